@@ -20,15 +20,24 @@ from __future__ import print_function
 
 import argparse
 import os
+import sys
 
-from typing import List
+from typing import Dict, List
 
+from . import buildcache as cbuildcache
 from . import charm as ccharm
 from . import config as cconfig
+from . import git as cgit
 from . import juju as cjuju
+from . import jujucall as cjujucall
+from . import testrun as ctestrun
+from . import timing as ctiming
 from . import utils as cu
 
 
+_TYPING_USED = (Dict,)
+
+
 charm_names = [
     'charm-cinder-storpool',
     'charm-storpool-block',
@@ -36,67 +45,80 @@ charm_names = [
 ]
 
 
-def test_element(cfg: cconfig.Config) -> None:
-    if os.path.isfile('tox.ini'):
-        cu.sp_msg('- running pep8/flake8 through tox')
-        cu.sp_run(cfg, ['tox', '-e', 'pep8'])
-        cu.sp_msg('- running all the tox tests')
-        cu.sp_run(cfg, ['tox', '-e', 'ALL'])
-        # Sigh... the build gets confused.  A lot.
-        cu.sp_msg('- removing the .tox/ directory')
-        cu.sp_run(cfg, ['rm', '-rf', '.tox/'])
-    else:
-        cu.sp_msg('- no tox.ini file, running some tests by ourselves')
-        cu.sp_msg('- running flake8')
-        cu.sp_run(cfg, ['flake8', '.'])
-        cu.sp_msg('- running pep8')
-        cu.sp_run(cfg, ['pep8', '.'])
-
-
-def test_elements(cfg: cconfig.Config, paths: List[str]) -> None:
-    for path in paths:
-        print('\n===== Testing {path}\n'.format(path=path))
-        cu.sp_chdir(cfg, '../' + path)
-        test_element(cfg)
-        cu.sp_chdir(cfg, '../')
-
-
 def cmd_checkout(cfg: cconfig.Config) -> None:
     ccharm.checkout_all(cfg, charm_names)
 
 
 def cmd_pull(cfg: cconfig.Config) -> None:
     subdir_full = '{base}/{subdir}'.format(base=cfg.basedir, subdir=cfg.subdir)
+    subdir_abs = os.path.abspath(subdir_full)
     cu.sp_msg('Updating the charms in the {d} directory'.format(d=subdir_full))
-    try:
-        cu.sp_chdir(cfg, subdir_full)
-    except FileNotFoundError:
+    if not cfg.noop and not os.path.isdir(subdir_full):
         exit('The {d} directory does not seem to exist!'
              .format(d=subdir_full))
 
+    if cfg.locked:
+        cu.parse_lock_file(cfg)
+
+    def pull_element(elem: ccharm.Element) -> None:
+        """ Update a single element, recording any failures. """
+        with ctiming.element(elem.fname):
+            pull_element_timed(elem)
+
+    def pull_element_timed(elem: ccharm.Element) -> None:
+        """ Actually update the element. """
+        cu.sp_msg('Updating the {name} {type}'
+                  .format(name=elem.name, type=elem.type))
+        try:
+            if cfg.locked:
+                state = cgit.PULL_LOCKED \
+                    if cgit.reconcile(cfg, elem.fname, elem.path) \
+                    else cgit.PULL_UNCHANGED
+            else:
+                state = cgit.pull(cfg, elem.fname, elem.path)
+        except cgit.RepoError as err:
+            failed[elem.fname] = str(err)
+            return
+
+        states[elem.fname] = state
+        if state == cgit.PULL_DIVERGED:
+            failed[elem.fname] = 'the local branch has diverged from ' \
+                'the upstream one'
+
+    def process_level(elements: List[ccharm.Element]) -> None:
+        cu.sp_parallel(cfg, pull_element, elements)
+
     def process_element(cfg: cconfig.Config,
                         elem: ccharm.Element,
                         to_process: List[ccharm.Element]) -> None:
-        cu.sp_msg('Updating the {name} {type}'
-                  .format(name=elem.name, type=elem.type))
-        cu.sp_chdir(cfg, elem.fname)
-        cu.sp_run(cfg, ['git', 'pull', '--ff-only'])
-        ccharm.parse_layers(cfg, elem.name, to_process, False)
+        ccharm.parse_layers(cfg, elem, to_process, False, graph)
         processed.append(elem.type + 's/' + elem.fname)
-        cu.sp_chdir(cfg, '../')
-
-    def process_charm(name: str, to_process: List[ccharm.Element]) -> None:
-        elem = ccharm.Element(
-            name=name,
-            type='charm',
-            parent_dir='',
-            fname=name,
-            exists=True,
-        )
+
+    def process_charm(elem: ccharm.Element,
+                      to_process: List[ccharm.Element]) -> None:
         process_element(cfg, elem, to_process)
 
+    failed = {}  # type: Dict[str, str]
+    states = {}  # type: Dict[str, str]
     processed = []  # type: List[str]
-    ccharm.recurse(cfg, charm_names, process_charm, process_element)
+    graph = ccharm.open_graph(cfg, subdir_abs)
+    ccharm.recurse(cfg, subdir_abs, charm_names, process_charm,
+                   process_element, process_level)
+    ccharm.save_graph(cfg, graph)
+
+    if not cfg.noop:
+        cu.sp_msg('Update summary:')
+        for name in sorted(set(states.keys()) | set(failed.keys())):
+            cu.sp_msg('- {name}: {state}'
+                      .format(name=name, state=states.get(name, 'failed')))
+
+    if failed:
+        cu.sp_msg('Could not update {count} of {total} elements:'
+                  .format(count=len(failed), total=len(processed)))
+        for name in sorted(failed):
+            cu.sp_msg('- {name}: {err}'.format(name=name, err=failed[name]))
+        exit('Some of the StorPool charms could not be updated in {subdir}'
+             .format(subdir=subdir_full))
 
     cu.sp_msg('The StorPool charms were updated in {subdir}'
               .format(subdir=subdir_full))
@@ -105,40 +127,31 @@ def cmd_pull(cfg: cconfig.Config) -> None:
 
 def cmd_test(cfg: cconfig.Config) -> None:
     subdir_full = '{base}/{subdir}'.format(base=cfg.basedir, subdir=cfg.subdir)
+    subdir_abs = os.path.abspath(subdir_full)
     cu.sp_msg('Running tox tests for the charms in the {d} directory'
               .format(d=subdir_full))
-    try:
-        cu.sp_chdir(cfg, subdir_full)
-    except FileNotFoundError:
+    if not cfg.noop and not os.path.isdir(subdir_full):
         exit('The {d} directory does not seem to exist!'
              .format(d=subdir_full))
 
-    def process_element(cfg: cconfig.Config,
-                        elem: ccharm.Element,
-                        to_process: List[ccharm.Element]) -> None:
-        cu.sp_msg('Examining the {name} {type}'
-                  .format(name=elem.name, type=elem.type))
-        cu.sp_chdir(cfg, elem.fname)
-        ccharm.parse_layers(cfg, elem.name, to_process, False)
-        processed.append(elem.type + 's/' + elem.fname)
-        cu.sp_chdir(cfg, '../')
-
-    def process_charm(name: str, to_process: List[ccharm.Element]) -> None:
-        elem = ccharm.Element(
-            name=name,
-            type='charm',
-            parent_dir='',
-            fname=name,
-            exists=True,
-        )
-        process_element(cfg, elem, to_process)
-
-    processed = []  # type: List[str]
-    ccharm.recurse(cfg, charm_names, process_charm, process_element)
+    graph = ccharm.load_graph(cfg, subdir_abs, charm_names)
+    processed = [node.type + 's/' + node.name
+                 for node in graph.nodes.values()]
 
     cu.sp_msg('Running the tox tests for {count} elements'
               .format(count=len(processed)))
-    test_elements(cfg, sorted(processed))
+    results = ctestrun.test_elements(cfg, subdir_abs, sorted(processed))
+    ctestrun.write_reports(cfg, results)
+
+    if not cfg.noop:
+        cu.sp_msg('Test results:')
+        for line in ctestrun.format_matrix(results):
+            cu.sp_msg(line)
+    failed = ctestrun.failed_elements(results)
+    if failed:
+        exit('The tests failed for {count} of {total} elements: {names}'
+             .format(count=len(failed), total=len(results),
+                     names=', '.join(failed)))
 
     cu.sp_msg('The StorPool charms were tested in {subdir}'
               .format(subdir=subdir_full))
@@ -149,6 +162,12 @@ def cmd_build(cfg: cconfig.Config) -> None:
     ccharm.build_all(cfg, charm_names)
 
 
+def cmd_prune_cache(cfg: cconfig.Config) -> None:
+    if cfg.cache_dir is None:
+        exit('No cache directory to prune')
+    cbuildcache.prune(cfg)
+
+
 def cmd_deploy(cfg: cconfig.Config) -> None:
     subdir_full = '{base}/{subdir}'.format(base=cfg.basedir, subdir=cfg.subdir)
     cu.sp_msg('Deploying the charms from the {d} directory'
@@ -162,7 +181,7 @@ def cmd_deploy(cfg: cconfig.Config) -> None:
     short_names = [name.replace('charm-', '') for name in charm_names]
 
     cu.sp_msg('Obtaining the current Juju status')
-    status = cjuju.get_status()
+    status = cjuju.get_status(cfg=cfg)
     found = [name for name in short_names if name in status['applications']]
     if found:
         exit('Found some StorPool charms already installed: {found}'
@@ -176,7 +195,7 @@ def cmd_undeploy(cfg: cconfig.Config) -> None:
     short_names = [name.replace('charm-', '') for name in charm_names]
 
     cu.sp_msg('Obtaining the current Juju status')
-    status = cjuju.get_status()
+    status = cjuju.get_status(cfg=cfg)
     found = [name for name in short_names if name in status['applications']]
     if not found:
         exit('No StorPool charms are installed')
@@ -201,7 +220,7 @@ def cmd_upgrade(cfg: cconfig.Config) -> None:
     short_names = [name.replace('charm-', '') for name in charm_names]
 
     cu.sp_msg('Obtaining the current Juju status')
-    status = cjuju.get_status()
+    status = cjuju.get_status(cfg=cfg)
     found = [name for name in short_names if name in status['applications']]
     if not found:
         exit('No StorPool charms are installed')
@@ -214,14 +233,14 @@ def cmd_upgrade(cfg: cconfig.Config) -> None:
 
 
 def cmd_generate_config(cfg: cconfig.Config) -> None:
-    status = cjuju.get_status()
+    status = cjuju.get_status(cfg=cfg)
     print(cjuju.get_storpool_config(cfg, status))
 
 
 def cmd_generate_charm_config(cfg: cconfig.Config) -> None:
     if cfg.repo_auth is None:
         exit('No repository username:password (-A) specified')
-    status = cjuju.get_status()
+    status = cjuju.get_status(cfg=cfg)
     conf = cjuju.get_storpool_config(cfg, status=status)
     charmconf = cjuju.get_charm_config(cfg, status, conf, [])
     print(charmconf)
@@ -231,6 +250,7 @@ COMMANDS = {
     'build': cmd_build,
     'deploy': cmd_deploy,
     'checkout': cmd_checkout,
+    'prune-cache': cmd_prune_cache,
     'pull': cmd_pull,
     'undeploy': cmd_undeploy,
     'upgrade': cmd_upgrade,
@@ -240,6 +260,29 @@ COMMANDS = {
 }
 
 
+def report_timings(fname: str) -> None:
+    ctiming.TIMINGS.write_report(fname)
+    cu.sp_msg('Timings written to {fname}; the slowest steps:'
+              .format(fname=fname))
+    for span in ctiming.TIMINGS.slowest():
+        name = span.name
+        if span.element is not None and span.element != span.name:
+            name = '[{elem}] {name}'.format(elem=span.element, name=name)
+        cu.sp_msg('{duration:10.3f}s  {stage:8s} {name}'
+                  .format(duration=span.duration, stage=span.stage,
+                          name=name))
+
+
+def report_juju_calls() -> None:
+    lines = cjujucall.CALLS.report()
+    if not lines:
+        return
+    # The output of some commands is the generated configuration.
+    print('Slow, retried, or failed Juju commands:', file=sys.stderr)
+    for line in lines:
+        print(line, file=sys.stderr)
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
         prog='storpool-charms',
@@ -248,30 +291,161 @@ def main() -> None:
         storpool-charms [-N] [-d basedir] [-s series] upgrade
         storpool-charms [-N] [-d basedir] undeploy
 
-        storpool-charms [-N] -S storpool-space generate-config
+        storpool-charms [-N] -S storpool-space [--hostname-source source] \
+[--probe-jobs count] [--probe-timeout seconds] [--probe-cache-ttl seconds] \
+[--refresh] generate-config
         storpool-charms [-N] -S storpool-space -A repo_auth \
-generate-charm-config
-
-        storpool-charms [-N] [-B branches-file] [-d basedir] checkout
-        storpool-charms [-N] [-d basedir] pull
-        storpool-charms [-N] [-d basedir] test
-        storpool-charms [-N] [-d basedir] [-s series] build
+[--hostname-source source] [--probe-jobs count] [--probe-timeout seconds] \
+[--probe-cache-ttl seconds] [--refresh] generate-charm-config
+
+        storpool-charms [-N] [-B branches-file] [-d basedir] [-j jobs] \
+[-L lock-file] [--incremental] [--locked] checkout
+        storpool-charms [-N] [-d basedir] [-j jobs] [-L lock-file] \
+[--locked] pull
+        storpool-charms [-N] [-d basedir] [-j jobs] [--force] \
+[--report dir] test
+        storpool-charms [-N] [-d basedir] [-j jobs] [-s series] [--changed] \
+[--rebuild] build
+        storpool-charms [-N] [-C cache-dir] [-M max-cache-size] prune-cache
 
     The "-A repo_auth" option accepts a repo_username:repo_password parameter.
 
     A {subdir} directory will be created in the specified base directory.
     For the "checkout" and "pull" commands, specifying "-X tox" will not run
-    the automated tests immediately after everything has been updated.'''
-        .format(subdir=cconfig.DEFAULT_SUBDIR),
+    the automated tests immediately after everything has been updated.
+    The "-j jobs" option specifies how many Git repositories to check out
+    or update, how many charms to build, or how many elements to test
+    at the same time.
+    Bare mirrors of the Git repositories are kept in the cache directory
+    (by default {cache}) so that subsequent checkouts only need to fetch
+    the changes; the built charms are also kept there, so that a charm is
+    only rebuilt if something that it includes has changed.  Specify
+    "--no-cache" to avoid that.  The external layers and interfaces, e.g.
+    layer:basic, are fetched by "charm build" itself, so a cached build
+    does not pick up their new versions; specify "--rebuild" to build
+    the charms anyway and replace the cached builds.
+    The "--incremental" option makes "checkout" keep the existing tree and
+    only switch the already checked out repositories to the correct branch
+    if needed.
+    The "checkout" command records the checked out commits in a lock file
+    (by default {subdir}-lock.yaml in the base directory); the "--locked"
+    option makes "checkout" and "pull" use the commits listed there.
+    The "build" command accepts a comma-separated list of series, e.g.
+    "-s xenial,bionic", and builds each charm for each of them.
+    The "--changed" option makes "build" only rebuild the charms that
+    include a layer or interface that has changed since the last build.
+    The "test" command skips the elements that passed their tests
+    the last time and have not changed since; specify "--force" to test
+    them anyway.
+    The "--report" option makes "test" write JUnit XML and JSON reports
+    and the full output of the tests into the specified directory;
+    each tox environment is run and reported on separately.
+    The "generate-config" and "generate-charm-config" commands use
+    the machines' hostnames as reported by "juju status" and only query
+    the machines that it does not report a hostname for; specify
+    "--hostname-source status" to only use "juju status" or
+    "--hostname-source ssh" to query all the machines.  The machines are
+    queried using "juju run" for up to 50 machines at once, and then
+    using "juju ssh" for the ones that "juju run" did not work for.
+    Up to "--probe-jobs" of these commands are run at a time (default:
+    {probe_jobs}), each one waiting for up to "--probe-timeout" seconds
+    (default: {probe_timeout}).
+    The hostnames queried are kept in the cache directory for
+    "--probe-cache-ttl" seconds (default: {probe_ttl}), so that only
+    the new or redeployed machines are queried the next time; specify
+    "--refresh" to query all of them anyway.
+    All the Juju commands are given "--juju-timeout" seconds to complete
+    (default: {juju_timeout}); the ones that only query the cluster are
+    retried up to "--juju-retries" times (default: {juju_retries}) with
+    an exponentially growing delay.  The Juju commands that were slow,
+    had to be retried, or failed are listed at the end.
+    The "--timings" option makes any command record how long each step
+    took into the specified JSON file and list the slowest steps.
+    The "build" command also keeps a shared pip download cache and
+    wheelhouse in the cache directory, and "test" keeps the tox
+    environments there; the "prune-cache" command removes the least
+    recently used cached builds, environments, and downloads until
+    they take up no more than the size specified by "-M" (default:
+    {max_size}).'''
+        .format(subdir=cconfig.DEFAULT_SUBDIR,
+                cache=cconfig.default_cache_dir(),
+                max_size='10G',
+                probe_jobs=cconfig.DEFAULT_PROBE_JOBS,
+                probe_timeout=cconfig.DEFAULT_PROBE_TIMEOUT,
+                probe_ttl=cconfig.DEFAULT_PROBE_CACHE_TTL,
+                juju_timeout=cconfig.DEFAULT_JUJU_TIMEOUT,
+                juju_retries=cconfig.DEFAULT_JUJU_RETRIES),
     )
+    parser.add_argument('-C', '--cache-dir',
+                        default=cconfig.default_cache_dir(),
+                        help='specify the directory to keep cached data in')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use or update any cached data; note '
+                        'that cached builds are not invalidated by new '
+                        'versions of the external layers')
+    parser.add_argument('--changed', action='store_true',
+                        help='only rebuild the charms that have changed')
     parser.add_argument('-d', '--basedir', default=cconfig.DEFAULT_BASEDIR,
                         help='specify the base directory for the charms tree')
+    parser.add_argument('--force', action='store_true',
+                        help='test all the elements, even unchanged ones')
+    parser.add_argument('--hostname-source', choices=cconfig.HOSTNAME_SOURCES,
+                        default=cconfig.HOSTNAME_SOURCE_AUTO,
+                        help='specify how to determine the hostnames of '
+                        'the machines')
+    parser.add_argument('--incremental', action='store_true',
+                        help='update an existing tree instead of recreating '
+                        'it')
+    parser.add_argument('-j', '--jobs', type=int, default=cconfig.DEFAULT_JOBS,
+                        help='specify the number of operations to run '
+                        'in parallel')
+    parser.add_argument('--juju-retries', type=int,
+                        default=cconfig.DEFAULT_JUJU_RETRIES,
+                        help='specify the number of times to retry a failed '
+                        'Juju command')
+    parser.add_argument('--juju-timeout', type=float,
+                        default=cconfig.DEFAULT_JUJU_TIMEOUT,
+                        help='specify the number of seconds to wait for '
+                        'a Juju command')
+    parser.add_argument('-L', '--lock-file',
+                        help='specify the YAML file listing the commits '
+                        'checked out')
+    parser.add_argument('--locked', action='store_true',
+                        help='check out the commits listed in the lock file')
+    parser.add_argument('-M', '--max-cache-size', default='10G',
+                        help='specify the size to prune the build caches '
+                        'down to, e.g. 512M or 10G')
     parser.add_argument('-N', '--noop', action='store_true',
                         help='no-operation mode, display what would be done')
+    parser.add_argument('--probe-cache-ttl', type=float,
+                        default=cconfig.DEFAULT_PROBE_CACHE_TTL,
+                        help='specify the number of seconds to use '
+                        'the cached machine hostnames for')
+    parser.add_argument('--probe-jobs', type=int,
+                        default=cconfig.DEFAULT_PROBE_JOBS,
+                        help='specify the number of machines to query '
+                        'at the same time')
+    parser.add_argument('--probe-timeout', type=float,
+                        default=cconfig.DEFAULT_PROBE_TIMEOUT,
+                        help='specify the number of seconds to wait for '
+                        'a machine to respond')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='build the charms even if there are cached '
+                        'builds, and replace those')
+    parser.add_argument('--refresh', action='store_true',
+                        help='query all the machines, ignoring any cached '
+                        'hostnames')
+    parser.add_argument('--report',
+                        help='specify the directory to write the test '
+                        'reports to')
     parser.add_argument('-s', '--series', default=cconfig.DEFAULT_SERIES,
-                        help='specify the name of the series to build for')
+                        help='specify the name of the series to build for, '
+                        'or a comma-separated list for "build"')
     parser.add_argument('-S', '--space',
                         help='specify the name of the StorPool network space')
+    parser.add_argument('--timings',
+                        help='write a JSON report of the time taken by each '
+                        'step to the specified file')
     parser.add_argument('-U', '--baseurl', default=cconfig.DEFAULT_BASEURL,
                         help='specify the base URL for the StorPool Git '
                         'repositories')
@@ -286,6 +460,22 @@ generate-charm-config
     parser.add_argument('command', choices=sorted(COMMANDS.keys()))
 
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('The number of jobs must be a positive integer')
+    if args.probe_jobs < 1:
+        parser.error('The number of probe jobs must be a positive integer')
+    if args.probe_timeout <= 0:
+        parser.error('The probe timeout must be a positive number')
+    if args.probe_cache_ttl < 0:
+        parser.error('The probe cache TTL must not be negative')
+    if args.juju_retries < 0:
+        parser.error('The number of Juju retries must not be negative')
+    if args.juju_timeout <= 0:
+        parser.error('The Juju timeout must be a positive number')
+    try:
+        max_cache_size = cbuildcache.parse_size(args.max_cache_size)
+    except ValueError as err:
+        parser.error(str(err))
     cfg = cconfig.Config(
         basedir=args.basedir,
         baseurl=args.baseurl,
@@ -295,8 +485,36 @@ generate-charm-config
         space=args.space,
         skip=args.skip,
         repo_auth=args.repo_auth,
+        jobs=args.jobs,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        incremental=args.incremental,
+        lock_file=args.lock_file,
+        locked=args.locked,
+        changed=args.changed,
+        rebuild=args.rebuild,
+        max_cache_size=max_cache_size,
+        force=args.force,
+        report_dir=args.report,
+        probe_jobs=args.probe_jobs,
+        probe_timeout=args.probe_timeout,
+        hostname_source=args.hostname_source,
+        probe_cache_ttl=args.probe_cache_ttl,
+        refresh=args.refresh,
+        juju_timeout=args.juju_timeout,
+        juju_retries=args.juju_retries,
     )
-    COMMANDS[args.command](cfg)
+    if not cfg.series_list:
+        parser.error('No series specified')
+    if args.command in ('deploy', 'upgrade') and len(cfg.series_list) > 1:
+        parser.error('Only a single series may be specified for '
+                     '"{cmd}"'.format(cmd=args.command))
+    try:
+        with ctiming.span(ctiming.STAGE_COMMAND, args.command):
+            COMMANDS[args.command](cfg)
+    finally:
+        report_juju_calls()
+        if args.timings is not None:
+            report_timings(args.timings)
 
 
 if __name__ == '__main__':
@@ -18,12 +18,12 @@ Run the actual commands to perform the needed actions.
 """
 
 import abc
-import subprocess
 
 from typing import List, Optional
 
 from . import config as cconfig
 from . import charm as ccharm
+from . import jujucall as cjujucall
 
 
 class Action(metaclass=abc.ABCMeta):
@@ -43,7 +43,8 @@ class Action(metaclass=abc.ABCMeta):
         if self._cfg.noop:
             print(' '.join(self.command))
         else:
-            subprocess.check_call(self.command, shell=False)
+            # Do not retry the commands that change the model.
+            cjujucall.check_call(self._cfg, self.command, retries=0)
 
 
 class ActComment(Action):
@@ -74,7 +75,7 @@ class ActDeployCharm(Action):
 
     @property
     def command(self) -> List[str]:
-        """ Deploy the charm from the correct directory. """
+        """ Deploy the charm from its archive or directory. """
         cmd = ['juju', 'deploy']
 
         if self._to is not None:
@@ -85,9 +86,9 @@ class ActDeployCharm(Action):
 
         cmd.extend([
             '--',
-            ccharm.charm_deploy_dir(self._cfg.basedir,
-                                    self._name,
-                                    self._cfg.series)
+            ccharm.charm_deploy_path(self._cfg.basedir,
+                                     self._name,
+                                     self._cfg.series)
         ])
         return cmd
 
@@ -102,12 +103,12 @@ class ActUpgradeCharm(Action):
 
     @property
     def command(self) -> List[str]:
-        """ Upgrade the charm from the correct directory. """
+        """ Upgrade the charm from its archive or directory. """
         return [
             'juju', 'upgrade-charm',
-            '--path', ccharm.charm_deploy_dir(self._cfg.basedir,
-                                              self._name,
-                                              self._cfg.series),
+            '--path', ccharm.charm_deploy_path(self._cfg.basedir,
+                                               self._name,
+                                               self._cfg.series),
             '--', self._name
         ]
 
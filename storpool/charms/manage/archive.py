@@ -0,0 +1,105 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Package the built charms into deterministic archives that Juju can
+deploy directly.
+"""
+
+
+import os
+import stat
+import zipfile
+
+from typing import Dict, List, Union
+
+from . import buildcache as cbuildcache
+from . import config as cconfig
+from . import utils as cu
+
+
+_TYPING_USED = (Dict, Union)
+
+
+MANIFEST_FORMAT = 1
+
+# The earliest timestamp that may be stored in a zip file.
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+# Mark the entries as created on Unix so that their modes are honored.
+ZIP_SYSTEM_UNIX = 3
+
+
+def archive_files(src_dir: str) -> List[str]:
+    """
+    Return the relative paths of the files and symlinks to store in
+    the archive of a built charm, in a stable order.
+    Symlinks to directories are not followed, but stored as symlinks.
+    """
+    res = []  # type: List[str]
+    for (dirpath, dirnames, filenames) in os.walk(src_dir):
+        dirnames.sort()
+        names = filenames + [name for name in dirnames
+                             if os.path.islink(os.path.join(dirpath, name))]
+        for name in sorted(names):
+            res.append(os.path.relpath(os.path.join(dirpath, name), src_dir))
+    return res
+
+
+def create_archive(cfg: cconfig.Config,
+                   src_dir: str,
+                   archive: str,
+                   manifest: str) -> None:
+    """
+    Store the files of a built charm into a zip archive, always in
+    the same order and with the same timestamps, so that building
+    the same charm twice produces identical archives.
+    Record the archive's hash in a manifest file next to it.
+    """
+    if cfg.noop:
+        cu.sp_msg("(would pack '{src}' into '{archive}')"
+                  .format(src=src_dir, archive=archive))
+        return
+
+    files = archive_files(src_dir)
+    tempf = cu.sp_temp_name(archive)
+    with zipfile.ZipFile(tempf, mode='w',
+                         compression=zipfile.ZIP_DEFLATED) as zf:
+        for relpath in files:
+            path = os.path.join(src_dir, relpath)
+            info = zipfile.ZipInfo(relpath, date_time=ZIP_EPOCH)
+            info.create_system = ZIP_SYSTEM_UNIX
+            info.compress_type = zipfile.ZIP_DEFLATED
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                # Store the link itself, never whatever it points to.
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                zf.writestr(info, os.readlink(path))
+                continue
+            mode = 0o755 if st.st_mode & stat.S_IXUSR else 0o644
+            info.external_attr = (stat.S_IFREG | mode) << 16
+            with open(path, mode='rb') as f:
+                zf.writestr(info, f.read())
+    os.rename(tempf, archive)
+
+    data = {
+        'format': MANIFEST_FORMAT,
+        'archive': os.path.basename(archive),
+        'sha256': cbuildcache.file_hash(archive),
+        'size': os.stat(archive).st_size,
+        'files': len(files),
+        'tree': cbuildcache.tree_hash(src_dir),
+    }  # type: Dict[str, Union[str, int]]
+    cu.sp_write_json(manifest, data, indent=2)
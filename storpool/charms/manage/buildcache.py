@@ -0,0 +1,392 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A content-addressed cache of built charms, keyed on a hash of
+everything that goes into the build.
+"""
+
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import stat
+import subprocess
+import threading
+
+from typing import Dict, List, Optional, Tuple
+
+from . import config as cconfig
+from . import utils as cu
+
+
+STATE_FILE = '.spcharms-built.json'
+
+RE_SIZE = re.compile(r'(?P<num> [0-9]+ ) \s* (?P<unit> [KMGT]? ) i?B? $',
+                     re.X | re.I)
+
+EXCLUDE_NAMES = set([
+    '.git',
+    '.tox',
+    '__pycache__',
+])
+
+
+def tree_hash(path: str) -> str:
+    """
+    Compute a hash of the names, permissions, and contents of all
+    the files in a directory tree, skipping Git metadata and the like.
+    """
+    if not os.path.isdir(path):
+        return 'missing'
+
+    digest = hashlib.sha256()
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        dirnames[:] = sorted(name for name in dirnames
+                             if name not in EXCLUDE_NAMES)
+        for name in sorted(filenames):
+            if name in EXCLUDE_NAMES or name.endswith('.pyc'):
+                continue
+            fname = os.path.join(dirpath, name)
+            relpath = os.path.relpath(fname, path)
+            st = os.lstat(fname)
+            if stat.S_ISLNK(st.st_mode):
+                digest.update('L {path}\0{target}\0'.format(
+                    path=relpath, target=os.readlink(fname)).encode('UTF-8'))
+                continue
+            digest.update('F {path}\0{mode:o}\0'.format(
+                path=relpath, mode=st.st_mode & 0o111).encode('UTF-8'))
+            with open(fname, mode='rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+_TOOLS_VERSION = {}  # type: Dict[str, str]
+_TOOLS_LOCK = threading.Lock()
+
+
+def charm_tools_version() -> str:
+    """ Return the version of the charm tools used for building. """
+    with _TOOLS_LOCK:
+        if 'charm' not in _TOOLS_VERSION:
+            try:
+                res = subprocess.run(['charm', 'version'],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+                version = res.stdout.decode('UTF-8', errors='replace') \
+                    .strip() if res.returncode == 0 else 'unknown'
+            except OSError:
+                version = 'unknown'
+            _TOOLS_VERSION['charm'] = version
+        return _TOOLS_VERSION['charm']
+
+
+def build_key(elements: Dict[str, str],
+              external: List[str],
+              series: str,
+              tools: str) -> str:
+    """
+    Compute the cache key for a charm build from the tree hashes of
+    the charm and all the layers and interfaces it includes, the names
+    of the external ones that "charm build" fetches by itself, the series,
+    and the version of the charm tools.
+    Note that the key does not change when a new version of an external
+    layer or interface is published; use cfg.rebuild for that.
+    """
+    data = json.dumps({
+        'elements': elements,
+        'external': external,
+        'series': series,
+        'tools': tools,
+    }, sort_keys=True)
+    return hashlib.sha256(data.encode('UTF-8')).hexdigest()
+
+
+def state_file(series_dir: str) -> str:
+    """
+    Return the path to the file recording the hashes of the elements
+    that the charms in the specified directory were built from.
+    """
+    return os.path.join(series_dir, STATE_FILE)
+
+
+def read_state(fname: str) -> Dict[str, Dict[str, str]]:
+    """
+    Read the hashes of the elements that each charm was last built from.
+    A missing or invalid file means that nothing is known.
+    """
+    try:
+        with open(fname, mode='r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {
+        name: hashes for name, hashes in data.items()
+        if isinstance(hashes, dict)
+    }
+
+
+def write_state(fname: str, state: Dict[str, Dict[str, str]]) -> None:
+    """ Record the hashes of the elements that each charm was built from. """
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    cu.sp_write_json(fname, state)
+
+
+def lookup(cfg: cconfig.Config, key: str) -> Optional[str]:
+    """
+    Return the path to a cached build, if there is one and the user
+    did not ask for all the charms to be built again.
+    """
+    if cfg.build_cache_dir is None or cfg.rebuild:
+        return None
+    path = os.path.join(cfg.build_cache_dir, key)
+    return path if os.path.isdir(path) else None
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """
+    Hardlink a file if possible, e.g. if the two paths are on the same
+    filesystem, and copy it otherwise.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def restore(cfg: cconfig.Config, cached: str, build_dir: str) -> None:
+    """
+    Hardlink or copy a cached build into the (nonexistent) build
+    directory.
+    """
+    if cfg.noop:
+        cu.sp_msg("# cp -al -- '{src}' '{dst}'"
+                  .format(src=cached, dst=build_dir))
+        return
+    shutil.copytree(cached, build_dir, symlinks=True,
+                    copy_function=link_or_copy)
+    os.utime(cached)
+
+
+def store(cfg: cconfig.Config, key: str, build_dir: str) -> None:
+    """
+    Store a hardlinked copy of a successful build in the cache, making
+    sure that other builds never see a partially-copied one.
+    If the charms are being rebuilt, replace any earlier cached build.
+    """
+    if cfg.build_cache_dir is None or cfg.noop:
+        return
+    path = os.path.join(cfg.build_cache_dir, key)
+    if os.path.isdir(path) and not cfg.rebuild:
+        return
+
+    os.makedirs(cfg.build_cache_dir, exist_ok=True)
+    tempd = cu.sp_temp_name(path)
+    shutil.copytree(build_dir, tempd, symlinks=True,
+                    copy_function=link_or_copy)
+    try:
+        if cfg.rebuild:
+            cu.sp_replace_dir(cfg, tempd, path)
+        else:
+            os.rename(tempd, path)
+    except OSError:
+        # Somebody else stored the same build in the meantime.
+        shutil.rmtree(tempd)
+
+
+def file_hash(fname: str) -> str:
+    """ Compute a hash of the contents of a file. """
+    digest = hashlib.sha256()
+    with open(fname, mode='rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def dedup(cfg: cconfig.Config, dirs: List[str]) -> Tuple[int, int]:
+    """
+    Replace the identical files within the specified directory trees
+    with hardlinks to a single copy.
+    Return the number of files replaced and the number of bytes freed,
+    only counting a file as freed if all its hardlinks were replaced,
+    e.g. if the build cache entries it was also linked from were among
+    the specified directories, too.
+    """
+    if cfg.noop:
+        cu.sp_msg('(would replace identical files in {dirs} with '
+                  'hardlinks)'.format(dirs=', '.join(dirs)))
+        return (0, 0)
+
+    by_size = {}  # type: Dict[int, List[Tuple[str, os.stat_result]]]
+    for top in dirs:
+        for (dirpath, _, filenames) in os.walk(top):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                    by_size.setdefault(st.st_size, []).append((path, st))
+
+    linked = 0
+    replaced = {}  # type: Dict[Tuple[int, int], int]
+    replaced_st = {}  # type: Dict[Tuple[int, int], os.stat_result]
+    for (size, files) in by_size.items():
+        if len(files) < 2:
+            continue
+        seen = {}  # type: Dict[Tuple[str, int, int], os.stat_result]
+        paths = {}  # type: Dict[Tuple[str, int, int], str]
+        hashes = {}  # type: Dict[Tuple[int, int], str]
+        for (path, st) in files:
+            inode = (st.st_dev, st.st_ino)
+            if inode not in hashes:
+                hashes[inode] = file_hash(path)
+            key = (hashes[inode], st.st_mode, st.st_dev)
+            orig = seen.get(key)
+            if orig is None:
+                seen[key] = st
+                paths[key] = path
+                continue
+            if orig.st_ino == st.st_ino:
+                continue
+
+            tempf = cu.sp_temp_name(path)
+            try:
+                os.link(paths[key], tempf)
+                os.rename(tempf, path)
+            except BaseException:
+                if os.path.lexists(tempf):
+                    os.unlink(tempf)
+                raise
+            linked += 1
+            replaced[inode] = replaced.get(inode, 0) + 1
+            replaced_st[inode] = st
+
+    freed = sum(st.st_size for inode, st in replaced_st.items()
+                if replaced[inode] >= st.st_nlink)
+    return (linked, freed)
+
+
+def build_env(cfg: cconfig.Config) -> List[str]:
+    """
+    Return the environment settings that make the charm build's pip
+    invocations use the shared download cache and wheelhouse.
+    """
+    if cfg.pip_cache_dir is None or cfg.wheelhouse_dir is None:
+        return []
+    return [
+        'PIP_CACHE_DIR={d}'.format(d=cfg.pip_cache_dir),
+        'PIP_FIND_LINKS={d}'.format(d=cfg.wheelhouse_dir),
+    ]
+
+
+def prepare_pip_cache(cfg: cconfig.Config) -> None:
+    """ Create the shared download cache and wheelhouse directories. """
+    for dname in (cfg.pip_cache_dir, cfg.wheelhouse_dir):
+        if dname is not None:
+            cu.sp_makedirs(cfg, dname, exist_ok=True)
+
+
+def collect_wheels(cfg: cconfig.Config, build_dir: str) -> None:
+    """
+    Copy the wheels and source archives from a built charm's wheelhouse
+    into the shared one, so that later builds do not download them again.
+    """
+    if cfg.wheelhouse_dir is None or cfg.noop:
+        return
+    for (dirpath, _, filenames) in os.walk(build_dir):
+        if os.path.basename(dirpath) != 'wheelhouse':
+            continue
+        for name in filenames:
+            dst = os.path.join(cfg.wheelhouse_dir, name)
+            if os.path.exists(dst):
+                os.utime(dst)
+                continue
+            tempf = cu.sp_temp_name(dst)
+            shutil.copyfile(os.path.join(dirpath, name), tempf)
+            os.rename(tempf, dst)
+
+
+def parse_size(value: str) -> int:
+    """ Parse a size specification such as "512M" or "10G". """
+    m = RE_SIZE.match(value.strip())
+    if m is None:
+        raise ValueError('Invalid size specification "{value}"'
+                         .format(value=value))
+    power = ' KMGT'.index(m.group('unit').upper() or ' ')
+    return int(m.group('num')) << (10 * power)
+
+
+def _cache_entries(cfg: cconfig.Config) -> List[Tuple[float, int, str]]:
+    """
+    Return the last-used time, size, and path of each separately
+    removable entry in the build-related caches: the cached builds and
+    tox environments as whole directories, and the downloaded files
+    one by one.
+    """
+    res = []  # type: List[Tuple[float, int, str]]
+    for top in (cfg.build_cache_dir, cfg.tox_cache_dir):
+        if top is None or not os.path.isdir(top):
+            continue
+        for name in os.listdir(top):
+            path = os.path.join(top, name)
+            if not os.path.isdir(path):
+                continue
+            size = 0
+            for (dirpath, _, filenames) in os.walk(path):
+                size += sum(os.lstat(os.path.join(dirpath, fname)).st_size
+                            for fname in filenames)
+            res.append((os.stat(path).st_mtime, size, path))
+
+    for top in (cfg.pip_cache_dir, cfg.wheelhouse_dir):
+        if top is None:
+            continue
+        for (dirpath, _, filenames) in os.walk(top):
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                st = os.lstat(path)
+                res.append((max(st.st_atime, st.st_mtime), st.st_size,
+                            path))
+    return res
+
+
+def prune(cfg: cconfig.Config) -> None:
+    """
+    Remove the least recently used cached builds, tox environments, and
+    downloaded files until the build-related caches fit in
+    cfg.max_cache_size bytes.
+    """
+    entries = sorted(_cache_entries(cfg))
+    total = sum(entry[1] for entry in entries)
+    cu.sp_msg('The build caches take up {total} bytes, the limit is '
+              '{limit} bytes'.format(total=total, limit=cfg.max_cache_size))
+    removed = 0
+    for (_, size, path) in entries:
+        if total <= cfg.max_cache_size:
+            break
+        if cfg.noop:
+            cu.sp_msg("# rm -rf -- '{path}'".format(path=path))
+        elif os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+        total -= size
+        removed += 1
+    cu.sp_msg('Removed {count} cache entries, {total} bytes left'
+              .format(count=removed, total=total))
@@ -21,12 +21,16 @@ Helper things to do with charms: check them out, build them, etc.
 import collections
 import os
 import re
-import yaml
+import subprocess
 
-from typing import Callable, Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
+from . import archive as carchive
+from . import buildcache as cbuildcache
 from . import config as cconfig
 from . import git as cgit
+from . import graph as cgraph
+from . import timing as ctiming
 from . import utils as cu
 
 
@@ -44,6 +48,7 @@ Element = collections.namedtuple('Element', [
     'parent_dir',
     'fname',
     'exists',
+    'path',
 ])
 
 
@@ -55,18 +60,61 @@ class CharmError(Exception):
         super(CharmError, self).__init__(message)
 
 
+def element_dir(subdir: str, elem: Element) -> str:
+    """ Return the path to the directory of a charm, layer, or interface. """
+    return '{subdir}/{type}s/{fname}' \
+        .format(subdir=subdir, type=elem.type, fname=elem.fname)
+
+
+def make_element(subdir: str, e_type: str, name: str, fname: str) -> Element:
+    """
+    Build an element object for a charm, layer, or interface in
+    the specified charms tree, checking whether it has been checked out.
+    """
+    parent_dir = '{subdir}/{t}s'.format(subdir=subdir, t=e_type)
+    dname = '{parent}/{fname}'.format(parent=parent_dir, fname=fname)
+    exists = os.path.exists(dname)
+    if exists and not os.path.isdir(dname):
+        raise CharmError(
+            'Something named {dname} exists and it is not a directory!'
+            .format(dname=dname))
+    return Element(
+        name=name,
+        type=e_type,
+        parent_dir=parent_dir,
+        fname=fname,
+        exists=exists,
+        path=dname,
+    )
+
+
+def charm_element(subdir: str, name: str) -> Element:
+    """ Build an element object for a charm. """
+    return make_element(subdir, 'charm', name, name)
+
+
 def parse_layers(cfg: cconfig.Config,
-                 name: str,
+                 elem: Element,
                  to_process: List[Element],
-                 layers_required: bool) -> None:
+                 layers_required: bool,
+                 graph: Optional[cgraph.Graph] = None) -> None:
+    """
+    Examine the layer.yaml file of a charm, layer, or interface and
+    add the elements it includes to the list to process.
+    If a dependency graph is specified, record the element and
+    the ones it includes there, and use its cache of parsed files.
+    """
+    if graph is None:
+        graph = cgraph.Graph()
+    graph.add_node(elem.fname, elem.type, elem.path)
     if cfg.noop:
         cu.sp_msg('(would examine the "layer.yaml" file and '
                   'process layers and interfaces recursively)')
         return
 
+    name = elem.fname
     try:
-        with open('layer.yaml', mode='r') as f:
-            contents = yaml.load(f)
+        includes = graph.read_includes(os.path.join(elem.path, 'layer.yaml'))
     except Exception as err:
         if isinstance(err, FileNotFoundError) and not layers_required:
             return
@@ -74,64 +122,70 @@ def parse_layers(cfg: cconfig.Config,
             'Could not load the layer.yaml file from {name}: {err}'
             .format(name=name, err=err))
 
-    for elem in contents['includes']:
-        if elem.find('storpool') == -1 and elem != 'interface:cinder-backend':
+    subdir = os.path.dirname(os.path.dirname(elem.path))
+    for inc in includes:
+        if inc.find('storpool') == -1 and inc != 'interface:cinder-backend':
+            graph.add_external(elem.fname, inc)
             continue
-        m = RE_ELEM.match(elem)
+        m = RE_ELEM.match(inc)
         if m is None:
             raise CharmError(
                 'Invalid value "{elem}" in the {name} "includes" directive!'
-                .format(name=name, elem=elem))
+                .format(name=name, elem=inc))
         (e_type, e_name) = (m.groupdict()['type'], m.groupdict()['name'])
-
-        parent_dir = '../{t}s'.format(t=e_type)
         fname = '{t}-{n}'.format(t=e_type, n=e_name)
-        dname = '{parent}/{fname}'.format(parent=parent_dir, fname=fname)
-        exists = os.path.exists(dname)
-        if exists and not os.path.isdir(dname):
-            raise CharmError(
-                'Something named {dname} exists and it is not a directory!'
-                .format(dname=dname))
-        to_process.append(Element(
-            name=e_name,
-            type=e_type,
-            parent_dir=parent_dir,
-            fname=fname,
-            exists=exists,
-        ))
+        graph.add_edge(elem.fname, fname)
+        to_process.append(make_element(subdir, e_type, e_name, fname))
 
 
-def checkout_element(cfg: cconfig.Config,
-                     name: str,
-                     to_process: List[Element],
-                     layers_required: bool = False) -> None:
+def open_graph(cfg: cconfig.Config, subdir: str) -> cgraph.Graph:
     """
-    Check out a single charm, interace, or layer, then look at
-    its configuration to find the elements it depends on.
+    Prepare an empty dependency graph for the specified charms tree,
+    backed by the cache of parsed layer.yaml files stored there.
     """
-    cgit.checkout(cfg, name)
-    cu.sp_chdir(cfg, name)
-    parse_layers(cfg, name, to_process, layers_required)
-    cu.sp_chdir(cfg, '../../charms')
+    if cfg.noop or not os.path.isdir(subdir):
+        return cgraph.Graph()
+    return cgraph.Graph(os.path.join(subdir, cgraph.CACHE_FILE))
+
+
+def save_graph(cfg: cconfig.Config, graph: cgraph.Graph) -> None:
+    """ Update the cache of parsed layer.yaml files if possible. """
+    if cfg.noop:
+        return
+    try:
+        graph.save()
+    except OSError as err:
+        cu.sp_msg('Could not update the dependency graph cache: {err}'
+                  .format(err=err))
 
 
 def recurse(cfg: cconfig.Config,
+            subdir: str,
             charm_names: List[str],
-            process_charm: Callable[[str, List[Element]], None],
+            process_charm: Callable[[Element, List[Element]], None],
             process_element: Optional[Callable[[cconfig.Config,
                                                 Element,
                                                 List[Element]],
-                                               None]]
+                                               None]],
+            process_level: Optional[Callable[[List[Element]], None]] = None
             ) -> None:
     """
     Recursively process a charm, its layers, its interfaces,
     their layers, their interfaces, etc.
+    The elements passed to the callbacks hold the full path to their
+    directories within the subdir charms tree, so nothing here depends on
+    the current working directory.
+    If specified, the process_level callback is invoked with all
+    the elements found at the same depth before any of them is processed.
     """
-    cu.sp_chdir(cfg, 'charms')
+    charms = [charm_element(subdir, name) for name in charm_names]
+    if process_level is not None:
+        process_level(charms)
 
     to_process = []  # type: List[Element]
-    for name in charm_names:
-        process_charm(name, to_process)
+    for elem in charms:
+        with ctiming.element(elem.fname):
+            process_charm(elem, to_process)
     if process_element is None:
         return
 
@@ -142,15 +196,42 @@ def recurse(cfg: cconfig.Config,
             break
         processing = {
             elem.fname: elem for elem in to_process
-            if elem.fname not in processed and not elem.exists
+            if elem.fname not in processed
         }.values()
         to_process = []
+        if process_level is not None:
+            process_level(list(processing))
         for elem in processing:
-            cu.sp_chdir(cfg, elem.parent_dir)
-            process_element(cfg, elem, to_process)
+            with ctiming.element(elem.fname):
+                process_element(cfg, elem, to_process)
             processed[elem.fname] = elem
 
 
+def load_graph(cfg: cconfig.Config,
+               subdir: str,
+               charm_names: List[str]) -> cgraph.Graph:
+    """
+    Examine the charms, layers, and interfaces already checked out in
+    the subdir charms tree and return their dependency graph.
+    Only the layer.yaml files that have changed since the last run are
+    parsed again.
+    """
+    def process_element(cfg: cconfig.Config,
+                        elem: Element,
+                        to_process: List[Element]) -> None:
+        cu.sp_msg('Examining the {name} {type}'
+                  .format(name=elem.name, type=elem.type))
+        parse_layers(cfg, elem, to_process, False, graph)
+
+    def process_charm(elem: Element, to_process: List[Element]) -> None:
+        process_element(cfg, elem, to_process)
+
+    graph = open_graph(cfg, subdir)
+    recurse(cfg, subdir, charm_names, process_charm, process_element)
+    save_graph(cfg, graph)
+    return graph
+
+
 def charm_build_dir(basedir: str, name: str, series: str) -> str:
     return '{base}/built/{series}/{name}'.format(base=basedir,
                                                  series=series,
@@ -164,38 +245,107 @@ def charm_deploy_dir(basedir: str, name: str, series: str) -> str:
                 name=name)
 
 
+def charm_archive(basedir: str, name: str, series: str) -> str:
+    return '{build}/{name}.charm' \
+        .format(build=charm_build_dir(basedir, name, series), name=name)
+
+
+def charm_deploy_path(basedir: str, name: str, series: str) -> str:
+    """
+    Return the path to the archive of a built charm if there is one,
+    and to its directory otherwise.
+    """
+    archive = charm_archive(basedir, name, series)
+    if os.path.isfile(archive):
+        return archive
+    return charm_deploy_dir(basedir, name, series)
+
+
+def write_lock_file(cfg: cconfig.Config, processed: List[Element]) -> None:
+    """ Record the branches and commits that have been checked out. """
+    branches = {}  # type: Dict[str, str]
+    commits = {}  # type: Dict[str, str]
+    if not cfg.noop:
+        for elem in processed:
+            branch = cgit.head_branch(elem.path)
+            commit = cgit.head_commit(elem.path)
+            if commit is None:
+                raise CharmError('Could not determine the commit checked '
+                                 'out in {dname}'.format(dname=elem.path))
+            branches[elem.fname] = branch if branch is not None \
+                else cfg.branches.get(elem.fname, 'master')
+            commits[elem.fname] = commit
+
+    cu.write_lock_file(cfg, branches, commits)
+
+
 def checkout_all(cfg: cconfig.Config, charm_names: List[str]) -> None:
-    """ Check out all the StorPool charms into the subdirectories. """
-    try:
-        cu.sp_chdir(cfg, cfg.basedir)
-    except FileNotFoundError:
+    """
+    Check out all the StorPool charms into the subdirectories.
+    The elements found at the same depth of the dependency tree are
+    checked out in parallel, up to cfg.jobs at a time.
+    In incremental mode, the existing tree is not removed; the elements
+    that are already checked out are only switched to the correct branch
+    if needed.
+    The branches and commits that were checked out are recorded in
+    the lock file; in locked mode, the same commits are checked out again.
+    """
+    subdir_full = os.path.abspath(os.path.join(cfg.basedir, cfg.subdir))
+    if not cfg.noop and not os.path.isdir(cfg.basedir):
         raise CharmError('The {d} directory does not seem to exist!'
                          .format(d=cfg.basedir))
 
-    cu.parse_branches_file(cfg)
+    if cfg.locked:
+        cu.parse_lock_file(cfg)
+    else:
+        cu.parse_branches_file(cfg)
+
+    comps = [os.path.join(subdir_full, comp)
+             for comp in ('layers', 'interfaces', 'charms')]
+    if cfg.incremental:
+        cu.sp_msg('Updating the {subdir}/ tree'.format(subdir=cfg.subdir))
+        for dname in [subdir_full] + comps:
+            cu.sp_makedirs(cfg, dname, exist_ok=True)
+    else:
+        cu.sp_msg('Recreating the {subdir}/ tree'.format(subdir=cfg.subdir))
+        cu.sp_run(cfg, ['rm', '-rf', '--', subdir_full])
+        for dname in [subdir_full] + comps:
+            cu.sp_mkdir(cfg, dname)
+
+    def clone_element(elem: Element) -> None:
+        with ctiming.element(elem.fname):
+            clone_element_timed(elem)
+
+    def clone_element_timed(elem: Element) -> None:
+        if cfg.incremental and os.path.isdir(elem.path):
+            cu.sp_msg('Examining the {name} {type}'
+                      .format(name=elem.name, type=elem.type))
+            cgit.reconcile(cfg, elem.fname, elem.path)
+            return
 
-    cu.sp_msg('Recreating the {subdir}/ tree'.format(subdir=cfg.subdir))
-    cu.sp_run(cfg, ['rm', '-rf', '--', cfg.subdir])
-    cu.sp_mkdir(cfg, cfg.subdir)
-    cu.sp_chdir(cfg, cfg.subdir)
-    for comp in ('layers', 'interfaces', 'charms'):
-        cu.sp_mkdir(cfg, comp)
+        cu.sp_msg('Checking out the {name} {type}'
+                  .format(name=elem.name, type=elem.type))
+        cgit.checkout(cfg, elem.fname, elem.path)
+
+    def process_level(elements: List[Element]) -> None:
+        cu.sp_parallel(cfg, clone_element, elements)
 
-    def process_charm(name: str, to_process: List[Element]) -> None:
-        cu.sp_msg('Checking out the {name} charm'.format(name=name))
-        checkout_element(cfg, name, to_process, layers_required=True)
-        processed.append('charms/' + name)
+    def process_charm(elem: Element, to_process: List[Element]) -> None:
+        parse_layers(cfg, elem, to_process, True, graph)
+        processed.append(elem)
 
     def process_element(cfg: cconfig.Config,
                         elem: Element,
                         to_process: List[Element]) -> None:
-        cu.sp_msg('Checking out the {name} {type}'
-                  .format(name=elem.name, type=elem.type))
-        checkout_element(cfg, elem.fname, to_process)
-        processed.append(elem.type + 's/' + elem.fname)
+        parse_layers(cfg, elem, to_process, False, graph)
+        processed.append(elem)
 
-    processed = []  # type: List[str]
-    recurse(cfg, charm_names, process_charm, process_element)
+    processed = []  # type: List[Element]
+    graph = open_graph(cfg, subdir_full)
+    recurse(cfg, subdir_full, charm_names, process_charm, process_element,
+            process_level)
+    save_graph(cfg, graph)
+    write_lock_file(cfg, processed)
 
     cu.sp_msg('The StorPool charms were checked out into {basedir}/{subdir}'
               .format(basedir=cfg.basedir, subdir=cfg.subdir))
@@ -203,37 +353,217 @@ def checkout_all(cfg: cconfig.Config, charm_names: List[str]) -> None:
 
 
 def build_all(cfg: cconfig.Config, charm_names: List[str]) -> None:
-    """ Build all the StorPool charms (already checked out). """
+    """
+    Build all the StorPool charms (already checked out) for all
+    the specified series.
+    Each charm is built in a new directory that then replaces the old
+    one, so that the old build is usable until the new one is ready.
+    The charms are built in parallel, up to cfg.jobs at a time; in that
+    case the output of each build is stored in a log file next to
+    the charm's build directory.
+    If the charm, the layers and interfaces it includes, the series, and
+    the charm tools version are the same as for an earlier build,
+    the result is copied from the build cache instead.
+    All the builds share a pip download cache and a wheelhouse, so that
+    the Python dependencies are only downloaded once.
+    The hashes of the elements that each charm was built from are
+    recorded in the build directory; in "changed" mode, only the charms
+    that include an element that has changed since then are rebuilt.
+    Each built charm is also packed into a deterministic archive that
+    may be deployed directly.
+    Finally, the identical files in the built charms for all the series
+    and in their build cache entries are replaced with hardlinks to
+    a single copy.
+    """
     subdir_full = '{base}/{subdir}'.format(base=cfg.basedir, subdir=cfg.subdir)
     cu.sp_msg('Building the charms in the {d} directory'.format(d=subdir_full))
-    try:
-        cu.sp_chdir(cfg, subdir_full, do_chdir=True)
-    except FileNotFoundError:
+    if not os.path.isdir(subdir_full):
         raise CharmError(
             'The {subdir} directory does not seem to exist!'
             .format(subdir=subdir_full))
-    basedir = os.getcwd()
-
-    def process_charm(name: str, to_process: List[Element]) -> None:
-        """ Build a single charm. """
-        cu.sp_msg('Building the {name} charm'.format(name=name))
-        cu.sp_chdir(cfg, name)
-        short_name = name.replace('charm-', '')
-        build_dir = charm_build_dir(basedir, short_name, cfg.series)
-        cu.sp_msg('- recreating the build directory')
-        cu.sp_run(cfg, ['rm', '-rf', '--', build_dir])
-        cu.sp_makedirs(cfg, build_dir, mode=0o755)
+    basedir = os.path.abspath(subdir_full)
+
+    def rebuild_reason(name: str,
+                       series: str,
+                       build_dir: str,
+                       current: Dict[str, str]) -> Optional[str]:
+        """ Explain why a charm needs to be rebuilt, if it does. """
+        previous = states[series].get(name)
+        if previous is None:
+            return 'it has not been built before'
+        if not os.path.isdir(build_dir):
+            return 'its build directory is missing'
+        changed = sorted(
+            elem for elem in set(previous.keys()) | set(current.keys())
+            if previous.get(elem) != current.get(elem))
+        if changed:
+            return 'changed: {names}'.format(names=', '.join(changed))
+        return None
+
+    def build_charm(target: Tuple[Element, str]) -> None:
+        """ Build a single charm for a single series, record the outcome. """
+        with ctiming.element('{name}/{series}'.format(name=target[0].fname,
+                                                      series=target[1])):
+            build_charm_timed(target)
+
+    def build_charm_timed(target: Tuple[Element, str]) -> None:
+        """ Actually build the charm. """
+        (elem, series) = target
+        short_name = elem.name.replace('charm-', '')
+        build_dir = charm_build_dir(basedir, short_name, series)
+        label = '{name} charm for {series}' \
+            .format(name=elem.name, series=series)
+        closure = graph.closure(elem.name)
+        current = {name: hashes[name] for name in closure}
+        key = cbuildcache.build_key(current, graph.external_includes(closure),
+                                    series, tools_version)
+        used_keys[target] = key
+        if cfg.changed and not cfg.noop:
+            reason = rebuild_reason(elem.name, series, build_dir, current)
+            if reason is None:
+                cu.sp_msg('Not rebuilding the {label}: none of its {n} '
+                          'elements have changed'
+                          .format(label=label, n=len(current)))
+                statuses[target] = 'unchanged, not rebuilt'
+                return
+            cu.sp_msg('Rebuilding the {label}: {reason}'
+                      .format(label=label, reason=reason))
+        else:
+            cu.sp_msg('Building the {label}'.format(label=label))
+
+        cached = cbuildcache.lookup(cfg, key)
+        new_dir = cu.sp_temp_name(build_dir)
+        new_archive = '{new}/{name}.charm'.format(new=new_dir,
+                                                  name=short_name)
+
+        def pack_charm() -> None:
+            """ Create the archive and the manifest of the new build. """
+            cu.sp_msg('- packing the charm')
+            carchive.create_archive(
+                cfg,
+                '{new}/{series}/{name}'.format(new=new_dir, series=series,
+                                               name=short_name),
+                new_archive,
+                '{new}/{name}.manifest.json'.format(new=new_dir,
+                                                    name=short_name))
+
+        cu.sp_msg('- preparing a new build directory')
+        cu.sp_run(cfg, ['rm', '-rf', '--', new_dir])
+        if cached is not None:
+            cu.sp_msg('- restoring the cached build {key}'
+                      .format(key=key[:12]))
+            cu.sp_makedirs(cfg, os.path.dirname(new_dir), exist_ok=True)
+            cbuildcache.restore(cfg, cached, new_dir)
+            if not cfg.noop and not os.path.isfile(new_archive):
+                pack_charm()
+            cu.sp_replace_dir(cfg, new_dir, build_dir)
+            statuses[target] = 'restored from the build cache'
+            new_states[series][elem.name] = current
+            return
+
+        cu.sp_makedirs(cfg, new_dir, mode=0o755)
         cu.sp_msg('- building the charm')
-        cu.sp_run(cfg, [
+        command = [
             'env',
             'LAYER_PATH={basedir}/layers'.format(basedir=basedir),
             'INTERFACE_PATH={basedir}/interfaces'.format(basedir=basedir),
-            'charm', 'build', '-s', cfg.series, '-n', short_name,
-            '-o', build_dir
-        ])
-        cu.sp_chdir(cfg, '../')
+        ] + cbuildcache.build_env(cfg) + [
+            'charm', 'build', '-s', series, '-n', short_name,
+            '-o', new_dir
+        ]
+        try:
+            if cfg.jobs > 1:
+                log_file = build_dir + '.log'
+                logs[target] = log_file
+                cu.sp_run_capture(cfg, command,
+                                  '{name}/{series}'.format(name=short_name,
+                                                           series=series),
+                                  cwd=elem.path, log_file=log_file)
+            else:
+                cu.sp_run(cfg, command, cwd=elem.path)
+        except subprocess.CalledProcessError as err:
+            statuses[target] = 'failed with exit code {code}' \
+                .format(code=err.returncode)
+            failed.append(label)
+            new_states[series].pop(elem.name, None)
+            cu.sp_run(cfg, ['rm', '-rf', '--', new_dir])
+            return
+        pack_charm()
+        cbuildcache.store(cfg, key, new_dir)
+        cu.sp_replace_dir(cfg, new_dir, build_dir)
+        statuses[target] = 'built'
+        new_states[series][elem.name] = current
+        cbuildcache.collect_wheels(cfg, build_dir)
+
+    graph = load_graph(cfg, basedir, charm_names)
+    names = sorted(graph.nodes.keys())
+    if cfg.noop:
+        hashes = {name: '' for name in names}
+        tools_version = ''
+    else:
+        cu.sp_msg('Examining the build inputs')
+        hashes = dict(zip(names, cu.sp_parallel(
+            cfg, cbuildcache.tree_hash,
+            [graph.nodes[name].path for name in names])))
+        tools_version = cbuildcache.charm_tools_version() \
+            if cfg.build_cache_dir is not None else ''
+
+    cbuildcache.prepare_pip_cache(cfg)
+    state_files = {
+        series: cbuildcache.state_file('{base}/built/{series}'
+                                       .format(base=basedir, series=series))
+        for series in cfg.series_list
+    }
+    states = {
+        series: cbuildcache.read_state(fname)
+        for series, fname in state_files.items()
+    }
+    new_states = {series: dict(state) for series, state in states.items()}
+    logs = {}  # type: Dict[Tuple[Element, str], str]
+    used_keys = {}  # type: Dict[Tuple[Element, str], str]
+    statuses = {}  # type: Dict[Tuple[Element, str], str]
+    failed = []  # type: List[str]
+    cu.sp_parallel(cfg, build_charm, [
+        (charm_element(basedir, name), series)
+        for series in cfg.series_list for name in charm_names
+    ])
+
+    built_top = '{base}/built'.format(base=basedir)
+    built_dirs = [
+        charm_build_dir(basedir, name.replace('charm-', ''), series)
+        for series in (sorted(os.listdir(built_top))
+                       if os.path.isdir(built_top) else [])
+        for name in charm_names
+    ]
+    # The built files are also hardlinked from the build cache entries;
+    # those must share the same copy, too, or nothing would be freed.
+    cache_dirs = [
+        path for path in (cbuildcache.lookup(cfg, key)
+                          for key in sorted(set(used_keys.values())))
+        if path is not None
+    ]
+    (linked, freed) = cbuildcache.dedup(
+        cfg, [dname for dname in built_dirs if os.path.isdir(dname)] +
+        cache_dirs)
+    if linked:
+        cu.sp_msg('Replaced {linked} identical files with hardlinks, '
+                  'freeing {freed} bytes'.format(linked=linked, freed=freed))
+
+    if not cfg.noop:
+        for series, fname in sorted(state_files.items()):
+            cbuildcache.write_state(fname, new_states[series])
+        cu.sp_msg('Build summary:')
+        for target in sorted(statuses, key=lambda t: (t[0].name, t[1])):
+            status = statuses[target]
+            if target in logs:
+                status += ', log in {log}'.format(log=logs[target])
+            cu.sp_msg('- {name} ({series}): {status}'
+                      .format(name=target[0].name, series=target[1],
+                              status=status))
+    if failed:
+        raise CharmError('Could not build the {labels}'
+                         .format(labels=', '.join(sorted(failed))))
 
-    recurse(cfg, charm_names, process_charm, None)
     cu.sp_msg('The StorPool charms were built in {subdir}'
               .format(subdir=subdir_full))
     cu.sp_msg('')
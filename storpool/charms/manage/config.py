@@ -17,13 +17,38 @@
 Configuration information for the StorPool charms management library.
 """
 
-from typing import Dict, Optional
+import os
+
+from typing import Dict, List, Optional
 
 
 DEFAULT_BASEDIR = '.'
 DEFAULT_SUBDIR = 'storpool-charms'
 DEFAULT_BASEURL = 'https://github.com/storpool'
 DEFAULT_SERIES = 'xenial'
+DEFAULT_JOBS = 1
+DEFAULT_MAX_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+DEFAULT_PROBE_JOBS = 16
+DEFAULT_PROBE_TIMEOUT = 60.0
+DEFAULT_PROBE_CACHE_TTL = 7 * 24 * 3600
+DEFAULT_JUJU_TIMEOUT = 300.0
+DEFAULT_JUJU_RETRIES = 2
+DEFAULT_JUJU_BACKOFF = 1.0
+
+HOSTNAME_SOURCE_AUTO = 'auto'
+HOSTNAME_SOURCE_SSH = 'ssh'
+HOSTNAME_SOURCE_STATUS = 'status'
+HOSTNAME_SOURCES = (
+    HOSTNAME_SOURCE_AUTO,
+    HOSTNAME_SOURCE_SSH,
+    HOSTNAME_SOURCE_STATUS,
+)
+
+
+def default_cache_dir() -> str:
+    """ Return the default directory to store cached data in. """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'spcharms')
 
 
 class Config(object):
@@ -38,7 +63,25 @@ class Config(object):
                  series: str = DEFAULT_SERIES,
                  space: Optional[str] = None,
                  skip: Optional[str] = None,
-                 repo_auth: Optional[str] = None) -> None:
+                 repo_auth: Optional[str] = None,
+                 jobs: int = DEFAULT_JOBS,
+                 cache_dir: Optional[str] = None,
+                 incremental: bool = False,
+                 lock_file: Optional[str] = None,
+                 locked: bool = False,
+                 changed: bool = False,
+                 rebuild: bool = False,
+                 max_cache_size: int = DEFAULT_MAX_CACHE_SIZE,
+                 force: bool = False,
+                 report_dir: Optional[str] = None,
+                 probe_jobs: int = DEFAULT_PROBE_JOBS,
+                 probe_timeout: float = DEFAULT_PROBE_TIMEOUT,
+                 hostname_source: str = HOSTNAME_SOURCE_AUTO,
+                 probe_cache_ttl: float = DEFAULT_PROBE_CACHE_TTL,
+                 refresh: bool = False,
+                 juju_timeout: float = DEFAULT_JUJU_TIMEOUT,
+                 juju_retries: int = DEFAULT_JUJU_RETRIES,
+                 juju_backoff: float = DEFAULT_JUJU_BACKOFF) -> None:
         """ Initialize a configuration object. """
         self._basedir = basedir
         self._subdir = subdir
@@ -49,8 +92,29 @@ class Config(object):
         self._space = space
         self._skip = skip
         self._repo_auth = repo_auth
+        self._jobs = jobs
+        # The cache paths are also used from within the elements' trees.
+        self._cache_dir = os.path.abspath(cache_dir) \
+            if cache_dir is not None else None
+        self._incremental = incremental
+        self._lock_file = lock_file
+        self._locked = locked
+        self._changed = changed
+        self._rebuild = rebuild
+        self._max_cache_size = max_cache_size
+        self._force = force
+        self._report_dir = report_dir
+        self._probe_jobs = probe_jobs
+        self._probe_timeout = probe_timeout
+        self._hostname_source = hostname_source
+        self._probe_cache_ttl = probe_cache_ttl
+        self._refresh = refresh
+        self._juju_timeout = juju_timeout
+        self._juju_retries = juju_retries
+        self._juju_backoff = juju_backoff
 
         self._branches = {}  # type: Dict[str, str]
+        self._commits = {}  # type: Dict[str, str]
 
     @property
     def basedir(self) -> str:
@@ -79,9 +143,15 @@ class Config(object):
 
     @property
     def series(self) -> str:
-        """ Return the charm series to build for. """
+        """ Return the charm series (possibly several) to build for. """
         return self._series
 
+    @property
+    def series_list(self) -> List[str]:
+        """ Return the comma-separated charm series as a list. """
+        return [series.strip() for series in self._series.split(',')
+                if series.strip()]
+
     @property
     def space(self) -> Optional[str]:
         """ Return the network space to configure for. """
@@ -97,6 +167,141 @@ class Config(object):
         """ Return the StorPool PPA authentication string. """
         return self._repo_auth
 
+    @property
+    def jobs(self) -> int:
+        """ Return the maximum number of operations to run at once. """
+        return self._jobs
+
+    @property
+    def cache_dir(self) -> Optional[str]:
+        """ Return the directory to store cached data in, if any. """
+        return self._cache_dir
+
+    @property
+    def mirror_dir(self) -> Optional[str]:
+        """ Return the directory to keep the Git repository mirrors in. """
+        if self._cache_dir is None:
+            return None
+        return os.path.join(self._cache_dir, 'mirrors')
+
+    @property
+    def build_cache_dir(self) -> Optional[str]:
+        """ Return the directory to keep the cached charm builds in. """
+        if self._cache_dir is None:
+            return None
+        return os.path.join(self._cache_dir, 'builds')
+
+    @property
+    def pip_cache_dir(self) -> Optional[str]:
+        """ Return the directory for pip to cache downloaded files in. """
+        if self._cache_dir is None:
+            return None
+        return os.path.join(self._cache_dir, 'pip')
+
+    @property
+    def wheelhouse_dir(self) -> Optional[str]:
+        """ Return the directory to collect the built charms' wheels in. """
+        if self._cache_dir is None:
+            return None
+        return os.path.join(self._cache_dir, 'wheelhouse')
+
+    @property
+    def tox_cache_dir(self) -> Optional[str]:
+        """ Return the directory to keep the tox environments in. """
+        if self._cache_dir is None:
+            return None
+        return os.path.join(self._cache_dir, 'tox')
+
+    @property
+    def probe_cache_file(self) -> Optional[str]:
+        """ Return the file to cache the facts queried from machines in. """
+        if self._cache_dir is None:
+            return None
+        return os.path.join(self._cache_dir, 'probes.json')
+
+    @property
+    def max_cache_size(self) -> int:
+        """ Return the size to trim the build-related caches down to. """
+        return self._max_cache_size
+
+    @property
+    def incremental(self) -> bool:
+        """ Return the flag for updating an existing tree in place. """
+        return self._incremental
+
+    @property
+    def lock_file(self) -> str:
+        """ Return the name of the file listing the checked out commits. """
+        if self._lock_file is not None:
+            return self._lock_file
+        return '{base}/{subdir}-lock.yaml'.format(base=self._basedir,
+                                                  subdir=self._subdir)
+
+    @property
+    def locked(self) -> bool:
+        """ Return the flag for checking out the commits in the lock file. """
+        return self._locked
+
+    @property
+    def changed(self) -> bool:
+        """ Return the flag for only rebuilding the changed charms. """
+        return self._changed
+
+    @property
+    def rebuild(self) -> bool:
+        """ Return the flag for rebuilding the charms despite the cache. """
+        return self._rebuild
+
+    @property
+    def force(self) -> bool:
+        """ Return the flag for ignoring any cached test results. """
+        return self._force
+
+    @property
+    def report_dir(self) -> Optional[str]:
+        """ Return the directory to write the test reports to. """
+        return self._report_dir
+
+    @property
+    def probe_jobs(self) -> int:
+        """ Return the maximum number of machines to probe at once. """
+        return self._probe_jobs
+
+    @property
+    def probe_timeout(self) -> float:
+        """ Return the number of seconds to wait for a machine probe. """
+        return self._probe_timeout
+
+    @property
+    def hostname_source(self) -> str:
+        """ Return the way to determine the machines' hostnames. """
+        return self._hostname_source
+
+    @property
+    def probe_cache_ttl(self) -> float:
+        """ Return the number of seconds to use the cached facts for. """
+        return self._probe_cache_ttl
+
+    @property
+    def refresh(self) -> bool:
+        """ Return the flag for ignoring the cached facts. """
+        return self._refresh
+
+    @property
+    def juju_timeout(self) -> float:
+        """ Return the number of seconds to wait for a Juju command. """
+        return self._juju_timeout
+
+    @property
+    def juju_retries(self) -> int:
+        """ Return the number of times to retry a failed Juju command. """
+        return self._juju_retries
+
+    @property
+    def juju_backoff(self) -> float:
+        """ Return the number of seconds to wait before the first retry. """
+        return self._juju_backoff
+
     @property
     def branches(self) -> Dict[str, str]:
         """ Return a copy of the parsed dictionary of branches. """
@@ -105,3 +310,12 @@ class Config(object):
     def set_branches(self, branches: Dict[str, str]) -> None:
         """ Set the parsed dictionary of branches. """
         self._branches = branches
+
+    @property
+    def commits(self) -> Dict[str, str]:
+        """ Return a copy of the dictionary of commits to check out. """
+        return dict(self._commits)
+
+    def set_commits(self, commits: Dict[str, str]) -> None:
+        """ Set the dictionary of commits to check out. """
+        self._commits = commits
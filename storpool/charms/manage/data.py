@@ -59,6 +59,8 @@ Interface = TypedDict('Interface', {
 
 Machine = TypedDict('Machine', {
     'juju-status': ObjectStatus,
+    'hostname': str,
+    'display-name': str,
     'dns-name': str,
     'ip-addresses': List[str],
     'instance-id': str,
@@ -19,11 +19,22 @@ Handle Git operations.
 
 
 import abc
+import hashlib
+import os
+import subprocess
+
+from typing import Optional
 
 from . import config as cconfig
 from . import utils as cu
 
 
+PULL_UNCHANGED = 'unchanged'
+PULL_FORWARDED = 'fast-forwarded'
+PULL_DIVERGED = 'diverged'
+PULL_LOCKED = 'reset to the locked commit'
+
+
 class RepoError(Exception, metaclass=abc.ABCMeta):
     """ A base class for errors that may occur during Git operations. """
 
@@ -68,13 +79,349 @@ class RepoCheckoutError(RepoError):
         return 'check out'
 
 
-def checkout(cfg: cconfig.Config, name: str) -> None:
-    """ Check out a single Git repository. """
-    url = '{base}/{name}.git'.format(base=cfg.baseurl, name=name)
+class RepoMirrorError(RepoError):
+    """ An error that occurred while updating a local mirror. """
+
+    @property
+    def action(self) -> str:
+        """ This error occurred while updating the mirror. """
+        return 'update the local mirror of'
+
+
+class RepoExamineError(RepoError):
+    """ An error that occurred while examining a local repository. """
+
+    @property
+    def action(self) -> str:
+        """ This error occurred while examining the repository. """
+        return 'examine'
+
+
+class RepoUpdateError(RepoError):
+    """ An error that occurred while updating a local repository. """
+
+    @property
+    def action(self) -> str:
+        """ This error occurred while updating the repository. """
+        return 'update'
+
+
+def repo_url(cfg: cconfig.Config, name: str) -> str:
+    """ Return the URL of the upstream Git repository. """
+    return '{base}/{name}.git'.format(base=cfg.baseurl, name=name)
+
+
+def read_ref(dirname: str, ref: str) -> Optional[str]:
+    """
+    Read the commit that a reference points to directly from the .git/
+    directory of a working tree, looking at the packed references if
+    there is no loose one; return None if there is no such reference.
+    """
+    return read_gitdir_ref(os.path.join(dirname, '.git'), ref)
+
+
+def read_gitdir_ref(gitdir: str, ref: str) -> Optional[str]:
+    """
+    Read the commit that a reference points to directly from a Git
+    directory, e.g. a bare mirror or the .git/ directory of a working tree.
+    """
+    try:
+        with open(os.path.join(gitdir, ref), mode='r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+
+    try:
+        with open(os.path.join(gitdir, 'packed-refs'), mode='r') as f:
+            for line in f.readlines():
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def read_head(dirname: str) -> str:
+    """ Read the HEAD of a Git working tree: a reference or a commit. """
+    fname = os.path.join(dirname, '.git', 'HEAD')
+    try:
+        with open(fname, mode='r') as f:
+            return f.read().strip()
+    except Exception as err:
+        raise RepoExamineError(dirname, err)
+
+
+def head_branch(dirname: str) -> Optional[str]:
+    """
+    Return the name of the branch checked out in a Git working tree or
+    None if its HEAD is detached.
+    """
+    head = read_head(dirname)
+    prefix = 'ref: refs/heads/'
+    if not head.startswith(prefix):
+        return None
+    return head[len(prefix):]
+
+
+def head_commit(dirname: str) -> Optional[str]:
+    """ Return the commit checked out in a Git working tree. """
+    head = read_head(dirname)
+    prefix = 'ref: '
+    if not head.startswith(prefix):
+        return head
+    return read_ref(dirname, head[len(prefix):])
+
+
+def has_commit(dirname: str, commit: str) -> bool:
+    """ Check whether a Git repository already contains a commit. """
+    return subprocess.call([
+        'git', '-C', dirname, 'cat-file', '-e', commit + '^{commit}',
+    ], stderr=subprocess.DEVNULL) == 0
+
+
+def worktree_hash(dirname: str) -> Optional[str]:
+    """
+    Return a string identifying the tree of the commit checked out in
+    a Git working tree along with any changes made to the tracked files;
+    return None if this cannot be determined.
+    """
+    try:
+        tree = subprocess.check_output([
+            'git', '-C', dirname, 'rev-parse', 'HEAD^{tree}',
+        ], stderr=subprocess.DEVNULL).decode('UTF-8').strip()
+        diff = subprocess.check_output([
+            'git', '-C', dirname, 'diff', '--binary', 'HEAD',
+        ], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if not diff:
+        return tree
+    return '{tree}+{diff}'.format(tree=tree,
+                                  diff=hashlib.sha256(diff).hexdigest())
+
+
+def update_mirror(cfg: cconfig.Config, name: str,
+                  commit: Optional[str] = None) -> Optional[str]:
+    """
+    Create or update the local bare mirror of a Git repository and
+    return its path, or return None if mirroring is disabled.
+    If a commit is specified and the mirror already contains it,
+    do not update the mirror at all.
+    """
+    if cfg.mirror_dir is None:
+        return None
+    url = repo_url(cfg, name)
+    path = '{mirrors}/{name}.git'.format(mirrors=cfg.mirror_dir, name=name)
+    try:
+        if commit is not None and os.path.isdir(path) and \
+                has_commit(path, commit):
+            cu.sp_msg('The local mirror {path} already contains {commit}'
+                      .format(path=path, commit=commit))
+        elif os.path.isdir(path):
+            cu.sp_msg('Updating the local mirror {path}'.format(path=path))
+            cu.sp_run(cfg, ['git', '--git-dir', path,
+                            'remote', 'set-url', 'origin', url])
+            cu.sp_run(cfg, ['git', '--git-dir', path,
+                            'fetch', '-q', '--prune', 'origin'])
+        else:
+            cu.sp_msg('Creating the local mirror {path}'.format(path=path))
+            cu.sp_makedirs(cfg, cfg.mirror_dir, mode=0o755, exist_ok=True)
+            cu.sp_run(cfg, ['git', 'clone', '-q', '--mirror', '--',
+                            url, path])
+    except Exception as err:
+        raise RepoMirrorError(name, err)
+    return path
+
+
+def checkout(cfg: cconfig.Config, name: str,
+             dirname: Optional[str] = None) -> None:
+    """
+    Check out a single Git repository, either into a subdirectory of
+    the current directory named after it or into the specified one.
+    """
+    url = repo_url(cfg, name)
     branch = cfg.branches.get(name, 'master')
+    commit = cfg.commits.get(name)
+    mirror = update_mirror(cfg, name, commit)
     cu.sp_msg('Checking out {url} branch {branch}'
               .format(url=url, branch=branch))
+    cmd = ['git', 'clone', '-b', branch, '--',
+           url if mirror is None else mirror]
+    if cfg.jobs > 1:
+        # Several progress meters at once would be no good to anyone.
+        cmd.insert(2, '-q')
+    if dirname is not None:
+        cmd.append(dirname)
     try:
-        cu.sp_run(cfg, ['git', 'clone', '-b', branch, '--', url])
+        cu.sp_run(cfg, cmd)
+        if mirror is not None:
+            # The objects were hardlinked from the mirror; now make sure
+            # that any further fetches go to the real thing.
+            cu.sp_run(cfg, ['git', '-C', name if dirname is None else dirname,
+                            'remote', 'set-url', 'origin', url])
+        if commit is not None:
+            checkout_commit(cfg, name if dirname is None else dirname,
+                            commit)
     except Exception as err:
         raise RepoCheckoutError(name, err)
+
+
+def checkout_commit(cfg: cconfig.Config, dirname: str, commit: str) -> None:
+    """
+    Reset the branch checked out in a freshly cloned repository to
+    the specified commit, fetching it if it is no longer on the branch.
+    """
+    cu.sp_msg('Resetting {dirname} to {commit}'
+              .format(dirname=dirname, commit=commit))
+    if not cfg.noop and not has_commit(dirname, commit):
+        cu.sp_run(cfg, ['git', '-C', dirname, 'fetch', '-q', 'origin',
+                        commit])
+    cu.sp_run(cfg, ['git', '-C', dirname, 'reset', '-q', '--hard', commit])
+
+
+def reconcile(cfg: cconfig.Config, name: str, dirname: str) -> bool:
+    """
+    Make sure that an existing checkout of a Git repository is on
+    the wanted branch at the commit that the branch points to upstream
+    (or, if a lock file was loaded, at the wanted commit); if it is not,
+    fetch that branch and forcibly reset the working tree to it.
+    Return True if anything had to be changed.
+    """
+    branch = cfg.branches.get(name, 'master')
+    commit = cfg.commits.get(name)
+    current = head_branch(dirname)
+
+    wanted = commit
+    mirror = None  # type: Optional[str]
+    mirror_updated = False
+    if commit is None and current == branch and not cfg.noop:
+        mirror = update_mirror(cfg, name)
+        mirror_updated = True
+        try:
+            if mirror is not None:
+                wanted = read_gitdir_ref(mirror, 'refs/heads/' + branch)
+            else:
+                wanted = remote_commit(cfg, name, dirname, branch)
+        except Exception as err:
+            raise RepoUpdateError(name, err)
+        if wanted is None:
+            raise RepoUpdateError(name, Exception(
+                'no {branch} branch in the upstream repository'
+                .format(branch=branch)))
+
+    if current == branch and \
+            (wanted is None or
+             read_ref(dirname, 'refs/heads/' + branch) == wanted):
+        cu.sp_msg('{name} is already on the {branch} branch'
+                  .format(name=name, branch=branch))
+        return False
+
+    if current == branch:
+        cu.sp_msg('Resetting {name} to {commit}'
+                  .format(name=name, commit=wanted))
+    else:
+        cu.sp_msg('Switching {name} from {current} to the {branch} branch'
+                  .format(name=name, branch=branch,
+                          current='a detached HEAD' if current is None
+                          else 'the ' + current + ' branch'))
+    if not mirror_updated:
+        mirror = update_mirror(cfg, name, commit)
+    remote = 'origin' if mirror is None else mirror
+    tracking = 'refs/remotes/origin/' + branch
+    try:
+        if commit is None:
+            cu.sp_run(cfg, ['git', '-C', dirname, 'fetch', '-q', remote,
+                            '+refs/heads/{b}:{t}'
+                            .format(b=branch, t=tracking)])
+            cu.sp_run(cfg, ['git', '-C', dirname, 'checkout', '-q', '-f',
+                            '-B', branch, '--track', tracking])
+        else:
+            if cfg.noop or not has_commit(dirname, commit):
+                cu.sp_run(cfg, ['git', '-C', dirname, 'fetch', '-q', remote,
+                                '+refs/heads/*:refs/remotes/origin/*'])
+            cu.sp_run(cfg, ['git', '-C', dirname, 'checkout', '-q', '-f',
+                            '-B', branch, commit])
+    except Exception as err:
+        raise RepoUpdateError(name, err)
+    return True
+
+
+def remote_commit(cfg: cconfig.Config, name: str, dirname: str,
+                  branch: str) -> Optional[str]:
+    """
+    Ask the upstream repository of a working tree which commit a branch
+    points to; return None if there is no such branch or, in no-operation
+    mode, if nothing was asked.
+    """
+    output = cu.sp_run_output(cfg, [
+        'git', '-C', dirname, 'ls-remote', 'origin', 'refs/heads/' + branch,
+    ], prefix=name)
+    if output is None:
+        return None
+    for line in output.split('\n'):
+        fields = line.split()
+        if len(fields) == 2 and fields[1] == 'refs/heads/' + branch:
+            return fields[0]
+    return None
+
+
+def is_ancestor(cfg: cconfig.Config, name: str, dirname: str,
+                first: str, second: str) -> bool:
+    """ Check whether the first commit is an ancestor of the second one. """
+    try:
+        output = cu.sp_run_output(cfg, [
+            'git', '-C', dirname, 'merge-base', '--is-ancestor',
+            first, second,
+        ], prefix=name)
+    except subprocess.CalledProcessError as err:
+        if err.returncode == 1:
+            return False
+        raise
+    return output is not None
+
+
+def pull(cfg: cconfig.Config, name: str, dirname: str) -> str:
+    """
+    Update the checked out branch of a Git working tree from its upstream
+    repository if possible, and return one of the PULL_* constants.
+    First ask the upstream repository whether there is anything to fetch
+    at all, comparing its idea of the branch to the one in the .git/
+    directory, so that up-to-date repositories are not touched at all.
+    """
+    if cfg.noop:
+        cu.sp_run_capture(cfg, ['git', '-C', dirname, 'pull', '--ff-only'],
+                          prefix=name)
+        return PULL_UNCHANGED
+
+    try:
+        branch = head_branch(dirname)
+        if branch is None:
+            raise Exception('not on a branch')
+        local_ref = 'refs/heads/' + branch
+        tracking = 'refs/remotes/origin/' + branch
+
+        remote = remote_commit(cfg, name, dirname, branch)
+        if remote is None:
+            raise Exception('no {branch} branch in the upstream repository'
+                            .format(branch=branch))
+        if remote == read_ref(dirname, local_ref):
+            return PULL_UNCHANGED
+
+        cu.sp_run_capture(cfg, [
+            'git', '-C', dirname, 'fetch', '-q', 'origin',
+            '+{local}:{tracking}'.format(local=local_ref, tracking=tracking),
+        ], prefix=name)
+        if is_ancestor(cfg, name, dirname, local_ref, tracking):
+            cu.sp_run_capture(cfg, [
+                'git', '-C', dirname, 'merge', '-q', '--ff-only', tracking,
+            ], prefix=name)
+            return PULL_FORWARDED
+        elif is_ancestor(cfg, name, dirname, tracking, local_ref):
+            # Nothing new upstream, the local branch is simply ahead.
+            return PULL_UNCHANGED
+        return PULL_DIVERGED
+    except RepoError:
+        raise
+    except Exception as err:
+        raise RepoUpdateError(name, err)
@@ -0,0 +1,220 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The dependency graph of the charms, layers, and interfaces, along with
+a persistent cache of the parsed layer.yaml files.
+"""
+
+
+import collections
+import json
+import os
+import threading
+import yaml
+
+from typing import Any, Dict, List, Optional, Set
+
+from . import utils as cu
+
+
+_TYPING_USED = (Any,)
+
+
+CACHE_FILE = '.spcharms-graph.json'
+
+CACHE_FORMAT = 1
+
+
+# Use the much faster libyaml-based loader if it is available.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+Node = collections.namedtuple('Node', [
+    'name',
+    'type',
+    'path',
+])
+
+
+class GraphError(Exception):
+    """ An error that occurred while examining the dependency graph. """
+
+    def __init__(self, message: str) -> None:
+        """ Initialize a graph error object. """
+        super(GraphError, self).__init__(message)
+
+
+class Graph(object):
+    """
+    The charms, layers, and interfaces and the "includes" relations
+    between them.  If a cache file is specified, the list of elements
+    included by each layer.yaml file is stored there, keyed on the file's
+    path, modification time, and size, so that only the files that have
+    changed since the last run need to be parsed again.
+    """
+
+    def __init__(self, cache_file: Optional[str] = None) -> None:
+        """ Initialize an empty graph, load the cache if there is one. """
+        self._cache_file = cache_file
+        self._nodes = {}  # type: Dict[str, Node]
+        self._edges = {}  # type: Dict[str, List[str]]
+        self._external = {}  # type: Dict[str, List[str]]
+        self._files = {}  # type: Dict[str, Dict[str, Any]]
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        if cache_file is None:
+            return
+        try:
+            with open(cache_file, mode='r') as f:
+                data = json.load(f)
+            if isinstance(data, dict) and \
+                    data.get('format') == CACHE_FORMAT and \
+                    isinstance(data.get('files'), dict):
+                self._files = data['files']
+        except (OSError, ValueError):
+            # A missing or corrupt cache is simply rebuilt.
+            pass
+
+    @property
+    def nodes(self) -> Dict[str, Node]:
+        """ Return the elements in the graph, keyed on their names. """
+        return dict(self._nodes)
+
+    @property
+    def edges(self) -> Dict[str, List[str]]:
+        """ Return the names of the elements that each element includes. """
+        return {name: list(deps) for name, deps in self._edges.items()}
+
+    def add_node(self, name: str, e_type: str, path: str) -> None:
+        """ Add a charm, layer, or interface to the graph. """
+        with self._lock:
+            self._nodes[name] = Node(name=name, type=e_type, path=path)
+            self._edges.setdefault(name, [])
+
+    def add_edge(self, src: str, dst: str) -> None:
+        """ Record that the src element includes the dst one. """
+        with self._lock:
+            deps = self._edges.setdefault(src, [])
+            if dst not in deps:
+                deps.append(dst)
+
+    def add_external(self, name: str, include: str) -> None:
+        """
+        Record that the element includes a layer or interface that is
+        not checked out locally, but fetched by "charm build" itself.
+        """
+        with self._lock:
+            includes = self._external.setdefault(name, [])
+            if include not in includes:
+                includes.append(include)
+
+    def external_includes(self, names: Set[str]) -> List[str]:
+        """
+        Return the external layers and interfaces that the specified
+        elements include directly.
+        """
+        return sorted(set(
+            include for name in names
+            for include in self._external.get(name, [])))
+
+    def read_includes(self, fname: str) -> List[str]:
+        """
+        Return the "includes" list of a layer.yaml file, parsing it
+        only if it has changed since it was cached.
+        Let the FileNotFoundError propagate if there is no such file.
+        """
+        stat = os.stat(fname)
+        key = os.path.abspath(fname)
+        with self._lock:
+            cached = self._files.get(key)
+        if cached is not None and \
+                cached.get('mtime_ns') == stat.st_mtime_ns and \
+                cached.get('size') == stat.st_size:
+            return list(cached['includes'])
+
+        with open(fname, mode='r') as f:
+            contents = yaml.load(f, Loader=YAML_LOADER)
+        if not isinstance(contents, dict) or \
+                not isinstance(contents.get('includes'), list) or \
+                [inc for inc in contents['includes']
+                 if not isinstance(inc, str)]:
+            raise GraphError('No "includes" list of strings in {fname}'
+                             .format(fname=fname))
+
+        includes = contents['includes']  # type: List[str]
+        with self._lock:
+            self._files[key] = {
+                'mtime_ns': stat.st_mtime_ns,
+                'size': stat.st_size,
+                'includes': includes,
+            }
+            self._dirty = True
+        return list(includes)
+
+    def save(self) -> None:
+        """ Store the parsed layer.yaml files into the cache file. """
+        if self._cache_file is None or not self._dirty:
+            return
+        self._files = {
+            fname: data for fname, data in self._files.items()
+            if os.path.exists(fname)
+        }
+        cu.sp_write_json(self._cache_file,
+                         {'format': CACHE_FORMAT, 'files': self._files})
+        self._dirty = False
+
+    def topological_order(self) -> List[str]:
+        """
+        Return the names of all the elements, each one following
+        all the elements that it includes.
+        """
+        order = []  # type: List[str]
+        done = set()  # type: Set[str]
+        active = set()  # type: Set[str]
+
+        def visit(name: str) -> None:
+            """ Add the dependencies of an element, then the element. """
+            if name in done:
+                return
+            if name in active:
+                raise GraphError('Circular dependency involving {name}'
+                                 .format(name=name))
+            active.add(name)
+            for dep in sorted(self._edges.get(name, [])):
+                visit(dep)
+            active.remove(name)
+            done.add(name)
+            order.append(name)
+
+        for name in sorted(self._nodes.keys()):
+            visit(name)
+        return order
+
+    def closure(self, name: str) -> Set[str]:
+        """
+        Return the names of the element itself and of all the elements
+        that it includes, directly or indirectly.
+        """
+        res = set()  # type: Set[str]
+        pending = [name]
+        while pending:
+            current = pending.pop()
+            if current in res:
+                continue
+            res.add(current)
+            pending.extend(self._edges.get(current, []))
+        return res
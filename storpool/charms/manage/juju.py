@@ -19,16 +19,19 @@ Helper routines for accessing the Juju cluster.
 
 
 import abc
+import concurrent.futures
 import subprocess
 
 import json
 import yaml
 
-from typing import cast, Any, Dict, List, Optional, Set
+from typing import cast, Any, Dict, List, Optional, Set, Tuple
 
 from . import actions as cact
 from . import config as cconfig
 from . import data as cdata
+from . import jujucall as cjujucall
+from . import probecache as cprobecache
 
 
 _TYPING_USED = (Optional,)
@@ -40,6 +43,17 @@ STORAGE_CHARMS = ('cinder',)
 COMPUTE_CHARMS = ('nova-compute', 'nova-compute-kvm',)
 
 
+FACT_MARKER = '--- spcharms fact '
+
+FACT_COMMANDS = {
+    'hostname': 'hostname',
+    'interfaces': 'ip -o link show up',
+}
+
+# The maximum number of machines to pass to a single "juju run" command.
+FACT_CHUNK_SIZE = 50
+
+
 class Error(Exception):
     """ A base class for Juju-related errors. """
 
@@ -176,10 +190,14 @@ def add_storpool_status(res: cdata.Status) -> None:
     })
 
 
-def get_status(add_sp: bool = True) -> cdata.Status:
+def get_status(add_sp: bool = True,
+               cfg: Optional[cconfig.Config] = None) -> cdata.Status:
     """ Get the "juju status" output. """
+    if cfg is None:
+        cfg = cconfig.Config()
     try:
-        status_j = subprocess.check_output(['juju', 'status', '--format=json'])
+        status_j = cjujucall.check_output(
+            cfg, ['juju', 'status', '--format=json'])
     except Exception as err:  # pylint: disable=broad-except
         raise RunError('status', err)
 
@@ -419,9 +437,13 @@ def get_upgrade_actions(cfg: cconfig.Config,
     return actions
 
 
-def juju_ssh_single_line(cmd: List[str]) -> str:
+def juju_ssh_single_line(cfg: cconfig.Config,
+                         cmd: List[str],
+                         host: Optional[str] = None,
+                         timeout: Optional[float] = None) -> str:
     """ Get the first non-empty line from a command's output. """
-    output = subprocess.check_output(cmd).decode('UTF-8')
+    output = cjujucall.check_output(cfg, cmd, host=host,
+                                    timeout=timeout).decode('UTF-8')
     lines = output.split('\n')
     for line in lines:
         stripped = line.strip()  # type: str
@@ -430,6 +452,253 @@ def juju_ssh_single_line(cmd: List[str]) -> str:
     return ''
 
 
+def probe_hostnames(cfg: cconfig.Config,
+                    targets: List[str]) -> Dict[str, str]:
+    """
+    Run "hostname" on the specified machines, up to cfg.probe_jobs of
+    them at a time, waiting no more than cfg.probe_timeout seconds for
+    each one.
+    """
+    def probe(tgt: str) -> str:
+        """ Get the hostname of a single machine. """
+        cmd = ['juju', 'ssh', tgt, 'hostname']
+        try:
+            return juju_ssh_single_line(cfg, cmd, host=tgt,
+                                        timeout=cfg.probe_timeout)
+        except (OSError, subprocess.SubprocessError) as err:
+            raise RunError(' '.join(cmd), err)
+
+    if not targets:
+        return {}
+    workers = max(1, min(cfg.probe_jobs, len(targets)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(targets, pool.map(probe, targets)))
+
+
+def fact_script(facts: List[str]) -> str:
+    """
+    Build a shell script that outputs each of the requested facts
+    after a line naming it.
+    """
+    return '; '.join(
+        "echo '{marker}{name}'; {cmd}"
+        .format(marker=FACT_MARKER, name=name, cmd=FACT_COMMANDS[name])
+        for name in facts)
+
+
+def parse_facts(output: str) -> Dict[str, str]:
+    """ Split the output of a fact_script() run into the separate facts. """
+    res = {}  # type: Dict[str, str]
+    current = None  # type: Optional[str]
+    for line in output.split('\n'):
+        if line.startswith(FACT_MARKER):
+            current = line[len(FACT_MARKER):].strip()
+            res[current] = ''
+        elif current is not None:
+            res[current] += line + '\n'
+    return {name: value.strip() for name, value in res.items()}
+
+
+def parse_run_output(raw: bytes) -> Dict[str, Tuple[int, str]]:
+    """
+    Parse the JSON output of a "juju run --machine" command into
+    the exit code and the standard output for each machine.
+    Handle both the list of results output by older Juju versions and
+    the dictionary of completed tasks output by newer ones.
+    """
+    data = json.loads(raw.decode('UTF-8'))
+    if isinstance(data, dict):
+        items = []  # type: List[Tuple[str, Dict[str, Any]]]
+        for key, task in data.items():
+            assert isinstance(task, dict), 'not a JSON object: ' + key
+            mid = task.get('machine', key.replace('machine-', '', 1))
+            results = task.get('results', {})
+            assert isinstance(results, dict), 'no results for ' + key
+            items.append((str(mid), results))
+    else:
+        assert isinstance(data, list), 'neither a JSON object nor a list'
+        items = []
+        for result in data:
+            assert isinstance(result, dict), 'not a JSON object in the list'
+            items.append((str(result.get('MachineId')), result))
+
+    res = {}  # type: Dict[str, Tuple[int, str]]
+    for (mid, result) in items:
+        code = 0
+        for field in ('return-code', 'ReturnCode', 'Code'):
+            if field in result:
+                code = int(result[field])
+                break
+        if result.get('Error'):
+            code = code or 1
+        stdout = result.get('stdout', result.get('Stdout', ''))
+        res[mid] = (code, stdout if isinstance(stdout, str) else '')
+    return res
+
+
+def run_facts_batch(cfg: cconfig.Config,
+                    targets: List[str],
+                    facts: List[str]) -> Dict[str, Dict[str, str]]:
+    """
+    Collect the requested facts from the specified machines using
+    a single "juju run" command.
+    Return the facts only for the machines that the command succeeded on.
+    """
+    cmd = [
+        'juju', 'run', '--format=json',
+        '--timeout', '{t}s'.format(t=int(cfg.probe_timeout)),
+        '--machine', ','.join(targets),
+        fact_script(facts),
+    ]
+    try:
+        # Fall back to "juju ssh" instead of retrying the whole chunk.
+        output = cjujucall.check_output(
+            cfg, cmd, host=','.join(targets),
+            timeout=cfg.probe_timeout + 30, retries=0)
+    except (OSError, subprocess.SubprocessError):
+        return {}
+    try:
+        results = parse_run_output(output)
+    except (ValueError, AssertionError):
+        return {}
+    return {
+        mid: parse_facts(stdout)
+        for mid, (code, stdout) in results.items()
+        if code == 0 and mid in targets
+    }
+
+
+def collect_facts(cfg: cconfig.Config,
+                  targets: List[str],
+                  facts: List[str]) -> Dict[str, Dict[str, str]]:
+    """
+    Collect the requested facts from the specified machines, splitting
+    them into chunks of FACT_CHUNK_SIZE machines for a single
+    "juju run" command each.
+    The machines that could not be queried are omitted from the result.
+    """
+    chunks = [targets[idx:idx + FACT_CHUNK_SIZE]
+              for idx in range(0, len(targets), FACT_CHUNK_SIZE)]
+    if not chunks:
+        return {}
+
+    res = {}  # type: Dict[str, Dict[str, str]]
+    workers = max(1, min(cfg.probe_jobs, len(chunks)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for data in pool.map(lambda chunk: run_facts_batch(cfg, chunk, facts),
+                             chunks):
+            res.update(data)
+    return res
+
+
+def query_hostnames(cfg: cconfig.Config,
+                    targets: List[str]) -> Dict[str, str]:
+    """
+    Query the specified machines for their hostnames, first using
+    a single "juju run" command for many machines at once, then using
+    "juju ssh" for the ones that it did not work for.
+    """
+    res = {}  # type: Dict[str, str]
+    for mid, data in collect_facts(cfg, targets, ['hostname']).items():
+        name = data.get('hostname', '').split('\n')[0].strip()
+        if name:
+            res[mid] = name
+
+    res.update(probe_hostnames(cfg, [tgt for tgt in targets
+                                     if tgt not in res]))
+    return res
+
+
+def get_model_uuid(cfg: cconfig.Config) -> Optional[str]:
+    """ Get the UUID of the current Juju model, if possible. """
+    try:
+        output = cjujucall.check_output(
+            cfg, ['juju', 'show-model', '--format=json'],
+            timeout=cfg.probe_timeout, retries=0)
+        data = json.loads(output.decode('UTF-8'))
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+    if not isinstance(data, dict) or len(data) != 1:
+        return None
+    model = list(data.values())[0]
+    if not isinstance(model, dict):
+        return None
+    uuid = model.get('model-uuid')
+    return uuid if isinstance(uuid, str) and uuid else None
+
+
+def cached_query_hostnames(cfg: cconfig.Config,
+                           status: cdata.Status,
+                           targets: List[str]) -> Dict[str, str]:
+    """
+    Query the specified machines for their hostnames, using the cached
+    results for the machines that were queried recently and are still
+    running the same instances.
+    """
+    fname = cfg.probe_cache_file
+    model_uuid = get_model_uuid(cfg) \
+        if fname is not None and targets else None
+    if model_uuid is None:
+        return query_hostnames(cfg, targets)
+
+    entries = cprobecache.read_cache(fname)
+    keys = {
+        tgt: cprobecache.cache_key(
+            model_uuid, tgt, status['machines'][tgt].get('instance-id', ''))
+        for tgt in targets
+    }
+    res = {}  # type: Dict[str, str]
+    for tgt in targets:
+        facts = cprobecache.lookup(cfg, entries, keys[tgt])
+        if facts is not None and facts.get('hostname'):
+            res[tgt] = facts['hostname']
+
+    queried = query_hostnames(cfg, [tgt for tgt in targets
+                                    if tgt not in res])
+    for tgt, name in queried.items():
+        cprobecache.store(entries, keys[tgt], {'hostname': name})
+    res.update(queried)
+    cprobecache.write_cache(cfg, fname, entries)
+    return res
+
+
+def status_hostname(mach: cdata.Machine) -> Optional[str]:
+    """
+    Return the hostname of a machine as reported by "juju status", if
+    it is there at all.
+    """
+    for field in ('hostname', 'display-name'):
+        value = mach.get(field)
+        if isinstance(value, str) and value.strip():
+            return value.strip()
+    return None
+
+
+def resolve_hostnames(cfg: cconfig.Config,
+                      status: cdata.Status,
+                      targets: List[str]) -> Dict[str, str]:
+    """
+    Determine the hostnames of the specified machines according to
+    cfg.hostname_source: use the ones reported by "juju status", query
+    the machines themselves, or query only the machines that
+    "juju status" does not report a hostname for.
+    """
+    res = {}  # type: Dict[str, str]
+    if cfg.hostname_source != cconfig.HOSTNAME_SOURCE_SSH:
+        for tgt in targets:
+            name = status_hostname(status['machines'][tgt])
+            if name is not None:
+                res[tgt] = name
+
+    missing = [tgt for tgt in targets if tgt not in res]
+    if missing and cfg.hostname_source == cconfig.HOSTNAME_SOURCE_STATUS:
+        raise StorPoolError('storpool-config', Exception(
+            '"juju status" does not report the hostnames of machines {mids}'
+            .format(mids=', '.join(missing))))
+    res.update(cached_query_hostnames(cfg, status, missing))
+    return res
+
+
 def get_storpool_config_data(cfg: cconfig.Config,
                              status: cdata.Status) -> Dict[str,
                                                            Dict[str, str]]:
@@ -442,10 +711,12 @@ def get_storpool_config_data(cfg: cconfig.Config,
     for machine_names in status['_meta']['sp']['machines'].values():
         targets.update(machine_names)
 
+    hostnames = resolve_hostnames(cfg, status, sorted(targets))
+
     res = {}  # type: Dict[str, Dict[str, str]]
     seen_hostnames = {}  # type: Dict[str, str]
     for (oid, tgt) in enumerate(sorted(targets)):
-        name = juju_ssh_single_line(['juju', 'ssh', tgt, 'hostname'])
+        name = hostnames[tgt]
         if name in seen_hostnames:
             raise StorPoolError('storpool-config', Exception(
                 'Hostname "{name}" seen on both machines {old} and {new}'
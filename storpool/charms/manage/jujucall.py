@@ -0,0 +1,182 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run Juju commands with a timeout, retry the ones that fail, and keep
+track of the slow ones.
+"""
+
+
+import collections
+import subprocess
+import threading
+import time
+
+from typing import Callable, List, Optional
+
+from . import config as cconfig
+
+
+# Report the calls that took longer than that many seconds.
+SLOW_CALL = 10.0
+
+# Never wait longer than that many seconds before retrying a call.
+MAX_BACKOFF = 30.0
+
+
+Call = collections.namedtuple('Call', [
+    'command',
+    'host',
+    'attempts',
+    'timeouts',
+    'duration',
+    'timed_out',
+    'failed',
+])
+
+
+class CallLog(object):
+    """ Record the Juju commands run and the way they went. """
+
+    def __init__(self) -> None:
+        """ Start with no calls recorded. """
+        self._lock = threading.Lock()
+        self._calls = []  # type: List[Call]
+
+    def add(self, call: Call) -> None:
+        """ Record a single call. """
+        with self._lock:
+            self._calls.append(call)
+
+    @property
+    def calls(self) -> List[Call]:
+        """ Return the calls recorded so far. """
+        with self._lock:
+            return list(self._calls)
+
+    def reset(self) -> None:
+        """ Forget all the calls recorded so far. """
+        with self._lock:
+            self._calls = []
+
+    def problems(self, slow: float = SLOW_CALL) -> List[Call]:
+        """
+        Return the calls that failed, had to be retried, or took longer
+        than the specified number of seconds, the slowest ones first.
+        """
+        return sorted((call for call in self.calls
+                       if call.failed or call.attempts > 1 or
+                       call.duration >= slow),
+                      key=lambda call: call.duration,
+                      reverse=True)
+
+    def report(self, slow: float = SLOW_CALL) -> List[str]:
+        """ Describe the problematic calls, one per line. """
+        res = []  # type: List[str]
+        for call in self.problems(slow):
+            if call.failed:
+                notes = ' ({res}{attempts})'.format(
+                    res='timed out' if call.timed_out else 'failed',
+                    attempts=', {count} attempts'.format(count=call.attempts)
+                    if call.attempts > 1 else '')
+            elif call.attempts > 1:
+                notes = ' - succeeded after {retries} retries ' \
+                    '({timeouts} timeouts)'.format(
+                        retries=call.attempts - 1, timeouts=call.timeouts)
+            else:
+                notes = ''
+            res.append('{duration:8.2f}s  {host}: {cmd}{notes}'.format(
+                duration=call.duration,
+                host=call.host if call.host is not None else '(controller)',
+                cmd=' '.join(call.command),
+                notes=notes))
+        return res
+
+
+CALLS = CallLog()
+
+
+def _run(cfg: cconfig.Config,
+         func: Callable[[List[str], float], bytes],
+         cmd: List[str],
+         host: Optional[str],
+         timeout: Optional[float],
+         retries: Optional[int]) -> bytes:
+    """
+    Invoke a subprocess function, retrying the failed or timed out
+    attempts with an exponentially growing delay.
+    """
+    if timeout is None:
+        timeout = cfg.juju_timeout
+    if retries is None:
+        retries = cfg.juju_retries
+
+    start = time.monotonic()
+    (attempts, timeouts, timed_out, failed) = (0, 0, False, True)
+    try:
+        while True:
+            attempts += 1
+            try:
+                res = func(cmd, timeout)
+                failed = False
+                return res
+            except subprocess.TimeoutExpired:
+                (timeouts, timed_out) = (timeouts + 1, True)
+                if attempts > retries:
+                    raise
+            except (OSError, subprocess.CalledProcessError):
+                timed_out = False
+                if attempts > retries:
+                    raise
+            time.sleep(min(cfg.juju_backoff * 2 ** (attempts - 1),
+                           MAX_BACKOFF))
+    finally:
+        CALLS.add(Call(command=cmd, host=host, attempts=attempts,
+                       timeouts=timeouts,
+                       duration=time.monotonic() - start,
+                       timed_out=failed and timed_out, failed=failed))
+
+
+def check_output(cfg: cconfig.Config,
+                 cmd: List[str],
+                 host: Optional[str] = None,
+                 timeout: Optional[float] = None,
+                 retries: Optional[int] = None) -> bytes:
+    """
+    Run a Juju command and return its output, retrying it if it fails
+    or takes longer than the timeout (by default cfg.juju_timeout).
+    """
+    def run(cmd: List[str], timeout: float) -> bytes:
+        """ Run the command once. """
+        return subprocess.check_output(cmd, timeout=timeout)
+
+    return _run(cfg, run, cmd, host, timeout, retries)
+
+
+def check_call(cfg: cconfig.Config,
+               cmd: List[str],
+               host: Optional[str] = None,
+               timeout: Optional[float] = None,
+               retries: Optional[int] = None) -> None:
+    """
+    Run a Juju command, retrying it if it fails or takes longer than
+    the timeout (by default cfg.juju_timeout).
+    """
+    def run(cmd: List[str], timeout: float) -> bytes:
+        """ Run the command once. """
+        subprocess.check_call(cmd, shell=False, timeout=timeout)
+        return b''
+
+    _run(cfg, run, cmd, host, timeout, retries)
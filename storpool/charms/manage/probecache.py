@@ -0,0 +1,107 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A persistent cache of the facts queried from the Juju machines, keyed on
+the model, the machine, and the instance running as that machine.
+"""
+
+
+import json
+import os
+import time
+
+from typing import Any, Dict, Optional
+
+from . import config as cconfig
+from . import utils as cu
+
+
+_TYPING_USED = (Any,)
+
+
+CACHE_FORMAT = 1
+
+
+def cache_key(model_uuid: str, mid: str, instance_id: str) -> str:
+    """ Build the key to store a machine's facts under. """
+    return '{model}/{mid}/{iid}'.format(model=model_uuid, mid=mid,
+                                        iid=instance_id)
+
+
+def read_cache(fname: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Read the cached facts.  A missing or invalid file means that
+    nothing is known.
+    """
+    if fname is None:
+        return {}
+    try:
+        with open(fname, mode='r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get('format') != CACHE_FORMAT or \
+            not isinstance(data.get('machines'), dict):
+        return {}
+    return {
+        key: entry for key, entry in data['machines'].items()
+        if isinstance(entry, dict) and
+        isinstance(entry.get('time'), (int, float)) and
+        isinstance(entry.get('facts'), dict)
+    }
+
+
+def write_cache(cfg: cconfig.Config,
+                fname: Optional[str],
+                entries: Dict[str, Dict[str, Any]]) -> None:
+    """ Store the facts that have not expired yet into the cache file. """
+    if fname is None or cfg.noop:
+        return
+    now = time.time()
+    data = {
+        'format': CACHE_FORMAT,
+        'machines': {
+            key: entry for key, entry in entries.items()
+            if now - entry['time'] < cfg.probe_cache_ttl
+        },
+    }
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    cu.sp_write_json(fname, data)
+
+
+def lookup(cfg: cconfig.Config,
+           entries: Dict[str, Dict[str, Any]],
+           key: str) -> Optional[Dict[str, str]]:
+    """
+    Return the cached facts about a machine unless they have expired or
+    the user asked for all the machines to be queried again.
+    """
+    if cfg.refresh:
+        return None
+    entry = entries.get(key)
+    if entry is None or time.time() - entry['time'] >= cfg.probe_cache_ttl:
+        return None
+    return dict(entry['facts'])
+
+
+def store(entries: Dict[str, Dict[str, Any]],
+          key: str,
+          facts: Dict[str, str]) -> None:
+    """ Record the facts just queried from a machine. """
+    entries[key] = {
+        'time': time.time(),
+        'facts': dict(facts),
+    }
@@ -0,0 +1,431 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run the tests of the charms, layers, and interfaces.
+"""
+
+
+import collections
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import buildcache as cbuildcache
+from . import config as cconfig
+from . import git as cgit
+from . import timing as ctiming
+from . import utils as cu
+
+
+STATE_FILE = '.spcharms-tested.json'
+
+REQUIREMENTS_FILES = set([
+    'tox.ini',
+    'setup.py',
+    'setup.cfg',
+    'wheelhouse.txt',
+])
+
+RE_REQUIREMENTS = re.compile(r'.*requirements.*\.txt $', re.X)
+
+RE_DIGEST = re.compile('[0-9a-f]{16} $', re.X)
+
+RE_TOX_ENV = re.compile('[A-Za-z0-9_.-]+ $', re.X)
+
+STATUS_PASSED = 'passed'
+STATUS_FAILED = 'failed'
+STATUS_SKIPPED = 'skipped'
+STATUS_CACHED = 'cached'
+
+
+EXCERPT_LINES = 40
+
+
+StepResult = collections.namedtuple('StepResult', [
+    'step',
+    'status',
+    'duration',
+    'excerpt',
+])
+
+
+def tox_workdir(cfg: cconfig.Config, path: str) -> Optional[str]:
+    """
+    Return the directory for tox to keep an element's environments in,
+    keyed on the files that specify the element's dependencies, so that
+    the environments are only recreated when those change.
+    """
+    if cfg.tox_cache_dir is None:
+        return None
+
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        if name not in REQUIREMENTS_FILES and \
+                not RE_REQUIREMENTS.match(name):
+            continue
+        fname = os.path.join(path, name)
+        if os.path.isfile(fname):
+            digest.update('{name}\0{hash}\0'.format(
+                name=name,
+                hash=cbuildcache.file_hash(fname)).encode('UTF-8'))
+    return os.path.join(cfg.tox_cache_dir, '{name}-{digest}'.format(
+        name=os.path.basename(path), digest=digest.hexdigest()[:16]))
+
+
+def prepare_tox_workdir(cfg: cconfig.Config, workdir: str) -> None:
+    """
+    Create the tox working directory for an element if needed and
+    remove the ones left over from its earlier dependencies.
+    """
+    if cfg.noop:
+        cu.sp_msg("# makedirs '{d}' exist_ok True".format(d=workdir))
+        return
+
+    os.makedirs(workdir, exist_ok=True)
+    os.utime(workdir)
+    (parent, current) = os.path.split(workdir)
+    prefix = current[:-16]
+    for name in os.listdir(parent):
+        if name != current and name.startswith(prefix) and \
+                RE_DIGEST.match(name[len(prefix):]):
+            cu.sp_msg('- removing the outdated {name} tox environments'
+                      .format(name=name))
+            shutil.rmtree(os.path.join(parent, name))
+
+
+def tox_envs(cfg: cconfig.Config,
+             path: str,
+             tox: List[str]) -> Optional[List[str]]:
+    """
+    List the tox environments of an element so that they may be run
+    and reported on one by one; return None if tox cannot tell.
+    """
+    try:
+        output = cu.sp_run_output(cfg, tox + ['-l'], os.path.basename(path),
+                                  cwd=path)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if output is None:
+        return None
+    envs = [line.strip() for line in output.split('\n')
+            if RE_TOX_ENV.match(line.strip())]
+    return envs if envs else None
+
+
+def element_steps(cfg: cconfig.Config,
+                  path: str,
+                  workdir: Optional[str] = None
+                  ) -> List[Tuple[str, List[str]]]:
+    """
+    Return the names and commands of the tests to run for an element:
+    the pep8 tests first, then each of its tox environments in turn.
+    """
+    if os.path.isfile(os.path.join(path, 'tox.ini')):
+        tox = ['tox'] if workdir is None else ['tox', '--workdir', workdir]
+        envs = tox_envs(cfg, path, tox)
+        if envs is None:
+            return [
+                ('pep8', tox + ['-e', 'pep8']),
+                ('tox', tox + ['-e', 'ALL']),
+            ]
+        return [('pep8', tox + ['-e', 'pep8'])] + [
+            (env, tox + ['-e', env]) for env in envs if env != 'pep8'
+        ]
+    return [
+        ('flake8', ['flake8', '.']),
+        ('pep8', ['pep8', '.']),
+    ]
+
+
+def test_element(cfg: cconfig.Config, path: str) -> List[StepResult]:
+    """
+    Run the tests for a single element, stopping at the first failure.
+    If several elements are tested at once, capture the output of
+    the tests so that it is not mixed up.
+    If there is a cache directory, the tox environments are kept there
+    instead of in the element's .tox/ directory, and reused later.
+    """
+    has_tox = os.path.isfile(os.path.join(path, 'tox.ini'))
+    workdir = tox_workdir(cfg, path) if has_tox else None
+    if workdir is not None:
+        prepare_tox_workdir(cfg, workdir)
+    steps = element_steps(cfg, path, workdir)
+    if not has_tox:
+        cu.sp_msg('- no tox.ini file, running some tests by ourselves')
+
+    name = os.path.basename(path)
+    results = []  # type: List[StepResult]
+    for (step, command) in steps:
+        if results and results[-1].status != STATUS_PASSED:
+            results.append(StepResult(step=step, status=STATUS_SKIPPED,
+                                      duration=0.0, excerpt=''))
+            continue
+
+        cu.sp_msg('- {name}: running {step}'.format(name=name, step=step))
+        start = time.monotonic()
+        excerpt = ''
+        try:
+            if cfg.report_dir is not None:
+                cu.sp_run_capture(cfg, command, name, cwd=path,
+                                  log_file=os.path.join(
+                                      cfg.report_dir, 'logs',
+                                      '{name}-{step}.log'
+                                      .format(name=name, step=step)))
+            elif cfg.jobs > 1:
+                cu.sp_run_capture(cfg, command, name, cwd=path)
+            else:
+                cu.sp_run(cfg, command, cwd=path)
+            status = STATUS_PASSED
+        except subprocess.CalledProcessError as err:
+            status = STATUS_FAILED
+            if err.output:
+                excerpt = '\n'.join(
+                    err.output.decode('UTF-8', errors='replace')
+                    .rstrip('\n').split('\n')[-EXCERPT_LINES:])
+        results.append(StepResult(step=step, status=status,
+                                  duration=time.monotonic() - start,
+                                  excerpt=excerpt))
+
+    if has_tox and workdir is None:
+        # Sigh... the build gets confused.  A lot.
+        cu.sp_msg('- {name}: removing the .tox/ directory'.format(name=name))
+        cu.sp_run(cfg, ['rm', '-rf', '.tox/'], cwd=path)
+    return results
+
+
+def element_key(path: str) -> Optional[Dict[str, str]]:
+    """
+    Identify the current contents of an element's working tree and
+    its tox.ini file; return None if the tree cannot be identified.
+    """
+    tree = cgit.worktree_hash(path)
+    if tree is None:
+        return None
+    tox_ini = os.path.join(path, 'tox.ini')
+    return {
+        'tree': tree,
+        'tox_ini': cbuildcache.file_hash(tox_ini)
+        if os.path.isfile(tox_ini) else '',
+    }
+
+
+def read_state(fname: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Read the keys and the test durations of the elements that passed
+    their tests the last time; a missing or invalid file means none.
+    """
+    try:
+        with open(fname, mode='r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {
+        path: value for path, value in data.items()
+        if isinstance(value, dict) and
+        isinstance(value.get('key'), dict) and
+        isinstance(value.get('steps'), list)
+    }
+
+
+def write_state(fname: str, state: Dict[str, Dict[str, Any]]) -> None:
+    """ Record the elements that passed their tests. """
+    cu.sp_write_json(fname, state)
+
+
+def test_elements(cfg: cconfig.Config,
+                  subdir: str,
+                  paths: List[str]) -> Dict[str, List[StepResult]]:
+    """
+    Run the tests for the specified elements (relative to subdir),
+    up to cfg.jobs of them at a time, and return the results.
+    The elements that passed their tests the last time and have not
+    changed since then are not tested again unless cfg.force is set.
+    """
+    def run_element(path: str) -> List[StepResult]:
+        """ Test a single element unless it has already passed. """
+        full = os.path.join(subdir, path)
+        key = None if cfg.noop else element_key(full)
+        prev = state.get(path)
+        if key is not None and prev is not None and not cfg.force and \
+                prev['key'] == key:
+            cu.sp_msg('===== Skipping {path}: cached pass'.format(path=path))
+            return [
+                StepResult(step=step, status=STATUS_CACHED,
+                           duration=duration, excerpt='')
+                for (step, duration) in prev['steps']
+            ]
+
+        cu.sp_msg('\n===== Testing {path}\n'.format(path=path))
+        with ctiming.element(os.path.basename(path)):
+            results = test_element(cfg, full)
+        with lock:
+            if key is not None and \
+                    all(res.status == STATUS_PASSED for res in results):
+                new_state[path] = {
+                    'key': key,
+                    'steps': [[res.step, res.duration] for res in results],
+                }
+            else:
+                new_state.pop(path, None)
+        return results
+
+    if cfg.report_dir is not None:
+        cu.sp_makedirs(cfg, os.path.join(cfg.report_dir, 'logs'),
+                       exist_ok=True)
+    state_file = os.path.join(subdir, STATE_FILE)
+    state = read_state(state_file)
+    new_state = dict(state)
+    lock = threading.Lock()
+    all_results = dict(zip(paths, cu.sp_parallel(cfg, run_element, paths)))
+    if not cfg.noop:
+        write_state(state_file, new_state)
+    return all_results
+
+
+def failed_elements(results: Dict[str, List[StepResult]]) -> List[str]:
+    """ Return the elements that have any failed tests. """
+    return sorted(
+        path for path, steps in results.items()
+        if [res for res in steps if res.status == STATUS_FAILED])
+
+
+def format_matrix(results: Dict[str, List[StepResult]]) -> List[str]:
+    """
+    Format a table with a row for each element and a column for each
+    test, showing whether each test passed and how long it took.
+    """
+    columns = []  # type: List[str]
+    for steps in results.values():
+        for res in steps:
+            if res.step not in columns:
+                columns.append(res.step)
+    columns.sort()
+
+    def cell(res: StepResult) -> str:
+        """ Format a single test result. """
+        if res.status == STATUS_SKIPPED:
+            return 'skipped'
+        if res.status == STATUS_CACHED:
+            return 'cached'
+        return '{status} {duration:.1f}s'.format(
+            status='ok' if res.status == STATUS_PASSED else 'FAIL',
+            duration=res.duration)
+
+    rows = [['element'] + columns]
+    for path in sorted(results):
+        by_step = {res.step: res for res in results[path]}
+        rows.append([path] + [
+            cell(by_step[step]) if step in by_step else '-'
+            for step in columns
+        ])
+
+    widths = [max(len(row[idx]) for row in rows)
+              for idx in range(len(columns) + 1)]
+    return [
+        '  '.join(value.ljust(width)
+                  for (value, width) in zip(row, widths)).rstrip()
+        for row in rows
+    ]
+
+
+def run_duration(steps: List[StepResult]) -> float:
+    """
+    Return the time spent running the tests of an element, not counting
+    the ones that passed the last time and were not run again.
+    """
+    return float(sum(res.duration for res in steps
+                     if res.status != STATUS_CACHED))
+
+
+def result_dict(path: str, steps: List[StepResult]) -> Dict[str, Any]:
+    """ Summarize the test results of an element for the JSON report. """
+    return {
+        'element': path,
+        'status': STATUS_FAILED
+        if [res for res in steps if res.status == STATUS_FAILED]
+        else STATUS_PASSED,
+        'duration': run_duration(steps),
+        'steps': [dict(res._asdict()) for res in steps],
+    }
+
+
+def junit_xml(path: str, steps: List[StepResult]) -> ET.Element:
+    """ Build a JUnit XML test suite for the test results of an element. """
+    suite = ET.Element('testsuite', {
+        'name': path,
+        'tests': str(len(steps)),
+        'failures': str(len([res for res in steps
+                             if res.status == STATUS_FAILED])),
+        'skipped': str(len([res for res in steps
+                            if res.status == STATUS_SKIPPED])),
+        'time': '{t:.3f}'.format(t=run_duration(steps)),
+    })
+    for res in steps:
+        case = ET.SubElement(suite, 'testcase', {
+            'classname': path.replace('/', '.'),
+            'name': res.step,
+            'time': '{t:.3f}'.format(t=run_duration([res])),
+        })
+        if res.status == STATUS_FAILED:
+            failure = ET.SubElement(case, 'failure', {
+                'message': 'the {step} tests failed'.format(step=res.step),
+            })
+            failure.text = res.excerpt
+        elif res.status == STATUS_SKIPPED:
+            ET.SubElement(case, 'skipped', {
+                'message': 'an earlier test failed',
+            })
+        elif res.status == STATUS_CACHED:
+            out = ET.SubElement(case, 'system-out')
+            out.text = 'cached pass, {t:.3f}s the last time'.format(
+                t=res.duration)
+    return suite
+
+
+def write_reports(cfg: cconfig.Config,
+                  results: Dict[str, List[StepResult]]) -> None:
+    """
+    Write a JUnit XML and a JSON report for each element into
+    the report directory, along with a JSON summary of all of them.
+    """
+    if cfg.report_dir is None or cfg.noop:
+        return
+
+    summary = []  # type: List[Dict[str, Any]]
+    for path in sorted(results):
+        base = os.path.join(cfg.report_dir, os.path.basename(path))
+        data = result_dict(path, results[path])
+        summary.append(data)
+        with open(base + '.json', mode='w') as f:
+            json.dump(data, f, sort_keys=True, indent=2)
+        ET.ElementTree(junit_xml(path, results[path])) \
+            .write(base + '.xml', encoding='UTF-8', xml_declaration=True)
+
+    with open(os.path.join(cfg.report_dir, 'summary.json'), mode='w') as f:
+        json.dump({
+            'elements': summary,
+            'failed': failed_elements(results),
+        }, f, sort_keys=True, indent=2)
@@ -0,0 +1,154 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Record how long the various stages of a spcharms run take.
+"""
+
+
+import collections
+import contextlib
+import json
+import threading
+import time
+
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+
+STAGE_COMMAND = 'command'
+STAGE_ELEMENT = 'element'
+STAGE_RUN = 'run'
+
+
+Span = collections.namedtuple('Span', [
+    'stage',
+    'name',
+    'element',
+    'start',
+    'duration',
+])
+
+
+class Timings(object):
+    """
+    Collect the durations of the stages of a run, each one attributed
+    to the charm, layer, or interface being processed at the time by
+    the same thread, if any.
+    """
+
+    def __init__(self) -> None:
+        """ Start with no spans recorded. """
+        self._lock = threading.Lock()
+        self._spans = []  # type: List[Span]
+        self._local = threading.local()
+        self._origin = time.monotonic()
+
+    def current_element(self) -> Optional[str]:
+        """ Return the element being processed by the current thread. """
+        stack = getattr(self._local, 'elements', [])  # type: List[str]
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def span(self, stage: str, name: str) -> Iterator[None]:
+        """ Record the duration of the enclosed block. """
+        element = self.current_element()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            with self._lock:
+                self._spans.append(Span(stage=stage, name=name,
+                                        element=element,
+                                        start=start - self._origin,
+                                        duration=duration))
+
+    @contextlib.contextmanager
+    def element(self, name: str) -> Iterator[None]:
+        """
+        Record the time spent processing an element, and attribute
+        the spans within the enclosed block to it.
+        """
+        if not hasattr(self._local, 'elements'):
+            self._local.elements = []
+        self._local.elements.append(name)
+        try:
+            with self.span(STAGE_ELEMENT, name):
+                yield
+        finally:
+            self._local.elements.pop()
+
+    @property
+    def spans(self) -> List[Span]:
+        """ Return the spans recorded so far. """
+        with self._lock:
+            return list(self._spans)
+
+    def reset(self) -> None:
+        """ Forget all the spans recorded so far. """
+        with self._lock:
+            self._spans = []
+            self._origin = time.monotonic()
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Summarize the recorded spans by stage and by element.
+        Nested spans are counted in the totals of each of their stages.
+        """
+        spans = self.spans
+        stages = {}  # type: Dict[str, Dict[str, Any]]
+        elements = {}  # type: Dict[str, Dict[str, Any]]
+        for span in spans:
+            st_data = stages.setdefault(span.stage,
+                                        {'count': 0, 'total': 0.0})
+            st_data['count'] += 1
+            st_data['total'] += span.duration
+
+            if span.element is None:
+                continue
+            el_data = elements.setdefault(span.element, {})
+            el_data[span.stage] = el_data.get(span.stage, 0.0) + \
+                span.duration
+
+        return {
+            'stages': stages,
+            'elements': elements,
+            'spans': [dict(span._asdict()) for span in spans],
+        }
+
+    def write_report(self, fname: str) -> None:
+        """ Store the summarized spans into a JSON file. """
+        with open(fname, mode='w') as f:
+            json.dump(self.report(), f, sort_keys=True, indent=2)
+
+    def slowest(self, count: int = 10) -> List[Span]:
+        """ Return the slowest steps, not counting the commands. """
+        return sorted((span for span in self.spans
+                       if span.stage != STAGE_COMMAND),
+                      key=lambda span: span.duration,
+                      reverse=True)[:count]
+
+
+TIMINGS = Timings()
+
+
+def span(stage: str, name: str) -> ContextManager[None]:
+    """ Record the duration of a block of code. """
+    return TIMINGS.span(stage, name)
+
+
+def element(name: str) -> ContextManager[None]:
+    """ Record the time spent processing an element. """
+    return TIMINGS.element(name)
@@ -20,13 +20,25 @@ Utility functions for the StorPool charms management library.
 from __future__ import print_function
 
 import abc
+import concurrent.futures
+import json
 import os
 import yaml
+import shutil
 import subprocess
+import threading
 
-from typing import Dict, List
+from typing import Any, Callable, Dict, List, Optional, Type, TypeVar
 
 from . import config as cconfig
+from . import timing as ctiming
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+_OUTPUT_LOCK = threading.Lock()
 
 
 class BranchesError(Exception, metaclass=abc.ABCMeta):
@@ -76,6 +88,7 @@ class BranchesReadError(BranchesError):
 class BranchesParseError(BranchesError):
     """ An error that occurred while parsing the branches file. """
 
+    @property
     def action(self) -> str:
         """This error occurred while parsing the branches file. """
         return 'parse'
@@ -84,16 +97,63 @@ class BranchesParseError(BranchesError):
 class BranchesValidateError(BranchesError):
     """ An error that occurred while parsing the branches file. """
 
+    @property
     def action(self) -> str:
         """This error occurred while parsing the branches file. """
         return 'validate'
 
 
+class LockError(BranchesError):
+    """ A base class for errors that may occur while handling a lock file. """
+
+    def __str__(self) -> str:
+        """ Provide a human-readable representation of an error. """
+        return 'Could not {act} the lock file {fname}: {err}' \
+               .format(act=self.action, fname=self.fname, err=self.error)
+
+
+class LockReadError(LockError):
+    """ An error that occurred while reading the lock file. """
+
+    @property
+    def action(self) -> str:
+        """ This error occurred while reading the lock file. """
+        return 'read'
+
+
+class LockParseError(LockError):
+    """ An error that occurred while parsing the lock file. """
+
+    @property
+    def action(self) -> str:
+        """ This error occurred while parsing the lock file. """
+        return 'parse'
+
+
+class LockValidateError(LockError):
+    """ An error that occurred while validating the lock file. """
+
+    @property
+    def action(self) -> str:
+        """ This error occurred while validating the lock file. """
+        return 'validate'
+
+
+class LockWriteError(LockError):
+    """ An error that occurred while writing the lock file. """
+
+    @property
+    def action(self) -> str:
+        """ This error occurred while writing the lock file. """
+        return 'write'
+
+
 def sp_msg(text: str) -> None:
     """
     Output a message.
     """
-    print(text)
+    with _OUTPUT_LOCK:
+        print(text)
 
 
 def sp_chdir(cfg: cconfig.Config, dirname: str,
@@ -128,56 +188,250 @@ def sp_makedirs(cfg: cconfig.Config, dirname: str, mode: int = 0o777,
                .format(dirname=dirname, mode=mode, exist_ok=exist_ok))
         return
 
-    # *Sigh* Python 2 does not have exist_ok, does it now...
-    if exist_ok and os.path.isdir(dirname):
+    os.makedirs(dirname, mode=mode, exist_ok=exist_ok)
+
+
+def sp_replace_dir(cfg: cconfig.Config, src: str, dst: str) -> None:
+    """
+    Move the src directory into the place of the dst one, removing
+    the old dst directory if it exists; the two renames keep the time
+    when there is nothing at dst as short as possible.
+    """
+    if cfg.noop:
+        sp_msg("# mv -T -- '{src}' '{dst}'".format(src=src, dst=dst))
+        return
+
+    old = None  # type: Optional[str]
+    if os.path.lexists(dst):
+        old = '{dst}.old-{pid}-{tid}' \
+            .format(dst=dst, pid=os.getpid(), tid=threading.get_ident())
+        os.rename(dst, old)
+    os.rename(src, dst)
+    if old is not None:
+        if os.path.isdir(old) and not os.path.islink(old):
+            shutil.rmtree(old)
+        else:
+            os.unlink(old)
+
+
+def sp_temp_name(fname: str) -> str:
+    """
+    Return the name of a temporary file or directory to create next to
+    the specified one, unique to the current process and thread.
+    """
+    return '{fname}.tmp-{pid}-{tid}' \
+        .format(fname=fname, pid=os.getpid(), tid=threading.get_ident())
+
+
+def sp_write_json(fname: str, data: Any, indent: int = 1) -> None:
+    """
+    Store data into a JSON file, making sure that readers never see
+    a partially written one, even if several processes or threads
+    write it at the same time.
+    """
+    tempf = sp_temp_name(fname)
+    try:
+        with open(tempf, mode='w') as f:
+            json.dump(data, f, sort_keys=True, indent=indent)
+        os.rename(tempf, fname)
+    except BaseException:
+        if os.path.exists(tempf):
+            os.unlink(tempf)
+        raise
+
+
+def sp_command(command: List[str], cwd: Optional[str] = None) -> str:
+    """
+    Return a human-readable representation of a command to run,
+    optionally in the specified directory.
+    """
+    if cwd is None:
+        return "# {command}".format(command=' '.join(command))
+    return "# cd -- '{cwd}' && {command}" \
+        .format(cwd=cwd, command=' '.join(command))
+
+
+def sp_run(cfg: cconfig.Config, command: List[str],
+           cwd: Optional[str] = None) -> None:
+    """
+    Run a command, optionally in the specified directory, unless
+    running in no-operation mode.
+    """
+    if cfg.noop:
+        sp_msg(sp_command(command, cwd))
         return
-    os.makedirs(dirname, mode=mode)
+
+    with ctiming.span(ctiming.STAGE_RUN, ' '.join(command)):
+        subprocess.check_call(command, cwd=cwd)
 
 
-def sp_run(cfg: cconfig.Config, command: List[str]) -> None:
+def sp_run_capture(cfg: cconfig.Config, command: List[str],
+                   prefix: str, cwd: Optional[str] = None,
+                   log_file: Optional[str] = None) -> None:
+    """
+    Run a command, capturing its output, then display the output with
+    each line prefixed by the specified string, so that the output of
+    commands running in parallel is not mixed up.
+    If a log file is specified, also store the full output there.
+    Raise subprocess.CalledProcessError if the command fails.
+    """
     if cfg.noop:
-        sp_msg("# {command}".format(command=' '.join(command)))
+        sp_msg(sp_command(command, cwd))
         return
 
-    subprocess.check_call(command)
+    with ctiming.span(ctiming.STAGE_RUN, ' '.join(command)):
+        res = subprocess.run(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, cwd=cwd)
+    output = res.stdout.decode('UTF-8', errors='replace')
+    if log_file is not None:
+        with open(log_file, mode='w') as f:
+            print(sp_command(command, cwd), file=f)
+            f.write(output)
+    sp_msg_prefixed(prefix, output)
+    res.check_returncode()
 
 
-def parse_branches_file(cfg: cconfig.Config) -> Dict[str, str]:
-    """ Parse the file containing the list of branches. """
-    if cfg.branches_file is None:
-        cfg.set_branches({})
-        return cfg.branches
+def sp_msg_prefixed(prefix: str, output: str) -> None:
+    """ Output the non-empty lines of a command's output, prefixed. """
+    lines = [line for line in output.split('\n') if line.strip()]
+    if lines:
+        sp_msg('\n'.join('[{prefix}] {line}'.format(prefix=prefix, line=line)
+                         for line in lines))
 
-    fn = cfg.branches_file  # type: str
-    sp_msg('Loading branches information from {fn}'.format(fn=fn))
+
+def sp_run_output(cfg: cconfig.Config, command: List[str],
+                  prefix: str, cwd: Optional[str] = None) -> Optional[str]:
+    """
+    Run a command that only examines things and return its standard
+    output; display its error output with each line prefixed by
+    the specified string, like sp_run_capture() does.
+    In no-operation mode, only display the command and return None.
+    Raise subprocess.CalledProcessError if the command fails.
+    """
+    if cfg.noop:
+        sp_msg(sp_command(command, cwd))
+        return None
+
+    with ctiming.span(ctiming.STAGE_RUN, ' '.join(command)):
+        res = subprocess.run(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, cwd=cwd)
+    sp_msg_prefixed(prefix, res.stderr.decode('UTF-8', errors='replace'))
+    res.check_returncode()
+    return res.stdout.decode('UTF-8', errors='replace')
+
+
+def sp_parallel(cfg: cconfig.Config,
+                func: Callable[[T], R],
+                items: List[T]) -> List[R]:
+    """
+    Invoke the function for each of the items, running up to cfg.jobs
+    invocations at a time, and return the results in the items' order.
+    In no-operation mode, or if only a single job is allowed, simply
+    invoke the function for each item in turn so that the output is
+    displayed in a predictable order.
+    """
+    if cfg.noop or cfg.jobs < 2 or len(items) < 2:
+        return [func(item) for item in items]
+
+    workers = min(cfg.jobs, len(items))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
+
+
+def load_string_dicts(fname: str,
+                      keys: List[str],
+                      read_error: Type[BranchesError],
+                      parse_error: Type[BranchesError],
+                      validate_error: Type[BranchesError]
+                      ) -> Dict[str, Dict[str, str]]:
+    """
+    Load a YAML file containing one or more string:string dictionaries
+    with the specified names.
+    """
     try:
-        contents = open(fn, mode='r').read()
+        contents = open(fname, mode='r').read()
     except Exception as err:
-        raise BranchesReadError(fname=fn, error=err)
+        raise read_error(fname=fname, error=err)
 
     try:
-        data = yaml.load(contents)  # type: Dict[str, str]
+        data = yaml.safe_load(contents)
     except Exception as err:
-        raise BranchesParseError(fname=fn, error=err)
+        raise parse_error(fname=fname, error=err)
 
     if not isinstance(data, dict):
-        raise BranchesValidateError(
-            fname=fn,
+        raise validate_error(
+            fname=fname,
             error=AttributeError('not a dictionary'))
-    if 'branches' not in data:
-        raise BranchesValidateError(
-            fname=fn,
-            error=AttributeError('no "branches" element'))
-    if not isinstance(data['branches'], dict):
-        raise BranchesValidateError(
-            fname=fn,
-            error=AttributeError('"branches" not a dictionary'))
-    bad = [val for val in data['branches'].items()
-           if not (isinstance(val[0], str) and isinstance(val[1], str))]
-    if bad:
-        raise BranchesValidateError(
-            fname=fn,
-            error=AttributeError('"branches" not a string:string dictionary'))
 
+    res = {}  # type: Dict[str, Dict[str, str]]
+    for key in keys:
+        if key not in data:
+            raise validate_error(
+                fname=fname,
+                error=AttributeError('no "{key}" element'.format(key=key)))
+        if not isinstance(data[key], dict):
+            raise validate_error(
+                fname=fname,
+                error=AttributeError('"{key}" not a dictionary'
+                                     .format(key=key)))
+        bad = [val for val in data[key].items()
+               if not (isinstance(val[0], str) and isinstance(val[1], str))]
+        if bad:
+            raise validate_error(
+                fname=fname,
+                error=AttributeError('"{key}" not a string:string dictionary'
+                                     .format(key=key)))
+        res[key] = data[key]
+
+    return res
+
+
+def parse_branches_file(cfg: cconfig.Config) -> Dict[str, str]:
+    """ Parse the file containing the list of branches. """
+    if cfg.branches_file is None:
+        cfg.set_branches({})
+        return cfg.branches
+
+    fn = cfg.branches_file  # type: str
+    sp_msg('Loading branches information from {fn}'.format(fn=fn))
+    data = load_string_dicts(fn, ['branches'], BranchesReadError,
+                             BranchesParseError, BranchesValidateError)
     cfg.set_branches(data['branches'])
     return cfg.branches
+
+
+def parse_lock_file(cfg: cconfig.Config) -> Dict[str, str]:
+    """
+    Parse the lock file listing the branches and the commits that
+    were checked out.
+    """
+    fn = cfg.lock_file
+    sp_msg('Loading the list of commits to check out from {fn}'
+           .format(fn=fn))
+    data = load_string_dicts(fn, ['branches', 'commits'], LockReadError,
+                             LockParseError, LockValidateError)
+    cfg.set_branches(data['branches'])
+    cfg.set_commits(data['commits'])
+    return cfg.commits
+
+
+def write_lock_file(cfg: cconfig.Config,
+                    branches: Dict[str, str],
+                    commits: Dict[str, str]) -> None:
+    """
+    Record the branches and the commits that were checked out, so that
+    the same tree may later be recreated using the "--locked" option.
+    """
+    fn = cfg.lock_file
+    if cfg.noop:
+        sp_msg('(would write the list of checked out commits to {fn})'
+               .format(fn=fn))
+        return
+
+    sp_msg('Writing the list of checked out commits to {fn}'.format(fn=fn))
+    try:
+        with open(fn, mode='w') as f:
+            yaml.safe_dump({'branches': branches, 'commits': commits}, f,
+                           default_flow_style=False)
+    except Exception as err:
+        raise LockWriteError(fname=fn, error=err)
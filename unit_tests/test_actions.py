@@ -138,7 +138,8 @@ class ActionTest:
         print_called = mock_print.call_count
         self.action.run()
         self.testcase.assertEqual(mock_call.call_count, call_called + 1)
-        mock_call.assert_called_with(self.data['command'], shell=False)
+        mock_call.assert_called_with(self.data['command'], shell=False,
+                                     timeout=self.cfg.juju_timeout)
         self.testcase.assertEqual(mock_print.call_count, print_called)
 
 
@@ -0,0 +1,131 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unit tests for the storpool.charms.manage.archive module.
+"""
+
+
+import json
+import os
+import tempfile
+import unittest
+import zipfile
+
+from storpool.charms.manage import archive as carchive
+from storpool.charms.manage import buildcache as cbuildcache
+from storpool.charms.manage import charm as ccharm
+from storpool.charms.manage import config as cconfig
+
+
+def write_tree(top: str, stamp: int) -> None:
+    """ Create a built charm tree with the specified timestamps. """
+    for (relpath, contents) in (('metadata.yaml', 'name: block\n'),
+                                ('hooks/install', '#!/bin/sh\n'),
+                                ('wheelhouse/a-1.0.whl', 'wheel')):
+        fname = os.path.join(top, relpath)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname, mode='w') as f:
+            f.write(contents)
+        os.utime(fname, (stamp, stamp))
+    os.chmod(os.path.join(top, 'hooks/install'), 0o755)
+
+
+class TestArchive(unittest.TestCase):
+    """ Test packing the built charms. """
+
+    def test_create(self) -> None:
+        """ The archives do not depend on the file timestamps. """
+        cfg = cconfig.Config()
+        with tempfile.TemporaryDirectory() as tempd:
+            archives = []
+            for stamp in (1000000000, 1500000000):
+                top = '{d}/{s}/xenial/block'.format(d=tempd, s=stamp)
+                write_tree(top, stamp)
+                archive = '{d}/{s}/block.charm'.format(d=tempd, s=stamp)
+                manifest = '{d}/{s}/block.manifest.json' \
+                    .format(d=tempd, s=stamp)
+                carchive.create_archive(cfg, top, archive, manifest)
+                archives.append(archive)
+
+                with open(manifest, mode='r') as f:
+                    data = json.load(f)
+                self.assertEqual(data['archive'], 'block.charm')
+                self.assertEqual(data['files'], 3)
+                self.assertEqual(data['sha256'],
+                                 cbuildcache.file_hash(archive))
+                self.assertEqual(data['tree'], cbuildcache.tree_hash(top))
+
+            with open(archives[0], mode='rb') as f:
+                first = f.read()
+            with open(archives[1], mode='rb') as f:
+                self.assertEqual(f.read(), first)
+
+            with zipfile.ZipFile(archives[0], mode='r') as zf:
+                self.assertEqual(zf.namelist(), [
+                    'metadata.yaml', 'hooks/install', 'wheelhouse/a-1.0.whl',
+                ])
+                self.assertEqual(
+                    zf.getinfo('hooks/install').external_attr >> 16,
+                    0o100755)
+                self.assertEqual(zf.read('wheelhouse/a-1.0.whl'), b'wheel')
+
+    def test_symlinks(self) -> None:
+        """ Store the symlinks as such, never follow them. """
+        cfg = cconfig.Config()
+        with tempfile.TemporaryDirectory() as tempd:
+            top = tempd + '/xenial/block'
+            write_tree(top, 1000000000)
+            os.makedirs(tempd + '/outside')
+            with open(tempd + '/outside/secret', mode='w') as f:
+                f.write('secret')
+            os.symlink('../../outside/secret', top + '/hooks/secret')
+            os.symlink(tempd + '/outside', top + '/outside')
+            os.symlink('..', top + '/hooks/loop')
+            os.symlink('install', top + '/hooks/start')
+
+            archive = tempd + '/block.charm'
+            carchive.create_archive(cfg, top, archive,
+                                    tempd + '/block.manifest.json')
+            with zipfile.ZipFile(archive, mode='r') as zf:
+                self.assertEqual(zf.namelist(), [
+                    'metadata.yaml', 'outside', 'hooks/install',
+                    'hooks/loop', 'hooks/secret', 'hooks/start',
+                    'wheelhouse/a-1.0.whl',
+                ])
+                for (name, target) in (('outside', tempd + '/outside'),
+                                       ('hooks/loop', '..'),
+                                       ('hooks/secret',
+                                        '../../outside/secret'),
+                                       ('hooks/start', 'install')):
+                    self.assertEqual(zf.getinfo(name).external_attr >> 16,
+                                     0o120777)
+                    self.assertEqual(zf.read(name), target.encode('UTF-8'))
+
+    def test_deploy_path(self) -> None:
+        """ Deploy the archive if there is one. """
+        with tempfile.TemporaryDirectory() as tempd:
+            self.assertEqual(
+                ccharm.charm_deploy_path(tempd, 'block', 'xenial'),
+                ccharm.charm_deploy_dir(tempd, 'block', 'xenial'))
+
+            archive = ccharm.charm_archive(tempd, 'block', 'xenial')
+            self.assertEqual(archive,
+                             tempd + '/built/xenial/block/block.charm')
+            os.makedirs(os.path.dirname(archive))
+            with open(archive, mode='w') as f:
+                f.write('PK')
+            self.assertEqual(
+                ccharm.charm_deploy_path(tempd, 'block', 'xenial'), archive)
@@ -0,0 +1,255 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unit tests for the storpool.charms.manage.buildcache module.
+"""
+
+
+import os
+import tempfile
+import unittest
+
+from typing import List
+
+import mock
+
+from storpool.charms.manage import buildcache as cbuildcache
+from storpool.charms.manage import config as cconfig
+
+
+def write_file(fname: str, contents: str) -> None:
+    """ Create a file with the specified contents. """
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, mode='w') as f:
+        f.write(contents)
+
+
+class TestBuildCache(unittest.TestCase):
+    """ Test the cache of built charms. """
+
+    def test_tree_hash(self) -> None:
+        """ Only the relevant changes affect the hash of a tree. """
+        with tempfile.TemporaryDirectory() as tempd:
+            self.assertEqual(cbuildcache.tree_hash(tempd + '/none'),
+                             'missing')
+
+            write_file(tempd + '/layer.yaml', 'includes: []\n')
+            write_file(tempd + '/reactive/layer.py', 'pass\n')
+            first = cbuildcache.tree_hash(tempd)
+            self.assertEqual(cbuildcache.tree_hash(tempd), first)
+
+            write_file(tempd + '/.git/HEAD', 'ref: refs/heads/master\n')
+            write_file(tempd + '/.tox/py3/log', 'log\n')
+            write_file(tempd + '/reactive/__pycache__/layer.pyc', 'x')
+            self.assertEqual(cbuildcache.tree_hash(tempd), first)
+
+            os.chmod(tempd + '/reactive/layer.py', 0o755)
+            second = cbuildcache.tree_hash(tempd)
+            self.assertNotEqual(second, first)
+
+            write_file(tempd + '/reactive/layer.py', 'pass  \n')
+            self.assertNotEqual(cbuildcache.tree_hash(tempd), second)
+
+    def test_build_key(self) -> None:
+        """ All the inputs affect the build key. """
+        ext = ['layer:basic']
+        key = cbuildcache.build_key({'a': '1', 'b': '2'}, ext, 'xenial', 'v1')
+        self.assertEqual(
+            cbuildcache.build_key({'b': '2', 'a': '1'}, ext, 'xenial', 'v1'),
+            key)
+        for other in (cbuildcache.build_key({'a': '1'}, ext, 'xenial', 'v1'),
+                      cbuildcache.build_key({'a': '1', 'b': '3'}, ext,
+                                            'xenial', 'v1'),
+                      cbuildcache.build_key({'a': '1', 'b': '2'}, [],
+                                            'xenial', 'v1'),
+                      cbuildcache.build_key({'a': '1', 'b': '2'},
+                                            ext + ['layer:openstack'],
+                                            'xenial', 'v1'),
+                      cbuildcache.build_key({'a': '1', 'b': '2'}, ext,
+                                            'bionic', 'v1'),
+                      cbuildcache.build_key({'a': '1', 'b': '2'}, ext,
+                                            'xenial', 'v2')):
+            self.assertNotEqual(other, key)
+
+    def test_store_restore(self) -> None:
+        """ Store a build in the cache and restore it. """
+        with tempfile.TemporaryDirectory() as tempd:
+            cfg = cconfig.Config(cache_dir=tempd + '/cache')
+            build_dir = tempd + '/built/xenial/block'
+            write_file(build_dir + '/xenial/block/metadata.yaml', 'name: x\n')
+
+            self.assertIsNone(cbuildcache.lookup(cfg, 'key'))
+            cbuildcache.store(cfg, 'key', build_dir)
+            cbuildcache.store(cfg, 'key', build_dir)
+            cached = cbuildcache.lookup(cfg, 'key')
+            self.assertEqual(cached, tempd + '/cache/builds/key')
+            self.assertEqual(os.listdir(tempd + '/cache/builds'), ['key'])
+
+            restored = tempd + '/restored'
+            assert cached is not None
+            cbuildcache.restore(cfg, cached, restored)
+            self.assertEqual(cbuildcache.tree_hash(restored),
+                             cbuildcache.tree_hash(build_dir))
+
+            rebuild = cconfig.Config(cache_dir=tempd + '/cache', rebuild=True)
+            self.assertIsNone(cbuildcache.lookup(rebuild, 'key'))
+            # The file is hardlinked into the cache, do not modify it.
+            os.unlink(build_dir + '/xenial/block/metadata.yaml')
+            write_file(build_dir + '/xenial/block/metadata.yaml', 'name: y\n')
+            cbuildcache.store(cfg, 'key', build_dir)
+            self.assertNotEqual(cbuildcache.tree_hash(cached),
+                                cbuildcache.tree_hash(build_dir))
+            cbuildcache.store(rebuild, 'key', build_dir)
+            self.assertEqual(cbuildcache.tree_hash(cached),
+                             cbuildcache.tree_hash(build_dir))
+            self.assertEqual(os.listdir(tempd + '/cache/builds'), ['key'])
+
+            cfg = cconfig.Config()
+            self.assertIsNone(cbuildcache.lookup(cfg, 'key'))
+
+    def test_parse_size(self) -> None:
+        """ Parse size specifications. """
+        self.assertEqual(cbuildcache.parse_size('1000'), 1000)
+        self.assertEqual(cbuildcache.parse_size('2k'), 2048)
+        self.assertEqual(cbuildcache.parse_size('512M'), 512 << 20)
+        self.assertEqual(cbuildcache.parse_size(' 10GiB '), 10 << 30)
+        self.assertEqual(cbuildcache.parse_size('1T'), 1 << 40)
+        self.assertRaises(ValueError, cbuildcache.parse_size, '')
+        self.assertRaises(ValueError, cbuildcache.parse_size, '10X')
+        self.assertRaises(ValueError, cbuildcache.parse_size, '-1')
+
+    def test_wheels(self) -> None:
+        """ Share the pip cache and collect the wheels. """
+        self.assertEqual(cbuildcache.build_env(cconfig.Config()), [])
+        with tempfile.TemporaryDirectory() as tempd:
+            cfg = cconfig.Config(cache_dir=tempd + '/cache')
+            self.assertEqual(cbuildcache.build_env(cfg), [
+                'PIP_CACHE_DIR={d}/cache/pip'.format(d=tempd),
+                'PIP_FIND_LINKS={d}/cache/wheelhouse'.format(d=tempd),
+            ])
+            cbuildcache.prepare_pip_cache(cfg)
+
+            build_dir = tempd + '/built/xenial/block'
+            write_file(build_dir + '/xenial/block/wheelhouse/a-1.0.whl', 'a')
+            write_file(build_dir + '/xenial/block/wheelhouse/b-2.tar.gz', 'b')
+            write_file(build_dir + '/xenial/block/metadata.yaml', 'x')
+            cbuildcache.collect_wheels(cfg, build_dir)
+            cbuildcache.collect_wheels(cfg, build_dir)
+            self.assertEqual(sorted(os.listdir(tempd + '/cache/wheelhouse')),
+                             ['a-1.0.whl', 'b-2.tar.gz'])
+
+    def test_prune(self) -> None:
+        """ Remove the least recently used entries. """
+        with tempfile.TemporaryDirectory() as tempd:
+            cache = tempd + '/cache'
+            write_file(cache + '/builds/old/charm/metadata.yaml', 'o' * 100)
+            write_file(cache + '/builds/new/charm/metadata.yaml', 'n' * 100)
+            write_file(cache + '/pip/http/a/b/c', 'p' * 100)
+            write_file(cache + '/wheelhouse/a-1.0.whl', 'w' * 100)
+            write_file(cache + '/mirrors/x.git/HEAD', 'm' * 1000)
+            for (path, stamp) in (('/builds/old', 1000),
+                                  ('/pip/http/a/b/c', 2000),
+                                  ('/wheelhouse/a-1.0.whl', 3000),
+                                  ('/builds/new', 4000)):
+                os.utime(cache + path, (stamp, stamp))
+
+            cfg = cconfig.Config(cache_dir=cache, max_cache_size=250,
+                                 noop=True)
+            cbuildcache.prune(cfg)
+            self.assertTrue(os.path.isdir(cache + '/builds/old'))
+
+            cfg = cconfig.Config(cache_dir=cache, max_cache_size=250)
+            cbuildcache.prune(cfg)
+            self.assertFalse(os.path.exists(cache + '/builds/old'))
+            self.assertFalse(os.path.exists(cache + '/pip/http/a/b/c'))
+            self.assertTrue(os.path.isfile(cache + '/wheelhouse/a-1.0.whl'))
+            self.assertTrue(os.path.isdir(cache + '/builds/new'))
+            self.assertTrue(os.path.isfile(cache + '/mirrors/x.git/HEAD'))
+
+    def test_dedup(self) -> None:
+        """ Replace identical files with hardlinks. """
+        with tempfile.TemporaryDirectory() as tempd:
+            for series in ('xenial', 'bionic'):
+                for name in ('block', 'cinder'):
+                    top = '{d}/{s}/{n}'.format(d=tempd, s=series, n=name)
+                    write_file(top + '/wheelhouse/a-1.0.whl', 'wheel' * 10)
+                    write_file(top + '/metadata.yaml', 'name: ' + name)
+                    write_file(top + '/hooks/install', 'hook' * 5)
+                    write_file(top + '/empty', '')
+            os.chmod(tempd + '/xenial/block/hooks/install', 0o755)
+            dirs = [tempd + '/xenial/block', tempd + '/xenial/cinder',
+                    tempd + '/bionic/block', tempd + '/bionic/cinder']
+
+            cfg = cconfig.Config(noop=True)
+            self.assertEqual(cbuildcache.dedup(cfg, dirs), (0, 0))
+
+            cfg = cconfig.Config()
+            self.assertEqual(cbuildcache.dedup(cfg, dirs),
+                             (3 + 2 + 2, 3 * 50 + 11 + 12 + 2 * 20))
+            self.assertEqual(cbuildcache.dedup(cfg, dirs), (0, 0))
+
+            def nlink(path: str) -> int:
+                """ Return the number of hardlinks to a file. """
+                return os.stat(tempd + path).st_nlink
+
+            self.assertEqual(nlink('/bionic/cinder/wheelhouse/a-1.0.whl'), 4)
+            self.assertEqual(nlink('/bionic/block/metadata.yaml'), 2)
+            self.assertEqual(nlink('/xenial/block/hooks/install'), 1)
+            self.assertEqual(nlink('/bionic/block/hooks/install'), 3)
+            self.assertEqual(nlink('/bionic/block/empty'), 1)
+
+            write_file(tempd + '/xenial/block/extra', 'extra' * 10)
+            write_file(tempd + '/bionic/block/extra', 'extra' * 10)
+            with mock.patch('os.rename', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    cbuildcache.dedup(cfg, dirs)
+            self.assertEqual(
+                sorted(name for name in os.listdir(tempd + '/bionic/block')
+                       if name.startswith('extra')), ['extra'])
+            self.assertEqual(nlink('/bionic/block/extra'), 1)
+            self.assertEqual(cbuildcache.dedup(cfg, dirs), (1, 50))
+
+    def test_dedup_cache(self) -> None:
+        """ Only free the space if the cache entries are relinked, too. """
+        with tempfile.TemporaryDirectory() as tempd:
+            cfg = cconfig.Config(cache_dir=tempd + '/cache')
+            dirs = []
+            for series in ('xenial', 'bionic'):
+                top = '{d}/built/{s}/block'.format(d=tempd, s=series)
+                write_file(top + '/wheelhouse/a-1.0.whl', 'wheel' * 10)
+                cbuildcache.store(cfg, series * 8, top)
+                dirs.append(top)
+            cached = [cbuildcache.lookup(cfg, series * 8)
+                      for series in ('xenial', 'bionic')]
+            cache_dirs = [path for path in cached if path is not None]
+            self.assertEqual(len(cache_dirs), 2)
+
+            def inodes() -> List[int]:
+                """ Return the inodes of all the copies of the wheel. """
+                return sorted(set(
+                    os.stat(top + '/wheelhouse/a-1.0.whl').st_ino
+                    for top in dirs + cache_dirs))
+
+            self.assertEqual(len(inodes()), 2)
+            self.assertEqual(cbuildcache.dedup(cfg, dirs + cache_dirs),
+                             (2, 50))
+            self.assertEqual(len(inodes()), 1)
+            self.assertEqual(cbuildcache.dedup(cfg, dirs + cache_dirs),
+                             (0, 0))
+
+            write_file(tempd + '/other/a-1.0.whl', 'wheel' * 10)
+            self.assertEqual(cbuildcache.dedup(cfg, dirs + [tempd + '/other']),
+                             (1, 50))
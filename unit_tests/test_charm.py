@@ -0,0 +1,353 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unit tests for the storpool.charms.manage.charm module.
+"""
+
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from typing import Dict, List, Optional, Tuple
+
+import mock
+
+from storpool.charms.manage import charm as ccharm
+from storpool.charms.manage import config as cconfig
+from storpool.charms.manage import graph as cgraph
+
+
+_TYPING_USED = (Dict, Optional, Tuple)
+
+
+TREE = {
+    'charms/charm-storpool-block': [
+        'layer:basic',
+        'layer:storpool-block',
+        'interface:storpool-presence',
+    ],
+    'charms/charm-cinder-storpool': [
+        'layer:openstack',
+        'layer:storpool-openstack-integration',
+        'interface:cinder-backend',
+    ],
+    'layers/layer-storpool-block': [
+        'layer:storpool-helper',
+        'interface:storpool-service',
+    ],
+    'layers/layer-storpool-openstack-integration': [
+        'layer:storpool-helper',
+    ],
+    'layers/layer-storpool-helper': None,
+    'interfaces/interface-storpool-presence': None,
+    'interfaces/interface-storpool-service': None,
+    'interfaces/interface-cinder-backend': None,
+}  # type: Dict[str, Optional[List[str]]]
+
+
+def create_tree(subdir: str) -> None:
+    """ Create a charms tree with some layer.yaml files. """
+    for path, includes in TREE.items():
+        dname = os.path.join(subdir, path)
+        os.makedirs(dname)
+        if includes is None:
+            continue
+        with open(os.path.join(dname, 'layer.yaml'), mode='w') as f:
+            print('includes:', file=f)
+            for inc in includes:
+                print('  - "{inc}"'.format(inc=inc), file=f)
+
+
+class TestRecurse(unittest.TestCase):
+    """ Test the traversal of the charms tree. """
+
+    def test_recurse(self) -> None:
+        """ Walk the tree without changing the current directory. """
+        cwd = os.getcwd()
+        cfg = cconfig.Config()
+        with tempfile.TemporaryDirectory() as subdir:
+            create_tree(subdir)
+
+            levels = []  # type: List[List[str]]
+            seen = []  # type: List[str]
+
+            def process_level(elements: List[ccharm.Element]) -> None:
+                """ Record the elements found at the same depth. """
+                levels.append(sorted(elem.fname for elem in elements))
+
+            def process_charm(elem: ccharm.Element,
+                              to_process: List[ccharm.Element]) -> None:
+                """ Examine a charm. """
+                self.assertTrue(elem.exists)
+                self.assertEqual(elem.path, ccharm.element_dir(subdir, elem))
+                ccharm.parse_layers(cfg, elem, to_process, True)
+                seen.append(os.path.relpath(elem.path, subdir))
+
+            def process_element(cfg: cconfig.Config,
+                                elem: ccharm.Element,
+                                to_process: List[ccharm.Element]) -> None:
+                """ Examine a layer or an interface. """
+                self.assertTrue(elem.exists)
+                self.assertEqual(elem.parent_dir,
+                                 os.path.dirname(elem.path))
+                ccharm.parse_layers(cfg, elem, to_process, False)
+                seen.append(os.path.relpath(elem.path, subdir))
+
+            ccharm.recurse(cfg, subdir,
+                           ['charm-storpool-block', 'charm-cinder-storpool'],
+                           process_charm, process_element, process_level)
+            self.assertEqual(os.getcwd(), cwd)
+
+        self.assertEqual(sorted(seen), sorted(TREE.keys()))
+        self.assertEqual(levels, [
+            ['charm-cinder-storpool', 'charm-storpool-block'],
+            ['interface-cinder-backend', 'interface-storpool-presence',
+             'layer-storpool-block', 'layer-storpool-openstack-integration'],
+            ['interface-storpool-service', 'layer-storpool-helper'],
+        ])
+
+    def test_missing_layer_yaml(self) -> None:
+        """ A charm must have a layer.yaml file. """
+        cfg = cconfig.Config()
+        with tempfile.TemporaryDirectory() as subdir:
+            elem = ccharm.charm_element(subdir, 'charm-storpool-block')
+            self.assertFalse(elem.exists)
+            self.assertRaises(ccharm.CharmError,
+                              ccharm.parse_layers, cfg, elem, [], True)
+
+            to_process = []  # type: List[ccharm.Element]
+            ccharm.parse_layers(cfg, elem, to_process, False)
+            self.assertEqual(to_process, [])
+
+    def test_load_graph(self) -> None:
+        """ Build the dependency graph and cache it in the charms tree. """
+        cfg = cconfig.Config()
+        with tempfile.TemporaryDirectory() as subdir:
+            create_tree(subdir)
+            graph = ccharm.load_graph(cfg, subdir, ['charm-storpool-block'])
+            self.assertTrue(os.path.isfile(
+                os.path.join(subdir, cgraph.CACHE_FILE)))
+
+            again = ccharm.load_graph(cfg, subdir, ['charm-storpool-block'])
+
+        for current in (graph, again):
+            self.assertEqual(current.edges['charm-storpool-block'], [
+                'layer-storpool-block',
+                'interface-storpool-presence',
+            ])
+            self.assertEqual(current.topological_order(), [
+                'interface-storpool-presence',
+                'interface-storpool-service',
+                'layer-storpool-helper',
+                'layer-storpool-block',
+                'charm-storpool-block',
+            ])
+            self.assertEqual(
+                current.nodes['layer-storpool-helper'].path,
+                os.path.join(subdir, 'layers/layer-storpool-helper'))
+
+
+class TestBuild(unittest.TestCase):
+    """ Test building the charms. """
+
+    @mock.patch('storpool.charms.manage.utils.sp_run')
+    @mock.patch('storpool.charms.manage.utils.sp_run_capture')
+    def test_build_parallel(self,
+                            sp_run_capture: mock.MagicMock,
+                            sp_run: mock.MagicMock) -> None:
+        """ Build the charms in parallel and collect the failures. """
+        def run_capture(cfg: cconfig.Config,
+                        command: List[str],
+                        prefix: str,
+                        cwd: str,
+                        log_file: str) -> None:
+            """ Check the build command, fail one of the builds. """
+            (name, series) = prefix.split('/')
+            self.assertEqual(series, 'xenial')
+            self.assertEqual(cwd, os.path.join(subdir, 'charms',
+                                               'charm-' + name))
+            self.assertTrue(command[-1].startswith(log_file[:-4] + '.tmp-'))
+            if name == 'cinder-storpool':
+                raise subprocess.CalledProcessError(2, command)
+
+        sp_run_capture.side_effect = run_capture
+        with tempfile.TemporaryDirectory() as basedir:
+            cfg = cconfig.Config(basedir=basedir, jobs=3)
+            subdir = os.path.join(basedir, cfg.subdir)
+            create_tree(subdir)
+            with self.assertRaises(ccharm.CharmError) as err:
+                ccharm.build_all(cfg, ['charm-storpool-block',
+                                       'charm-cinder-storpool'])
+
+        self.assertEqual(str(err.exception),
+                         'Could not build the charm-cinder-storpool charm '
+                         'for xenial')
+        self.assertEqual(sp_run_capture.call_count, 2)
+        self.assertEqual(sp_run.call_count, 3)
+
+    @mock.patch('storpool.charms.manage.buildcache.charm_tools_version',
+                new=lambda: 'charm-tools 2.4')
+    @mock.patch('storpool.charms.manage.utils.sp_run')
+    def test_build_cached(self, sp_run: mock.MagicMock) -> None:
+        """ Restore the charm from the build cache if nothing changed. """
+        def run(cfg: cconfig.Config,
+                command: List[str],
+                cwd: Optional[str] = None) -> None:
+            """ Pretend to remove the build directory and build the charm. """
+            if command[0] == 'rm':
+                shutil.rmtree(command[-1], ignore_errors=True)
+                return
+            dname = os.path.join(command[-1], 'xenial', 'storpool-block')
+            os.makedirs(dname)
+            with open(os.path.join(dname, 'metadata.yaml'), mode='w') as f:
+                print('name: storpool-block', file=f)
+
+        sp_run.side_effect = run
+        with tempfile.TemporaryDirectory() as basedir:
+            cfg = cconfig.Config(basedir=basedir,
+                                 cache_dir=os.path.join(basedir, 'cache'))
+            subdir = os.path.join(basedir, cfg.subdir)
+            create_tree(subdir)
+            build_dir = ccharm.charm_build_dir(subdir, 'storpool-block',
+                                               cfg.series)
+            metadata = os.path.join(build_dir, 'xenial', 'storpool-block',
+                                    'metadata.yaml')
+
+            ccharm.build_all(cfg, ['charm-storpool-block'])
+            self.assertEqual(sp_run.call_count, 2)
+            self.assertTrue(os.path.isfile(metadata))
+
+            sp_run.reset_mock()
+            shutil.rmtree(build_dir)
+            ccharm.build_all(cfg, ['charm-storpool-block'])
+            self.assertEqual(sp_run.call_count, 1)
+            self.assertTrue(os.path.isfile(metadata))
+
+            sp_run.reset_mock()
+            with open(os.path.join(subdir, 'interfaces',
+                                   'interface-storpool-service',
+                                   'provides.py'), mode='w') as f:
+                print('pass', file=f)
+            ccharm.build_all(cfg, ['charm-storpool-block'])
+            self.assertEqual(sp_run.call_count, 2)
+
+    @mock.patch('storpool.charms.manage.utils.sp_msg')
+    @mock.patch('storpool.charms.manage.utils.sp_run')
+    def test_build_changed(self,
+                           sp_run: mock.MagicMock,
+                           sp_msg: mock.MagicMock) -> None:
+        """ Only rebuild the charms that include a changed element. """
+        def run(cfg: cconfig.Config,
+                command: List[str],
+                cwd: Optional[str] = None) -> None:
+            """ Pretend to remove the build directory and build the charm. """
+            if command[0] == 'rm':
+                shutil.rmtree(command[-1], ignore_errors=True)
+                return
+            built.append(command[command.index('-n') + 1])
+
+        def messages() -> List[str]:
+            """ Return the messages about (not) rebuilding the charms. """
+            return sorted(call[0][0] for call in sp_msg.call_args_list
+                          if 'build' in call[0][0] and
+                          call[0][0].startswith(('Not ', 'Rebuilding ')))
+
+        charms = ['charm-storpool-block', 'charm-cinder-storpool']
+        built = []  # type: List[str]
+        sp_run.side_effect = run
+        with tempfile.TemporaryDirectory() as basedir:
+            cfg = cconfig.Config(basedir=basedir, changed=True)
+            subdir = os.path.join(basedir, cfg.subdir)
+            create_tree(subdir)
+
+            ccharm.build_all(cfg, charms)
+            self.assertEqual(sorted(built),
+                             ['cinder-storpool', 'storpool-block'])
+            self.assertEqual(messages(), [
+                'Rebuilding the charm-cinder-storpool charm for xenial: '
+                'it has not been built before',
+                'Rebuilding the charm-storpool-block charm for xenial: '
+                'it has not been built before',
+            ])
+
+            del built[:]
+            sp_msg.reset_mock()
+            ccharm.build_all(cfg, charms)
+            self.assertEqual(built, [])
+            self.assertEqual(messages(), [
+                'Not rebuilding the charm-cinder-storpool charm for xenial: '
+                'none of its 4 elements have changed',
+                'Not rebuilding the charm-storpool-block charm for xenial: '
+                'none of its 5 elements have changed',
+            ])
+
+            sp_msg.reset_mock()
+            with open(os.path.join(subdir, 'interfaces',
+                                   'interface-storpool-service',
+                                   'provides.py'), mode='w') as f:
+                print('pass', file=f)
+            ccharm.build_all(cfg, charms)
+            self.assertEqual(built, ['storpool-block'])
+            self.assertEqual(messages(), [
+                'Not rebuilding the charm-cinder-storpool charm for xenial: '
+                'none of its 4 elements have changed',
+                'Rebuilding the charm-storpool-block charm for xenial: '
+                'changed: interface-storpool-service',
+            ])
+
+    @mock.patch('storpool.charms.manage.utils.sp_run_capture')
+    @mock.patch('storpool.charms.manage.utils.sp_run')
+    def test_build_series(self,
+                          sp_run: mock.MagicMock,
+                          sp_run_capture: mock.MagicMock) -> None:
+        """ Build the charms for several series at once. """
+        built = []  # type: List[Tuple[str, str, str]]
+
+        def run_capture(cfg: cconfig.Config,
+                        command: List[str],
+                        prefix: str,
+                        cwd: str,
+                        log_file: str) -> None:
+            """ Record the charm builds. """
+            (build_dir, temp_suffix) = command[-1].rsplit('.tmp-', 1)
+            self.assertTrue(temp_suffix)
+            built.append((command[command.index('-n') + 1],
+                          command[command.index('-s') + 1],
+                          build_dir))
+
+        sp_run_capture.side_effect = run_capture
+        with tempfile.TemporaryDirectory() as basedir:
+            cfg = cconfig.Config(basedir=basedir, series='xenial, bionic',
+                                 jobs=4)
+            self.assertEqual(cfg.series_list, ['xenial', 'bionic'])
+            subdir = os.path.join(basedir, cfg.subdir)
+            create_tree(subdir)
+            ccharm.build_all(cfg, ['charm-storpool-block',
+                                   'charm-cinder-storpool'])
+
+            self.assertEqual(sorted(built), sorted([
+                (name, series,
+                 ccharm.charm_build_dir(subdir, name, series))
+                for name in ('storpool-block', 'cinder-storpool')
+                for series in ('xenial', 'bionic')
+            ]))
+            self.assertEqual(sp_run.call_count, 4)
+            for series in ('xenial', 'bionic'):
+                self.assertTrue(os.path.isfile(os.path.join(
+                    subdir, 'built', series, '.spcharms-built.json')))
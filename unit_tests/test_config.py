@@ -18,6 +18,8 @@ Unit tests for the storpool.charms.manage.config module.
 """
 
 
+import os
+import tempfile
 import unittest
 
 import mock
@@ -36,9 +38,28 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(cfg.subdir, cconfig.DEFAULT_SUBDIR)
         self.assertEqual(cfg.baseurl, cconfig.DEFAULT_BASEURL)
         self.assertIsNone(cfg.branches_file)
+        self.assertIsNone(cfg.cache_dir)
+        self.assertIsNone(cfg.mirror_dir)
+        self.assertIsNone(cfg.build_cache_dir)
+        self.assertIsNone(cfg.pip_cache_dir)
+        self.assertIsNone(cfg.wheelhouse_dir)
+        self.assertIsNone(cfg.tox_cache_dir)
 
         self.assertEqual(cfg.branches, {})
 
+        cfg = cconfig.Config(cache_dir='/var/cache/sp')
+        self.assertEqual(cfg.mirror_dir, '/var/cache/sp/mirrors')
+        self.assertEqual(cfg.build_cache_dir, '/var/cache/sp/builds')
+        self.assertEqual(cfg.pip_cache_dir, '/var/cache/sp/pip')
+        self.assertEqual(cfg.wheelhouse_dir, '/var/cache/sp/wheelhouse')
+        self.assertEqual(cfg.tox_cache_dir, '/var/cache/sp/tox')
+
+        with mock.patch('os.getcwd', return_value='/home/sp/charms'):
+            cfg = cconfig.Config(cache_dir='relcache')
+        self.assertEqual(cfg.cache_dir, '/home/sp/charms/relcache')
+        self.assertEqual(cfg.mirror_dir, '/home/sp/charms/relcache/mirrors')
+        self.assertEqual(cfg.tox_cache_dir, '/home/sp/charms/relcache/tox')
+
     def test_parse(self) -> None:
         """ Test parsing the branches file. """
         cfg = cconfig.Config(branches_file='branches.yaml')
@@ -87,3 +108,29 @@ branches:
                 'charm-storpool-block': 'assorted-fixes',
                 'layer-storpool-openstack-integration': 'devel',
             })
+
+    def test_lock_file(self) -> None:
+        """ Test writing and parsing the lock file. """
+        cfg = cconfig.Config(basedir='/base')
+        self.assertEqual(cfg.lock_file, '/base/storpool-charms-lock.yaml')
+        self.assertFalse(cfg.locked)
+        self.assertEqual(cfg.commits, {})
+
+        with tempfile.TemporaryDirectory() as tempd:
+            fname = os.path.join(tempd, 'lock.yaml')
+            cfg = cconfig.Config(lock_file=fname, locked=True)
+            self.assertRaises(cu.LockReadError, cu.parse_lock_file, cfg)
+
+            with mock.patch('storpool.charms.manage.utils.sp_msg'):
+                cu.write_lock_file(cfg, {'charm-storpool-block': 'devel'},
+                                   {'charm-storpool-block': '1' * 40})
+                self.assertEqual(cu.parse_lock_file(cfg), {
+                    'charm-storpool-block': '1' * 40,
+                })
+            self.assertEqual(cfg.branches, {'charm-storpool-block': 'devel'})
+
+            with open(fname, mode='w') as f:
+                print('branches: {}', file=f)
+            with mock.patch('storpool.charms.manage.utils.sp_msg'):
+                self.assertRaises(cu.LockValidateError,
+                                  cu.parse_lock_file, cfg)
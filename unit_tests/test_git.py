@@ -18,9 +18,12 @@ Unit tests for the storpool.charms.manage.git module.
 """
 
 
+import os
+import subprocess
+import tempfile
 import unittest
 
-from typing import Callable, List, Tuple
+from typing import Any, Callable, List, Tuple
 
 import mock
 
@@ -75,8 +78,8 @@ class Event(object):
 
 def append_event_fn(events: List[Event], name: str) -> Callable[..., None]:
     """ Return a function that will record its invocation. """
-    def _inner(*args: Tuple) -> None:
-        """ Record the function invocation. """
+    def _inner(*args: Tuple, **kwargs: Any) -> None:
+        """ Record the function invocation, ignoring keyword arguments. """
         events.append(Event(name=name, args=args))
 
     return _inner
@@ -126,3 +129,338 @@ class TestGit(unittest.TestCase):
             )),
         ])
         self.assertIsInstance(err.exception.error, IOError)
+
+    @mock.patch('storpool.charms.manage.git.cu')
+    def test_checkout_dirname(self, mod_utils: mock.MagicMock) -> None:
+        """ Check out into a specified directory, possibly in parallel. """
+        events = []  # type: List[Event]
+        add_events_scm_utils(mod_utils, events)
+        cfg = cconfig.Config(baseurl='.')
+        cgit.checkout(cfg, 'layer-storpool', '/sub/layers/layer-storpool')
+
+        self.assertEqual(events, [
+            Event(name='sp_msg', args=()),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', 'clone', '-b', 'master', '--',
+                 './layer-storpool.git', '/sub/layers/layer-storpool']
+            )),
+        ])
+
+        events.clear()
+        cfg = cconfig.Config(baseurl='.', jobs=4)
+        cgit.checkout(cfg, 'layer-storpool', '/sub/layers/layer-storpool')
+
+        self.assertEqual(events, [
+            Event(name='sp_msg', args=()),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', 'clone', '-q', '-b', 'master', '--',
+                 './layer-storpool.git', '/sub/layers/layer-storpool']
+            )),
+        ])
+
+    @mock.patch('os.path.isdir')
+    @mock.patch('storpool.charms.manage.git.cu')
+    def test_checkout_mirror(self,
+                             mod_utils: mock.MagicMock,
+                             isdir: mock.MagicMock) -> None:
+        """ Check out from a local mirror, creating it if needed. """
+        events = []  # type: List[Event]
+        add_events_scm_utils(mod_utils, events)
+        cfg = cconfig.Config(baseurl='http://repo', cache_dir='/cache')
+        isdir.return_value = False
+        cgit.checkout(cfg, 'charm-storpool-block')
+        isdir.assert_called_once_with(
+            '/cache/mirrors/charm-storpool-block.git')
+
+        self.assertEqual(events, [
+            Event(name='sp_msg', args=()),
+            Event(name='sp_makedirs', args=(cfg, '/cache/mirrors')),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', 'clone', '-q', '--mirror', '--',
+                 'http://repo/charm-storpool-block.git',
+                 '/cache/mirrors/charm-storpool-block.git']
+            )),
+            Event(name='sp_msg', args=()),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', 'clone', '-b', 'master', '--',
+                 '/cache/mirrors/charm-storpool-block.git']
+            )),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', '-C', 'charm-storpool-block', 'remote', 'set-url',
+                 'origin', 'http://repo/charm-storpool-block.git']
+            )),
+        ])
+
+        events.clear()
+        isdir.return_value = True
+        cgit.checkout(cfg, 'charm-storpool-block', '/sub/charm')
+
+        self.assertEqual(events, [
+            Event(name='sp_msg', args=()),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', '--git-dir',
+                 '/cache/mirrors/charm-storpool-block.git',
+                 'remote', 'set-url', 'origin',
+                 'http://repo/charm-storpool-block.git']
+            )),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', '--git-dir',
+                 '/cache/mirrors/charm-storpool-block.git',
+                 'fetch', '-q', '--prune', 'origin']
+            )),
+            Event(name='sp_msg', args=()),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', 'clone', '-b', 'master', '--',
+                 '/cache/mirrors/charm-storpool-block.git', '/sub/charm']
+            )),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', '-C', '/sub/charm', 'remote', 'set-url',
+                 'origin', 'http://repo/charm-storpool-block.git']
+            )),
+        ])
+
+    def test_read_refs(self) -> None:
+        """ Read the HEAD and some references from a .git/ directory. """
+        with tempfile.TemporaryDirectory() as tempd:
+            os.makedirs(tempd + '/.git/refs/heads')
+            with open(tempd + '/.git/HEAD', mode='w') as f:
+                print('ref: refs/heads/devel', file=f)
+            with open(tempd + '/.git/refs/heads/devel', mode='w') as f:
+                print('1' * 40, file=f)
+            with open(tempd + '/.git/packed-refs', mode='w') as f:
+                print('# pack-refs with: peeled fully-peeled sorted', file=f)
+                print('2' * 40 + ' refs/heads/devel', file=f)
+                print('3' * 40 + ' refs/remotes/origin/devel', file=f)
+
+            self.assertEqual(cgit.head_branch(tempd), 'devel')
+            self.assertEqual(cgit.read_ref(tempd, 'refs/heads/devel'),
+                             '1' * 40)
+            self.assertEqual(cgit.read_ref(tempd,
+                                           'refs/remotes/origin/devel'),
+                             '3' * 40)
+            self.assertIsNone(cgit.read_ref(tempd, 'refs/heads/master'))
+
+            with open(tempd + '/.git/HEAD', mode='w') as f:
+                print('4' * 40, file=f)
+            self.assertIsNone(cgit.head_branch(tempd))
+
+            self.assertRaises(cgit.RepoExamineError,
+                              cgit.head_branch, tempd + '/nonexistent')
+
+    @mock.patch('storpool.charms.manage.git.remote_commit')
+    @mock.patch('storpool.charms.manage.git.read_ref')
+    @mock.patch('storpool.charms.manage.git.head_branch')
+    @mock.patch('storpool.charms.manage.git.cu')
+    def test_reconcile(self,
+                       mod_utils: mock.MagicMock,
+                       head_branch: mock.MagicMock,
+                       read_ref: mock.MagicMock,
+                       remote_commit: mock.MagicMock) -> None:
+        """ Switch an existing checkout to another branch if needed. """
+        events = []  # type: List[Event]
+        add_events_scm_utils(mod_utils, events)
+        cfg = cconfig.Config(baseurl='http://repo')
+        cfg.set_branches({'layer-storpool': 'devel'})
+
+        head_branch.return_value = 'devel'
+        read_ref.return_value = '1' * 40
+        remote_commit.return_value = '1' * 40
+        self.assertFalse(cgit.reconcile(cfg, 'layer-storpool', '/sub/l'))
+        self.assertEqual(events, [Event(name='sp_msg', args=())])
+        remote_commit.assert_called_once_with(cfg, 'layer-storpool',
+                                              '/sub/l', 'devel')
+        read_ref.assert_called_once_with('/sub/l', 'refs/heads/devel')
+
+        events.clear()
+        remote_commit.return_value = '2' * 40
+        self.assertTrue(cgit.reconcile(cfg, 'layer-storpool', '/sub/l'))
+        self.assertEqual(events, [
+            Event(name='sp_msg', args=()),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', '-C', '/sub/l', 'fetch', '-q', 'origin',
+                 '+refs/heads/devel:refs/remotes/origin/devel']
+            )),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', '-C', '/sub/l', 'checkout', '-q', '-f',
+                 '-B', 'devel', '--track', 'refs/remotes/origin/devel']
+            )),
+        ])
+
+        remote_commit.return_value = None
+        self.assertRaises(cgit.RepoUpdateError,
+                          cgit.reconcile, cfg, 'layer-storpool', '/sub/l')
+
+        events.clear()
+        remote_commit.reset_mock()
+        head_branch.return_value = 'master'
+        self.assertTrue(cgit.reconcile(cfg, 'layer-storpool', '/sub/l'))
+        self.assertEqual(events, [
+            Event(name='sp_msg', args=()),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', '-C', '/sub/l', 'fetch', '-q', 'origin',
+                 '+refs/heads/devel:refs/remotes/origin/devel']
+            )),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', '-C', '/sub/l', 'checkout', '-q', '-f',
+                 '-B', 'devel', '--track', 'refs/remotes/origin/devel']
+            )),
+        ])
+        remote_commit.assert_not_called()
+
+    @mock.patch('storpool.charms.manage.utils.sp_run_output')
+    def test_remote_commit(self, sp_run_output: mock.MagicMock) -> None:
+        """ Parse the output of "git ls-remote". """
+        cfg = cconfig.Config()
+        sp_run_output.return_value = \
+            '{c}\trefs/heads/devel\n'.format(c='5' * 40)
+        self.assertEqual(cgit.remote_commit(cfg, 'layer-sp', '/sub/l',
+                                            'devel'),
+                         '5' * 40)
+        sp_run_output.assert_called_once_with(cfg, [
+            'git', '-C', '/sub/l', 'ls-remote', 'origin', 'refs/heads/devel',
+        ], prefix='layer-sp')
+
+        sp_run_output.return_value = ''
+        self.assertIsNone(cgit.remote_commit(cfg, 'layer-sp', '/sub/l',
+                                             'devel'))
+
+        sp_run_output.return_value = None
+        self.assertIsNone(cgit.remote_commit(cfg, 'layer-sp', '/sub/l',
+                                             'devel'))
+
+    @mock.patch('storpool.charms.manage.utils.sp_run_output')
+    def test_is_ancestor(self, sp_run_output: mock.MagicMock) -> None:
+        """ Only treat the "not an ancestor" exit code as an answer. """
+        cfg = cconfig.Config()
+        sp_run_output.return_value = ''
+        self.assertTrue(cgit.is_ancestor(cfg, 'layer-sp', '/sub/l',
+                                         'HEAD', 'origin/master'))
+
+        sp_run_output.side_effect = subprocess.CalledProcessError(1, 'git')
+        self.assertFalse(cgit.is_ancestor(cfg, 'layer-sp', '/sub/l',
+                                          'HEAD', 'origin/master'))
+
+        sp_run_output.side_effect = subprocess.CalledProcessError(128, 'git')
+        self.assertRaises(subprocess.CalledProcessError, cgit.is_ancestor,
+                          cfg, 'layer-sp', '/sub/l', 'HEAD', 'origin/master')
+
+    @mock.patch('storpool.charms.manage.git.is_ancestor')
+    @mock.patch('storpool.charms.manage.git.remote_commit')
+    @mock.patch('storpool.charms.manage.git.read_ref')
+    @mock.patch('storpool.charms.manage.git.head_branch')
+    @mock.patch('storpool.charms.manage.git.cu')
+    def test_pull(self,
+                  mod_utils: mock.MagicMock,
+                  head_branch: mock.MagicMock,
+                  read_ref: mock.MagicMock,
+                  remote_commit: mock.MagicMock,
+                  is_ancestor: mock.MagicMock) -> None:
+        """ Only fetch the repositories that have changed upstream. """
+        events = []  # type: List[Event]
+        for name in ('sp_msg', 'sp_run_capture'):
+            setattr(mod_utils, name, append_event_fn(events, name))
+        cfg = cconfig.Config()
+        head_branch.return_value = 'master'
+        read_ref.return_value = '1' * 40
+
+        remote_commit.return_value = '1' * 40
+        self.assertEqual(cgit.pull(cfg, 'layer-sp', '/sub/l'),
+                         cgit.PULL_UNCHANGED)
+        self.assertEqual(events, [])
+        remote_commit.assert_called_once_with(cfg, 'layer-sp', '/sub/l',
+                                              'master')
+
+        remote_commit.return_value = '2' * 40
+        is_ancestor.side_effect = [True]
+        self.assertEqual(cgit.pull(cfg, 'layer-sp', '/sub/l'),
+                         cgit.PULL_FORWARDED)
+        self.assertEqual(events, [
+            Event(name='sp_run_capture', args=(
+                cfg,
+                ['git', '-C', '/sub/l', 'fetch', '-q', 'origin',
+                 '+refs/heads/master:refs/remotes/origin/master'],
+            )),
+            Event(name='sp_run_capture', args=(
+                cfg,
+                ['git', '-C', '/sub/l', 'merge', '-q', '--ff-only',
+                 'refs/remotes/origin/master'],
+            )),
+        ])
+
+        events.clear()
+        is_ancestor.side_effect = [False, False]
+        self.assertEqual(cgit.pull(cfg, 'layer-sp', '/sub/l'),
+                         cgit.PULL_DIVERGED)
+        self.assertEqual(len(events), 1)
+
+        remote_commit.return_value = None
+        self.assertRaises(cgit.RepoUpdateError,
+                          cgit.pull, cfg, 'layer-sp', '/sub/l')
+
+        head_branch.return_value = None
+        self.assertRaises(cgit.RepoUpdateError,
+                          cgit.pull, cfg, 'layer-sp', '/sub/l')
+
+    @mock.patch('storpool.charms.manage.git.has_commit')
+    @mock.patch('storpool.charms.manage.git.read_ref')
+    @mock.patch('storpool.charms.manage.git.head_branch')
+    @mock.patch('storpool.charms.manage.git.cu')
+    def test_reconcile_locked(self,
+                              mod_utils: mock.MagicMock,
+                              head_branch: mock.MagicMock,
+                              read_ref: mock.MagicMock,
+                              has_commit: mock.MagicMock) -> None:
+        """ Reset an existing checkout to a locked commit if needed. """
+        events = []  # type: List[Event]
+        add_events_scm_utils(mod_utils, events)
+        cfg = cconfig.Config(baseurl='http://repo')
+        cfg.set_commits({'layer-storpool': '1' * 40})
+
+        head_branch.return_value = 'master'
+        read_ref.return_value = '1' * 40
+        self.assertFalse(cgit.reconcile(cfg, 'layer-storpool', '/sub/l'))
+        self.assertEqual(events, [Event(name='sp_msg', args=())])
+
+        events.clear()
+        read_ref.return_value = '2' * 40
+        has_commit.return_value = True
+        self.assertTrue(cgit.reconcile(cfg, 'layer-storpool', '/sub/l'))
+        has_commit.assert_called_once_with('/sub/l', '1' * 40)
+        self.assertEqual(events, [
+            Event(name='sp_msg', args=()),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', '-C', '/sub/l', 'checkout', '-q', '-f',
+                 '-B', 'master', '1' * 40]
+            )),
+        ])
+
+        events.clear()
+        has_commit.return_value = False
+        self.assertTrue(cgit.reconcile(cfg, 'layer-storpool', '/sub/l'))
+        self.assertEqual(events, [
+            Event(name='sp_msg', args=()),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', '-C', '/sub/l', 'fetch', '-q', 'origin',
+                 '+refs/heads/*:refs/remotes/origin/*']
+            )),
+            Event(name='sp_run', args=(
+                cfg,
+                ['git', '-C', '/sub/l', 'checkout', '-q', '-f',
+                 '-B', 'master', '1' * 40]
+            )),
+        ])
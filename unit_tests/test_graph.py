@@ -0,0 +1,110 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unit tests for the storpool.charms.manage.graph module.
+"""
+
+
+import os
+import tempfile
+import unittest
+
+import mock
+
+from storpool.charms.manage import graph as cgraph
+
+
+def make_graph() -> cgraph.Graph:
+    """ Build a small graph of charms, layers, and interfaces. """
+    graph = cgraph.Graph()
+    for name, e_type in (('charm-a', 'charm'),
+                         ('layer-b', 'layer'),
+                         ('layer-c', 'layer'),
+                         ('interface-d', 'interface')):
+        graph.add_node(name, e_type, '/tmp/' + name)
+    graph.add_edge('charm-a', 'layer-c')
+    graph.add_edge('charm-a', 'layer-b')
+    graph.add_edge('layer-b', 'layer-c')
+    graph.add_edge('layer-c', 'interface-d')
+    graph.add_edge('layer-c', 'interface-d')
+    return graph
+
+
+class TestGraph(unittest.TestCase):
+    """ Test the dependency graph and its cache. """
+
+    def test_structure(self) -> None:
+        """ Query the nodes and edges of the graph. """
+        graph = make_graph()
+        self.assertEqual(sorted(graph.nodes.keys()),
+                         ['charm-a', 'interface-d', 'layer-b', 'layer-c'])
+        self.assertEqual(graph.nodes['layer-b'].type, 'layer')
+        self.assertEqual(graph.edges['charm-a'], ['layer-c', 'layer-b'])
+        self.assertEqual(graph.edges['layer-c'], ['interface-d'])
+        self.assertEqual(graph.edges['interface-d'], [])
+
+        self.assertEqual(graph.topological_order(),
+                         ['interface-d', 'layer-c', 'layer-b', 'charm-a'])
+        self.assertEqual(graph.closure('layer-b'),
+                         set(['layer-b', 'layer-c', 'interface-d']))
+
+        graph.add_external('layer-c', 'layer:basic')
+        graph.add_external('charm-a', 'layer:openstack')
+        graph.add_external('layer-b', 'layer:basic')
+        self.assertEqual(graph.external_includes(graph.closure('layer-b')),
+                         ['layer:basic'])
+        self.assertEqual(graph.external_includes(graph.closure('charm-a')),
+                         ['layer:basic', 'layer:openstack'])
+        self.assertEqual(graph.external_includes(set(['interface-d'])), [])
+
+        graph.add_edge('interface-d', 'layer-b')
+        self.assertRaises(cgraph.GraphError, graph.topological_order)
+
+    def test_cache(self) -> None:
+        """ Only parse the layer.yaml files that have changed. """
+        with tempfile.TemporaryDirectory() as subdir:
+            cache_file = os.path.join(subdir, cgraph.CACHE_FILE)
+            fname = os.path.join(subdir, 'layer.yaml')
+            with open(fname, mode='w') as f:
+                print('includes: ["layer:basic"]', file=f)
+
+            graph = cgraph.Graph(cache_file)
+            self.assertEqual(graph.read_includes(fname), ['layer:basic'])
+            graph.save()
+            self.assertTrue(os.path.isfile(cache_file))
+
+            with mock.patch('yaml.load') as mock_load:
+                graph = cgraph.Graph(cache_file)
+                self.assertEqual(graph.read_includes(fname),
+                                 ['layer:basic'])
+                mock_load.assert_not_called()
+
+            with open(fname, mode='w') as f:
+                print('includes: ["layer:basic", "layer:storpool-helper"]',
+                      file=f)
+            graph = cgraph.Graph(cache_file)
+            self.assertEqual(graph.read_includes(fname),
+                             ['layer:basic', 'layer:storpool-helper'])
+
+            with open(fname, mode='w') as f:
+                print('no-includes: here', file=f)
+            self.assertRaises(cgraph.GraphError, graph.read_includes, fname)
+
+            with open(cache_file, mode='w') as f:
+                print('{ not JSON', file=f)
+            graph = cgraph.Graph(cache_file)
+            self.assertRaises(FileNotFoundError, graph.read_includes,
+                              os.path.join(subdir, 'nonexistent.yaml'))
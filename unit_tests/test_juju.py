@@ -18,7 +18,10 @@ Tests for the storpool.charms.manage.juju module.
 """
 
 
+import json
 import re
+import subprocess
+import tempfile
 import unittest
 
 from typing import cast, Dict, List
@@ -488,7 +491,7 @@ class TestStatus(unittest.TestCase):
                 super(WeirdError, self).__init__()
                 self.cmd = cmd
 
-        def error_out(cmd: List[str]) -> None:
+        def error_out(cmd: List[str], timeout: float) -> None:
             """ Raise an exception. """
             raise WeirdError(cmd)
 
@@ -671,32 +674,32 @@ class TestStorPoolConfig(unittest.TestCase):
             'compute': ['0', '1'],
         })
 
-        next_mach = 0
-
-        def dup_hostnames(cmd: List[str]) -> bytes:
+        def dup_hostnames(cmd: List[str], timeout: float) -> bytes:
             """ Return the same hostname for any machine. """
-            nonlocal next_mach
-            mid = str(next_mach)
-            next_mach = next_mach + 1
-
-            self.assertEqual(cmd, ['juju', 'ssh', mid, 'hostname'])
-            return 'same-hostname'.encode('us-ascii')
+            self.assertEqual(cmd[:3], ['juju', 'run', '--format=json'])
+            self.assertEqual(cmd[5:7], ['--machine', '0,1'])
+            return json.dumps([
+                {
+                    'MachineId': mid,
+                    'Stdout': cjuju.FACT_MARKER + 'hostname\nsame-hostname\n',
+                }
+                for mid in ('0', '1')
+            ]).encode('UTF-8')
 
         check_output.side_effect = dup_hostnames
         self.assertRaises(cjuju.StorPoolError,
                           cjuju.get_storpool_config_data, cfg, status)
 
-        def ssh_hostnames(cmd: List[str]) -> bytes:
+        def ssh_hostnames(cmd: List[str], timeout: float) -> bytes:
             """ Mock a 'juju ssh <mach> hostname' invocation. """
-            nonlocal next_mach
-            mid = str(next_mach)
-            next_mach = next_mach + 1
-
-            self.assertEqual(cmd, ['juju', 'ssh', mid, 'hostname'])
-            return ('srv' + mid).encode('us-ascii')
+            if cmd[1] == 'run':
+                raise subprocess.CalledProcessError(1, cmd)
+            self.assertEqual(cmd[:2], ['juju', 'ssh'])
+            self.assertEqual(timeout, cfg.probe_timeout)
+            self.assertEqual(cmd[3:], ['hostname'])
+            return ('srv' + cmd[2]).encode('us-ascii')
 
         check_output.side_effect = ssh_hostnames
-        next_mach = 0
         data = cjuju.get_storpool_config_data(cfg, status)
         self.assertEqual(data, {
             'srv0': {
@@ -725,3 +728,160 @@ class TestStorPoolConfig(unittest.TestCase):
                 'storpool_version': '18.01',
             },
         })
+
+    @mock.patch('subprocess.check_output')
+    def test_probe_timeout(self, check_output: mock.MagicMock) -> None:
+        """ Report a machine that does not respond in time. """
+        cfg = cconfig.Config(space='storpool', probe_jobs=2,
+                             probe_timeout=5.0, juju_retries=1,
+                             juju_backoff=0.0)
+        check_output.return_value = JSON_REAL.encode('UTF-8')
+        status = cjuju.get_status()
+
+        probed = []  # type: List[str]
+
+        def ssh_hostnames(cmd: List[str], timeout: float) -> bytes:
+            """ Let machine 1 time out. """
+            probed.append(cmd[2])
+            if cmd[1] == 'run' or cmd[2] == '1':
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            return ('srv' + cmd[2]).encode('us-ascii')
+
+        check_output.side_effect = ssh_hostnames
+        with self.assertRaises(cjuju.RunError) as err:
+            cjuju.get_storpool_config_data(cfg, status)
+        self.assertEqual(err.exception.command, 'juju ssh 1 hostname')
+        self.assertIsInstance(err.exception.error, subprocess.TimeoutExpired)
+        self.assertEqual(sorted(probed), ['--format=json', '0', '1', '1'])
+
+    @mock.patch('subprocess.check_output')
+    def test_hostname_source(self, check_output: mock.MagicMock) -> None:
+        """ Only query the machines that "juju status" has no names for. """
+        check_output.return_value = JSON_REAL.encode('UTF-8')
+        status = cjuju.get_status()
+        status['machines']['0']['hostname'] = 'node0'
+        status['machines']['1']['display-name'] = 'node1'
+
+        probed = []  # type: List[str]
+
+        def ssh_hostnames(cmd: List[str], timeout: float) -> bytes:
+            """ Record the machines queried. """
+            if cmd[1] == 'run':
+                raise subprocess.CalledProcessError(1, cmd)
+            probed.append(cmd[2])
+            return ('srv' + cmd[2]).encode('us-ascii')
+
+        check_output.side_effect = ssh_hostnames
+        cfg = cconfig.Config(space='storpool')
+        self.assertEqual(
+            sorted(cjuju.get_storpool_config_data(cfg, status).keys()),
+            ['node0', 'node1'])
+        self.assertEqual(probed, [])
+
+        status['machines']['1']['display-name'] = ''
+        self.assertEqual(
+            sorted(cjuju.get_storpool_config_data(cfg, status).keys()),
+            ['node0', 'srv1'])
+        self.assertEqual(probed, ['1'])
+
+        cfg = cconfig.Config(space='storpool', hostname_source='status')
+        self.assertRaises(cjuju.StorPoolError,
+                          cjuju.get_storpool_config_data, cfg, status)
+
+        del probed[:]
+        cfg = cconfig.Config(space='storpool', hostname_source='ssh')
+        self.assertEqual(
+            sorted(cjuju.get_storpool_config_data(cfg, status).keys()),
+            ['srv0', 'srv1'])
+        self.assertEqual(sorted(probed), ['0', '1'])
+
+    @mock.patch('subprocess.check_output')
+    def test_batch(self, check_output: mock.MagicMock) -> None:
+        """ Query many machines at once, fall back to "juju ssh". """
+        check_output.return_value = JSON_REAL.encode('UTF-8')
+        status = cjuju.get_status()
+        calls = []  # type: List[List[str]]
+
+        def juju_run(cmd: List[str], timeout: float) -> bytes:
+            """ Mock "juju run" failing on machine 1. """
+            calls.append(cmd)
+            if cmd[1] == 'ssh':
+                return ('srv' + cmd[2]).encode('us-ascii')
+            mids = cmd[cmd.index('--machine') + 1].split(',')
+            return json.dumps({
+                'machine-' + mid: {
+                    'id': '1' + mid,
+                    'results': {
+                        'return-code': int(mid),
+                        'stdout': '{marker}hostname\nnode{mid}\n'
+                                  '{marker}interfaces\n1: lo: <UP>\n'
+                                  .format(marker=cjuju.FACT_MARKER, mid=mid),
+                    },
+                    'status': 'completed',
+                }
+                for mid in mids
+            }).encode('UTF-8')
+
+        check_output.side_effect = juju_run
+        cfg = cconfig.Config(space='storpool', hostname_source='ssh')
+        self.assertEqual(
+            sorted(cjuju.get_storpool_config_data(cfg, status).keys()),
+            ['node0', 'srv1'])
+        self.assertEqual([cmd[1] for cmd in calls], ['run', 'ssh'])
+
+        del calls[:]
+        with mock.patch('storpool.charms.manage.juju.FACT_CHUNK_SIZE', 1):
+            facts = cjuju.collect_facts(cfg, ['0', '1'],
+                                        ['hostname', 'interfaces'])
+        self.assertEqual(facts, {
+            '0': {'hostname': 'node0', 'interfaces': '1: lo: <UP>'},
+        })
+        self.assertEqual(sorted(cmd[cmd.index('--machine') + 1]
+                                for cmd in calls), ['0', '1'])
+
+    @mock.patch('subprocess.check_output')
+    def test_probe_cache(self, check_output: mock.MagicMock) -> None:
+        """ Only query the new or redeployed machines. """
+        check_output.return_value = JSON_REAL.encode('UTF-8')
+        status = cjuju.get_status()
+        probed = []  # type: List[str]
+
+        def ssh_hostnames(cmd: List[str], timeout: float) -> bytes:
+            """ Record the machines queried. """
+            if cmd[1] == 'show-model':
+                return json.dumps({
+                    'default': {'model-uuid': 'deadbeef'},
+                }).encode('UTF-8')
+            if cmd[1] == 'run':
+                raise subprocess.CalledProcessError(1, cmd)
+            probed.append(cmd[2])
+            return ('srv' + cmd[2]).encode('us-ascii')
+
+        check_output.side_effect = ssh_hostnames
+        with tempfile.TemporaryDirectory() as tempd:
+            cfg = cconfig.Config(space='storpool', cache_dir=tempd)
+            expected = ['srv0', 'srv1']
+            self.assertEqual(
+                sorted(cjuju.get_storpool_config_data(cfg, status).keys()),
+                expected)
+            self.assertEqual(sorted(probed), ['0', '1'])
+
+            del probed[:]
+            status['machines']['1']['instance-id'] = 'replaced'
+            self.assertEqual(
+                sorted(cjuju.get_storpool_config_data(cfg, status).keys()),
+                expected)
+            self.assertEqual(probed, ['1'])
+
+            del probed[:]
+            self.assertEqual(
+                sorted(cjuju.get_storpool_config_data(cfg, status).keys()),
+                expected)
+            self.assertEqual(probed, [])
+
+            cfg = cconfig.Config(space='storpool', cache_dir=tempd,
+                                 refresh=True)
+            self.assertEqual(
+                sorted(cjuju.get_storpool_config_data(cfg, status).keys()),
+                expected)
+            self.assertEqual(sorted(probed), ['0', '1'])
@@ -0,0 +1,103 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unit tests for the storpool.charms.manage.jujucall module.
+"""
+
+
+import subprocess
+import unittest
+
+from typing import List
+
+import mock
+
+from storpool.charms.manage import config as cconfig
+from storpool.charms.manage import jujucall as cjujucall
+
+
+class TestJujuCall(unittest.TestCase):
+    """ Test running the Juju commands. """
+
+    @mock.patch('time.sleep')
+    @mock.patch('subprocess.check_output')
+    def test_retry(self,
+                   check_output: mock.MagicMock,
+                   sleep: mock.MagicMock) -> None:
+        """ Retry the failed commands with an exponential backoff. """
+        cjujucall.CALLS.reset()
+        cfg = cconfig.Config(juju_timeout=7.0, juju_retries=3,
+                             juju_backoff=2.0)
+        attempts = []  # type: List[float]
+
+        def flaky(cmd: List[str], timeout: float) -> bytes:
+            """ Time out twice, then succeed. """
+            attempts.append(timeout)
+            if len(attempts) < 3:
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            return b'ok'
+
+        check_output.side_effect = flaky
+        self.assertEqual(cjujucall.check_output(cfg, ['juju', 'status']),
+                         b'ok')
+        self.assertEqual(attempts, [7.0, 7.0, 7.0])
+        self.assertEqual([call[0][0] for call in sleep.call_args_list],
+                         [2.0, 4.0])
+
+        check_output.side_effect = subprocess.CalledProcessError(
+            1, ['juju', 'ssh'])
+        with self.assertRaises(subprocess.CalledProcessError):
+            cjujucall.check_output(cfg, ['juju', 'ssh', '1', 'hostname'],
+                                   host='1', timeout=1.0, retries=1)
+        self.assertEqual(check_output.call_count, 5)
+
+        calls = cjujucall.CALLS.calls
+        self.assertEqual(
+            [(call.host, call.attempts, call.timeouts, call.timed_out,
+              call.failed)
+             for call in calls],
+            [(None, 3, 2, False, False), ('1', 2, 0, False, True)])
+
+        lines = cjujucall.CALLS.report(slow=3600)
+        self.assertEqual(
+            sorted(line.split('s  ', 1)[1] for line in lines),
+            ['(controller): juju status - succeeded after 2 retries '
+             '(2 timeouts)',
+             '1: juju ssh 1 hostname (failed, 2 attempts)'])
+        cjujucall.CALLS.reset()
+
+    @mock.patch('time.sleep')
+    @mock.patch('subprocess.check_call')
+    def test_timeout(self,
+                     check_call: mock.MagicMock,
+                     sleep: mock.MagicMock) -> None:
+        """ Report the commands that timed out on the last attempt. """
+        cjujucall.CALLS.reset()
+        cfg = cconfig.Config(juju_timeout=7.0, juju_retries=1,
+                             juju_backoff=2.0)
+        check_call.side_effect = [
+            subprocess.CalledProcessError(1, ['juju', 'ssh']),
+            subprocess.TimeoutExpired(['juju', 'ssh'], 7.0),
+        ]
+        with self.assertRaises(subprocess.TimeoutExpired):
+            cjujucall.check_call(cfg, ['juju', 'ssh', '0', 'true'], host='0')
+        self.assertEqual(sleep.call_count, 1)
+
+        lines = cjujucall.CALLS.report(slow=3600)
+        self.assertEqual(
+            [line.split('s  ', 1)[1] for line in lines],
+            ['0: juju ssh 0 true (timed out, 2 attempts)'])
+        cjujucall.CALLS.reset()
@@ -0,0 +1,68 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unit tests for the storpool.charms.manage.probecache module.
+"""
+
+
+import os
+import tempfile
+import time
+import unittest
+
+import mock
+
+from storpool.charms.manage import config as cconfig
+from storpool.charms.manage import probecache as cprobecache
+
+
+class TestProbeCache(unittest.TestCase):
+    """ Test the cache of the facts queried from the machines. """
+
+    def test_cache(self) -> None:
+        """ Store, expire, and ignore the cached facts. """
+        with tempfile.TemporaryDirectory() as tempd:
+            cfg = cconfig.Config(cache_dir=tempd, probe_cache_ttl=100)
+            fname = cfg.probe_cache_file
+            assert fname is not None
+            self.assertEqual(fname, os.path.join(tempd, 'probes.json'))
+            self.assertEqual(cprobecache.read_cache(fname), {})
+
+            key = cprobecache.cache_key('uuid', '0', 'kyapk6')
+            self.assertNotEqual(key,
+                                cprobecache.cache_key('uuid', '0', 'nyaphk'))
+            entries = cprobecache.read_cache(fname)
+            cprobecache.store(entries, key, {'hostname': 'srv0'})
+            old = cprobecache.cache_key('uuid', '1', '4p3nfh')
+            cprobecache.store(entries, old, {'hostname': 'srv1'})
+            entries[old]['time'] -= 200
+            cprobecache.write_cache(cfg, fname, entries)
+
+            entries = cprobecache.read_cache(fname)
+            self.assertEqual(list(entries.keys()), [key])
+            self.assertEqual(cprobecache.lookup(cfg, entries, key),
+                             {'hostname': 'srv0'})
+            self.assertIsNone(cprobecache.lookup(cfg, entries, old))
+
+            refresh = cconfig.Config(cache_dir=tempd, refresh=True)
+            self.assertIsNone(cprobecache.lookup(refresh, entries, key))
+
+            with mock.patch('time.time', return_value=time.time() + 100):
+                self.assertIsNone(cprobecache.lookup(cfg, entries, key))
+
+            with open(fname, mode='w') as f:
+                print('[]', file=f)
+            self.assertEqual(cprobecache.read_cache(fname), {})
@@ -0,0 +1,286 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unit tests for the storpool.charms.manage.testrun module.
+"""
+
+
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import unittest
+import xml.etree.ElementTree as ET
+
+from typing import List, Tuple
+
+import mock
+
+from storpool.charms.manage import config as cconfig
+from storpool.charms.manage import testrun as ctestrun
+
+
+_TYPING_USED = (Tuple,)
+
+
+ELEMENTS = [
+    'charms/charm-storpool-block',
+    'interfaces/interface-storpool-service',
+    'layers/layer-storpool-helper',
+]
+
+
+class TestRun(unittest.TestCase):
+    """ Test running the tests of the elements. """
+
+    @mock.patch('storpool.charms.manage.utils.sp_run_output',
+                return_value=None)
+    @mock.patch('storpool.charms.manage.utils.sp_run')
+    @mock.patch('storpool.charms.manage.utils.sp_run_capture')
+    def test_parallel(self,
+                      sp_run_capture: mock.MagicMock,
+                      sp_run: mock.MagicMock,
+                      sp_run_output: mock.MagicMock) -> None:
+        """ Test the elements at the same time, collect the results. """
+        lock = threading.Lock()
+        commands = []  # type: List[Tuple[str, str]]
+
+        def run_capture(cfg: cconfig.Config,
+                        command: List[str],
+                        prefix: str,
+                        cwd: str) -> None:
+            """ Record the test commands, fail one of them. """
+            self.assertEqual(os.path.basename(cwd), prefix)
+            with lock:
+                commands.append((prefix, ' '.join(command)))
+            if prefix == 'layer-storpool-helper' and command[-1] == 'pep8':
+                raise subprocess.CalledProcessError(1, command)
+
+        sp_run_capture.side_effect = run_capture
+        with tempfile.TemporaryDirectory() as subdir:
+            for path in ELEMENTS:
+                os.makedirs(os.path.join(subdir, path))
+                if not path.startswith('interfaces/'):
+                    with open(os.path.join(subdir, path, 'tox.ini'),
+                              mode='w') as f:
+                        print('[tox]', file=f)
+
+            cfg = cconfig.Config(jobs=3)
+            results = ctestrun.test_elements(cfg, subdir, ELEMENTS)
+
+        self.assertEqual(sorted(commands), [
+            ('charm-storpool-block', 'tox -e ALL'),
+            ('charm-storpool-block', 'tox -e pep8'),
+            ('interface-storpool-service', 'flake8 .'),
+            ('interface-storpool-service', 'pep8 .'),
+            ('layer-storpool-helper', 'tox -e pep8'),
+        ])
+        self.assertEqual(sp_run.call_count, 2)
+
+        self.assertEqual(sorted(results.keys()), ELEMENTS)
+        self.assertEqual(
+            [(res.step, res.status)
+             for res in results['layers/layer-storpool-helper']],
+            [('pep8', ctestrun.STATUS_FAILED),
+             ('tox', ctestrun.STATUS_SKIPPED)])
+        self.assertEqual(ctestrun.failed_elements(results),
+                         ['layers/layer-storpool-helper'])
+
+        matrix = ctestrun.format_matrix(results)
+        self.assertEqual(len(matrix), 4)
+        self.assertEqual(matrix[0].split(),
+                         ['element', 'flake8', 'pep8', 'tox'])
+        self.assertEqual(matrix[2].split()[:2],
+                         ['interfaces/interface-storpool-service', 'ok'])
+        self.assertEqual(matrix[2].split()[-1], '-')
+        self.assertEqual(matrix[3].split()[:4],
+                         ['layers/layer-storpool-helper', '-', 'FAIL',
+                          matrix[3].split()[3]])
+        self.assertEqual(matrix[3].split()[-1], 'skipped')
+
+    @mock.patch('storpool.charms.manage.utils.sp_run_output',
+                side_effect=OSError)
+    @mock.patch('storpool.charms.manage.utils.sp_run')
+    def test_cached(self,
+                    sp_run: mock.MagicMock,
+                    sp_run_output: mock.MagicMock) -> None:
+        """ Do not test the unchanged elements again. """
+        def git(*args: str) -> None:
+            """ Run a Git command in the element's directory. """
+            subprocess.check_call(['git', '-C', path, '-c', 'user.name=T',
+                                   '-c', 'user.email=t@example.com'] +
+                                  list(args), stdout=subprocess.DEVNULL)
+
+        def tested() -> List[str]:
+            """ Run the tests, return the commands actually executed. """
+            sp_run.reset_mock()
+            results = ctestrun.test_elements(cfg, subdir, [elem])
+            self.assertEqual(ctestrun.failed_elements(results), [])
+            return [' '.join(call[0][1]) for call in sp_run.call_args_list]
+
+        elem = 'layers/layer-storpool-helper'
+        with tempfile.TemporaryDirectory() as subdir:
+            path = os.path.join(subdir, elem)
+            os.makedirs(path)
+            with open(os.path.join(path, 'tox.ini'), mode='w') as f:
+                print('[tox]', file=f)
+            git('init', '-q')
+            git('add', 'tox.ini')
+            git('commit', '-q', '-m', 'Initial commit')
+
+            cfg = cconfig.Config()
+            all_steps = ['tox -e pep8', 'tox -e ALL', 'rm -rf .tox/']
+            self.assertEqual(tested(), all_steps)
+            self.assertEqual(tested(), [])
+            results = ctestrun.test_elements(cfg, subdir, [elem])
+            self.assertEqual([res.status for res in results[elem]],
+                             [ctestrun.STATUS_CACHED] * 2)
+
+            cfg = cconfig.Config(force=True)
+            self.assertEqual(tested(), all_steps)
+
+            cfg = cconfig.Config()
+            with open(os.path.join(path, 'tox.ini'), mode='a') as f:
+                print('envlist = pep8', file=f)
+            self.assertEqual(tested(), all_steps)
+            self.assertEqual(tested(), [])
+
+    @mock.patch('storpool.charms.manage.utils.sp_run_output',
+                return_value='pep8\npy3\nfunc-smoke\n')
+    @mock.patch('storpool.charms.manage.utils.sp_run')
+    def test_tox_workdir(self,
+                         sp_run: mock.MagicMock,
+                         sp_run_output: mock.MagicMock) -> None:
+        """ Keep the tox environments in the cache directory. """
+        with tempfile.TemporaryDirectory() as tempd:
+            path = os.path.join(tempd, 'layers', 'layer-storpool-helper')
+            os.makedirs(path)
+            for name in ('tox.ini', 'requirements.txt', 'README.md'):
+                with open(os.path.join(path, name), mode='w') as f:
+                    print(name, file=f)
+
+            self.assertIsNone(ctestrun.tox_workdir(cconfig.Config(), path))
+            cfg = cconfig.Config(cache_dir=os.path.join(tempd, 'cache'))
+            workdir = ctestrun.tox_workdir(cfg, path)
+            assert workdir is not None
+            self.assertEqual(os.path.dirname(workdir), cfg.tox_cache_dir)
+            self.assertTrue(os.path.basename(workdir)
+                            .startswith('layer-storpool-helper-'))
+
+            with open(os.path.join(path, 'README.md'), mode='a') as f:
+                print('More documentation', file=f)
+            self.assertEqual(ctestrun.tox_workdir(cfg, path), workdir)
+
+            ctestrun.test_element(cfg, path)
+            self.assertEqual(
+                [call[0][1] for call in sp_run.call_args_list],
+                [['tox', '--workdir', workdir, '-e', 'pep8'],
+                 ['tox', '--workdir', workdir, '-e', 'py3'],
+                 ['tox', '--workdir', workdir, '-e', 'func-smoke']])
+            sp_run_output.assert_called_once_with(
+                cfg, ['tox', '--workdir', workdir, '-l'],
+                'layer-storpool-helper', cwd=path)
+            self.assertTrue(os.path.isdir(workdir))
+
+            with open(os.path.join(path, 'requirements.txt'), mode='a') as f:
+                print('charmhelpers', file=f)
+            new_workdir = ctestrun.tox_workdir(cfg, path)
+            assert new_workdir is not None
+            self.assertNotEqual(new_workdir, workdir)
+
+            other = os.path.join(os.path.dirname(workdir),
+                                 'layer-storpool-0123456789abcdef')
+            os.mkdir(other)
+            ctestrun.test_element(cfg, path)
+            self.assertEqual(sorted(os.listdir(cfg.tox_cache_dir)),
+                             sorted([os.path.basename(new_workdir),
+                                     os.path.basename(other)]))
+
+    @mock.patch('storpool.charms.manage.utils.sp_run_output',
+                return_value='default environments:\npep8\npy3\nlint\n')
+    @mock.patch('storpool.charms.manage.utils.sp_run_capture')
+    def test_report(self,
+                    sp_run_capture: mock.MagicMock,
+                    sp_run_output: mock.MagicMock) -> None:
+        """ Write the JUnit XML and JSON reports with failure excerpts. """
+        def run_capture(cfg: cconfig.Config,
+                        command: List[str],
+                        prefix: str,
+                        cwd: str,
+                        log_file: str) -> None:
+            """ Fail the py3 tests of the helper layer. """
+            self.assertTrue(os.path.isdir(os.path.dirname(log_file)))
+            if command[-1] == 'py3' and cwd.endswith('-helper'):
+                output = ''.join('line {idx}\n'.format(idx=idx)
+                                 for idx in range(100))
+                raise subprocess.CalledProcessError(
+                    1, command, output=output.encode('UTF-8'))
+
+        sp_run_capture.side_effect = run_capture
+        with tempfile.TemporaryDirectory() as tempd:
+            for elem in ELEMENTS:
+                os.makedirs(os.path.join(tempd, elem))
+                with open(os.path.join(tempd, elem, 'tox.ini'),
+                          mode='w') as f:
+                    print('[tox]', file=f)
+            report_dir = os.path.join(tempd, 'report')
+            cfg = cconfig.Config(report_dir=report_dir)
+            results = ctestrun.test_elements(
+                cfg, tempd, [os.path.join(tempd, elem) for elem in ELEMENTS])
+            ctestrun.write_reports(cfg, results)
+
+            self.assertEqual(
+                sorted(os.listdir(report_dir)),
+                sorted(['logs', 'summary.json'] +
+                       [os.path.basename(elem) + ext for elem in ELEMENTS
+                        for ext in ('.json', '.xml')]))
+            with open(os.path.join(report_dir, 'summary.json'),
+                      mode='r') as f:
+                summary = json.load(f)
+            self.assertEqual(summary['failed'],
+                             [os.path.join(tempd, ELEMENTS[2])])
+
+            suite = ET.parse(os.path.join(
+                report_dir, 'layer-storpool-helper.xml')).getroot()
+            self.assertEqual((suite.get('tests'), suite.get('failures'),
+                              suite.get('skipped')), ('3', '1', '1'))
+            self.assertEqual([case.get('name')
+                              for case in suite.findall('testcase')],
+                             ['pep8', 'py3', 'lint'])
+            failure = suite.find('testcase/failure')
+            assert failure is not None and failure.text is not None
+            lines = failure.text.split('\n')
+            self.assertEqual(len(lines), ctestrun.EXCERPT_LINES)
+            self.assertEqual(lines[-1], 'line 99')
+
+            suite = ET.parse(os.path.join(
+                report_dir, 'charm-storpool-block.xml')).getroot()
+            self.assertEqual((suite.get('tests'), suite.get('failures'),
+                              suite.get('skipped')), ('3', '0', '0'))
+
+        steps = [
+            ctestrun.StepResult(step='pep8', status=ctestrun.STATUS_CACHED,
+                                duration=5.0, excerpt=''),
+            ctestrun.StepResult(step='py3', status=ctestrun.STATUS_PASSED,
+                                duration=2.5, excerpt=''),
+        ]
+        self.assertEqual(ctestrun.result_dict('elem', steps)['duration'], 2.5)
+        suite = ctestrun.junit_xml('elem', steps)
+        self.assertEqual(suite.get('time'), '2.500')
+        self.assertEqual([case.get('time')
+                          for case in suite.findall('testcase')],
+                         ['0.000', '2.500'])
@@ -0,0 +1,87 @@
+# Copyright (c) 2018  StorPool
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Unit tests for the storpool.charms.manage.timing module.
+"""
+
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from storpool.charms.manage import timing as ctiming
+
+
+class TestTimings(unittest.TestCase):
+    """ Test the recording of the durations of the steps. """
+
+    @mock.patch('time.monotonic')
+    def test_spans(self, monotonic: mock.MagicMock) -> None:
+        """ Record nested spans and attribute them to elements. """
+        ticks = iter(range(0, 1000, 1))
+        monotonic.side_effect = lambda: float(next(ticks))
+        timings = ctiming.Timings()
+
+        def process(name: str) -> None:
+            """ Run a couple of commands for an element. """
+            with timings.element(name):
+                with timings.span(ctiming.STAGE_RUN, 'tox -e pep8'):
+                    pass
+                with timings.span(ctiming.STAGE_RUN, 'tox -e ALL'):
+                    self.assertEqual(timings.current_element(), name)
+
+        with timings.span(ctiming.STAGE_COMMAND, 'test'):
+            process('layer-a')
+            thr = threading.Thread(target=process, args=('layer-b',))
+            thr.start()
+            thr.join()
+            self.assertIsNone(timings.current_element())
+
+        spans = timings.spans
+        self.assertEqual(len(spans), 7)
+        self.assertEqual(spans[-1].stage, ctiming.STAGE_COMMAND)
+        self.assertIsNone(spans[-1].element)
+        self.assertEqual(
+            sorted((span.element, span.name) for span in spans
+                   if span.stage == ctiming.STAGE_RUN),
+            [('layer-a', 'tox -e ALL'), ('layer-a', 'tox -e pep8'),
+             ('layer-b', 'tox -e ALL'), ('layer-b', 'tox -e pep8')])
+
+        report = timings.report()
+        self.assertEqual(report['stages'][ctiming.STAGE_RUN]['count'], 4)
+        self.assertEqual(report['stages'][ctiming.STAGE_ELEMENT]['count'], 2)
+        self.assertEqual(sorted(report['elements'].keys()),
+                         ['layer-a', 'layer-b'])
+        self.assertEqual(report['elements']['layer-a'],
+                         {ctiming.STAGE_ELEMENT: 5.0,
+                          ctiming.STAGE_RUN: 2.0})
+
+        slowest = timings.slowest(3)
+        self.assertEqual([span.stage for span in slowest],
+                         [ctiming.STAGE_ELEMENT] * 2 + [ctiming.STAGE_RUN])
+
+        with tempfile.TemporaryDirectory() as tempd:
+            fname = os.path.join(tempd, 'timings.json')
+            timings.write_report(fname)
+            with open(fname, mode='r') as f:
+                self.assertEqual(len(json.load(f)['spans']), 7)
+
+        timings.reset()
+        self.assertEqual(timings.spans, [])
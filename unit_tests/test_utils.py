@@ -18,14 +18,24 @@ Unit tests for the storpool.charms.manage.utils module.
 """
 
 import builtins
+import json
+import os
+import subprocess
+import tempfile
+import threading
 import unittest
 
+from typing import List
+
 import mock
 
 from storpool.charms.manage import config as cconfig
 from storpool.charms.manage import utils as cu
 
 
+_TYPING_USED = (List,)
+
+
 class TestSPMsg(unittest.TestCase):
     """
     A trivial test for the sp_msg() function.
@@ -89,3 +99,179 @@ class TestDirectories(unittest.TestCase):
         cu.sp_chdir(cfg, '/path', do_chdir=True)
         self.assertEqual(sp_msg.call_count, 3)
         self.assertEqual(os_chdir.call_count, 4)
+
+
+class TestParallel(unittest.TestCase):
+    """
+    Test the sp_parallel() function.
+    """
+
+    def test_sequential(self) -> None:
+        """
+        Make sure that no-op mode and a single job run things in order.
+        """
+        for cfg in (cconfig.Config(noop=True, jobs=4),
+                    cconfig.Config(jobs=1)):
+            seen = []  # type: List[int]
+
+            def record(item: int) -> int:
+                """ Record the item and return its square. """
+                seen.append(item)
+                return item * item
+
+            self.assertEqual(cu.sp_parallel(cfg, record, [3, 1, 2]),
+                             [9, 1, 4])
+            self.assertEqual(seen, [3, 1, 2])
+
+    def test_parallel(self) -> None:
+        """
+        Make sure that several jobs really run at the same time.
+        """
+        cfg = cconfig.Config(jobs=3)
+        barrier = threading.Barrier(3, timeout=5)
+
+        def wait_for_all(item: int) -> int:
+            """ Wait for all the other jobs to start. """
+            barrier.wait()
+            return item + 1
+
+        self.assertEqual(cu.sp_parallel(cfg, wait_for_all, [1, 2, 3]),
+                         [2, 3, 4])
+
+
+class TestRunCapture(unittest.TestCase):
+    """
+    Test the sp_run_capture() function.
+    """
+
+    @mock.patch('storpool.charms.manage.utils.sp_msg')
+    def test_capture(self, sp_msg: mock.MagicMock) -> None:
+        """
+        Make sure that the output is prefixed and failures are reported.
+        """
+        cfg = cconfig.Config()
+        cu.sp_run_capture(cfg, ['printf', 'a\\n\\nb\\n'], 'elem')
+        sp_msg.assert_called_once_with('[elem] a\n[elem] b')
+
+        sp_msg.reset_mock()
+        with self.assertRaises(subprocess.CalledProcessError):
+            cu.sp_run_capture(cfg, ['sh', '-c', 'echo oops; exit 3'], 'bad')
+        sp_msg.assert_called_once_with('[bad] oops')
+
+        sp_msg.reset_mock()
+        cfg = cconfig.Config(noop=True)
+        cu.sp_run_capture(cfg, ['false'], 'noop')
+        sp_msg.assert_called_once_with('# false')
+
+        sp_msg.reset_mock()
+        cu.sp_run_capture(cfg, ['false'], 'noop', cwd='/nowhere')
+        sp_msg.assert_called_once_with("# cd -- '/nowhere' && false")
+
+    @mock.patch('storpool.charms.manage.utils.sp_msg')
+    def test_output(self, sp_msg: mock.MagicMock) -> None:
+        """
+        Make sure that the output is returned and the errors are prefixed.
+        """
+        cfg = cconfig.Config()
+        self.assertEqual(
+            cu.sp_run_output(cfg, ['sh', '-c', 'echo out; echo err >&2'],
+                             'elem'),
+            'out\n')
+        sp_msg.assert_called_once_with('[elem] err')
+
+        sp_msg.reset_mock()
+        with self.assertRaises(subprocess.CalledProcessError):
+            cu.sp_run_output(cfg, ['sh', '-c', 'exit 1'], 'bad')
+        sp_msg.assert_not_called()
+
+        cfg = cconfig.Config(noop=True)
+        self.assertIsNone(cu.sp_run_output(cfg, ['false'], 'noop'))
+        sp_msg.assert_called_once_with('# false')
+
+    @mock.patch('storpool.charms.manage.utils.sp_msg')
+    def test_log_file(self, sp_msg: mock.MagicMock) -> None:
+        """
+        Make sure that the full output is stored in the log file.
+        """
+        cfg = cconfig.Config()
+        with tempfile.TemporaryDirectory() as tempd:
+            log_file = os.path.join(tempd, 'elem.log')
+            with self.assertRaises(subprocess.CalledProcessError):
+                cu.sp_run_capture(cfg, ['sh', '-c', 'echo oops; exit 3'],
+                                  'elem', cwd=tempd, log_file=log_file)
+            with open(log_file, mode='r') as f:
+                contents = f.read()
+        self.assertEqual(contents,
+                         "# cd -- '{tempd}' && sh -c echo oops; exit 3\n"
+                         "oops\n".format(tempd=tempd))
+        sp_msg.assert_called_once_with('[elem] oops')
+
+
+class TestReplaceDir(unittest.TestCase):
+    """
+    Test the sp_replace_dir() function.
+    """
+
+    def test_replace(self) -> None:
+        """
+        Move a new directory into place, removing the old one.
+        """
+        with tempfile.TemporaryDirectory() as tempd:
+            (src, dst) = (tempd + '/new', tempd + '/built')
+            os.mkdir(src)
+            with open(src + '/first', mode='w') as f:
+                print('first', file=f)
+            cu.sp_replace_dir(cconfig.Config(), src, dst)
+            self.assertEqual(os.listdir(tempd), ['built'])
+            self.assertEqual(os.listdir(dst), ['first'])
+
+            os.mkdir(src)
+            with open(src + '/second', mode='w') as f:
+                print('second', file=f)
+            with mock.patch('storpool.charms.manage.utils.sp_msg') as sp_msg:
+                cu.sp_replace_dir(cconfig.Config(noop=True), src, dst)
+                sp_msg.assert_called_once_with(
+                    "# mv -T -- '{src}' '{dst}'".format(src=src, dst=dst))
+            self.assertEqual(os.listdir(dst), ['first'])
+
+            cu.sp_replace_dir(cconfig.Config(), src, dst)
+            self.assertEqual(os.listdir(tempd), ['built'])
+            self.assertEqual(os.listdir(dst), ['second'])
+
+
+class TestWriteJSON(unittest.TestCase):
+    """
+    Test the sp_write_json() function.
+    """
+
+    def test_write(self) -> None:
+        """
+        Store the data, leaving no temporary files behind.
+        """
+        with tempfile.TemporaryDirectory() as tempd:
+            fname = tempd + '/state.json'
+            self.assertNotEqual(cu.sp_temp_name(fname), fname + '.tmp')
+            self.assertTrue(cu.sp_temp_name(fname).startswith(fname))
+
+            cu.sp_write_json(fname, {'b': [1, 2], 'a': 'x'})
+            self.assertEqual(os.listdir(tempd), ['state.json'])
+            with open(fname, mode='r') as f:
+                self.assertEqual(json.load(f), {'a': 'x', 'b': [1, 2]})
+
+            with self.assertRaises(TypeError):
+                cu.sp_write_json(fname, {'a': object()})
+            self.assertEqual(os.listdir(tempd), ['state.json'])
+            with open(fname, mode='r') as f:
+                self.assertEqual(json.load(f), {'a': 'x', 'b': [1, 2]})
+
+    def test_threads(self) -> None:
+        """
+        Make sure different threads use different temporary files.
+        """
+        names = []  # type: List[str]
+        thr = threading.Thread(
+            target=lambda: names.append(cu.sp_temp_name('/x/y')))
+        thr.start()
+        thr.join()
+        self.assertNotEqual(names, [cu.sp_temp_name('/x/y')])
+        self.assertEqual(len(names), 1)